@@ -27,7 +27,12 @@ help_text = textwrap.dedent('''\
     Commands:
 
         runserver         - Run the Quart dev server (DO NOT USE IN PRODUCTION. USE Hypercorn)
+        initdb            - Create the database, tables and indexes (of the STORAGE_BACKEND) if they don't exist
+        rebuild_stats     - Recount the hourly / daily stats rollups from every imported message
+        reindex           - Recompute the search tokens, delivery records (and other indexed fields) of every imported message
         parse             - Parse the mail log and import it into the DB
+        follow            - Continuously tail the mail log, importing new lines as they're written
+        bench             - Run the offline parser / storage benchmarks
 
 ''')
 
@@ -42,8 +47,10 @@ subparser = parser.add_subparsers()
 
 
 def runserver(opt):
+    from postfixparser.storage import get_storage
     from postfixparser.webui import app
 
+    asyncio.run(get_storage().bootstrap())
     app.run(
         host=opt.host,
         port=opt.port,
@@ -51,9 +58,85 @@ def runserver(opt):
     )
 
 
+def runinitdb(opt):
+    from postfixparser.storage import get_storage
+    asyncio.run(get_storage().bootstrap())
+
+
+def runrebuildstats(opt):
+    from postfixparser.stats import rebuild_stats
+    from postfixparser.storage import get_storage
+
+    async def _rebuild():
+        await get_storage().bootstrap()
+        docs = await rebuild_stats()
+        print(f"Rebuilt the stats rollups - {docs} documents written")
+
+    asyncio.run(_rebuild())
+
+
+def runreindex(opt):
+    from postfixparser.main import reindex
+    from postfixparser.storage import get_storage
+
+    async def _reindex():
+        await get_storage().bootstrap()
+        await reindex()
+
+    asyncio.run(_reindex())
+
+
 def runparse(opt):
     from postfixparser.main import main
-    asyncio.run(main())
+    asyncio.run(main(full=opt.full, pattern=opt.glob, workers=opt.workers, rewrite=opt.rewrite))
+
+
+def runfollow(opt):
+    from postfixparser.follow import follow
+    asyncio.run(follow(full=opt.full))
+
+
+def runbench(opt):
+    import json
+    import logging
+    import os
+    import tempfile
+    from postfixparser import benchmark, loggen
+
+    # core attaches an INFO console handler to the 'postfixparser' logger - quieten it so it doesn't drown out the results
+    logging.getLogger('postfixparser').setLevel(logging.WARNING)
+    results = dict(seed=opt.seed)
+    if 'parser' in opt.suites:
+        results['parser'] = benchmark.bench_parser(count=opt.lines, repeat=opt.repeat, seed=opt.seed)
+        benchmark.print_parser_bench(results['parser'])
+    log_suites = [s for s in opt.suites if s != 'parser']
+    if len(log_suites) > 0:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = opt.log
+            if path is None:
+                path = os.path.join(tmp, 'mail.log')
+                lines = loggen.write_mail_log(
+                    path, opt.messages, seed=opt.seed, rate=opt.rate, defer_rate=opt.defer_rate, bounce_rate=opt.bounce_rate,
+                    retry_minutes=opt.retry_minutes, reuse_rate=opt.reuse_rate,
+                )
+                print(f"Generated synthetic log with {opt.messages} emails ({lines} lines)")
+            if 'stages' in opt.suites:
+                results['stages'] = benchmark.bench_stages(path, latencies=[float(l) for l in opt.latency.split(',')])
+                benchmark.print_stages_bench(results['stages'])
+            if 'workers' in opt.suites:
+                counts = [int(w) for w in opt.workers.split(',')]
+                results['workers'] = benchmark.bench_workers(path, counts)
+                benchmark.print_workers_bench(results['workers'])
+            if 'memory' in opt.suites:
+                results['memory'] = benchmark.bench_memory(path)
+                benchmark.print_memory_bench(results['memory'])
+            if 'storage' in opt.suites:
+                results['storage'] = benchmark.bench_storage(path, opt.backends.split(','), repeat=opt.repeat)
+                benchmark.print_storage_bench(results['storage'])
+    if opt.output is not None:
+        with open(opt.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"Saved results to {opt.output}")
 
 
 p_run = subparser.add_parser('runserver', description='Run Quart dev server (DO NOT USE IN PRODUCTION. USE Hypercorn)')
@@ -61,9 +144,61 @@ p_run.add_argument('--port', help='Port to listen on', default=5222, type=int)
 p_run.add_argument('--host', help='IP/Hostname to listen on', default='127.0.0.1')
 p_run.set_defaults(func=runserver)
 
+p_initdb = subparser.add_parser('initdb', description="Create the database, tables and indexes of the STORAGE_BACKEND if "
+                                                     "they don't exist (the Web UI doesn't create them itself)")
+p_initdb.set_defaults(func=runinitdb)
+
+p_rebuild = subparser.add_parser('rebuild_stats', description="Recount the hourly / daily stats rollups (used by "
+                                                             "/api/stats) from every message in the DB. Stop the "
+                                                             "importer first.")
+p_rebuild.set_defaults(func=runrebuildstats)
+
+p_reindex = subparser.add_parser('reindex', description="Recompute the search tokens, per-recipient delivery records "
+                                                       "(and other indexed fields) of every message already in the DB")
+p_reindex.set_defaults(func=runreindex)
+
 p_parse = subparser.add_parser('parse', description='Parse the mail log and import it into the DB')
+p_parse.add_argument('--full', help='Ignore the saved checkpoint, and re-import the whole mail log', action='store_true',
+                     default=False)
+p_parse.add_argument('--glob', help="Import all rotated / compressed logs matching this pattern in chronological order, "
+                                    "e.g. '/var/log/mail.log*' (does not use or update the checkpoint)", default=None)
+p_parse.add_argument('--workers', help='Parse uncompressed logs in parallel using this many processes', default=1, type=int)
+p_parse.add_argument('--rewrite', help='Write every message read, even if it has not changed since it was last imported '
+                                       '(empties the fingerprint cache)', action='store_true', default=False)
 p_parse.set_defaults(func=runparse)
 
+p_follow = subparser.add_parser('follow', description='Continuously tail the mail log, importing new lines as they are '
+                                                       'written. Stops cleanly on SIGTERM / SIGINT.')
+p_follow.add_argument('--full', help='Ignore the saved checkpoint, and import the whole mail log before following it',
+                      action='store_true', default=False)
+p_follow.set_defaults(func=runfollow)
+
+p_bench = subparser.add_parser('bench', description='Run the offline parser / storage benchmarks (only the rethinkdb '
+                                                   'storage benchmark needs RethinkDB)')
+p_bench.add_argument('suites', help="Benchmarks to run: 'parser', 'stages', 'workers', 'memory' and/or 'storage' "
+                                    "(default: parser stages)",
+                     nargs='*', choices=['parser', 'stages', 'workers', 'memory', 'storage'], default=['parser', 'stages'])
+p_bench.add_argument('--lines', help="Number of synthetic log lines for the 'parser' benchmark", default=100000, type=int)
+p_bench.add_argument('--repeat', help='Run each benchmark this many times, and report the fastest', default=3, type=int)
+p_bench.add_argument('--seed', help='Random seed for the synthetic log generator', default=1234, type=int)
+p_bench.add_argument('--messages', help='Number of emails in the generated log file', default=20000, type=int)
+p_bench.add_argument('--rate', help='Emails received per second in the generated log (higher = more interleaving)',
+                     default=20.0, type=float)
+p_bench.add_argument('--defer-rate', help='Probability of each delivery attempt being deferred', default=0.1, type=float)
+p_bench.add_argument('--bounce-rate', help='Probability of each delivery attempt bouncing', default=0.02, type=float)
+p_bench.add_argument('--retry-minutes', help='Deferred deliveries are retried 5 to this many minutes later (more than '
+                                              'FLUSH_IDLE_MINUTES makes the importer flush them as idle)', default=30, type=int)
+p_bench.add_argument('--reuse-rate', help='Probability of each email re-using the queue ID of a removed one',
+                     default=0.0, type=float)
+p_bench.add_argument('--log', help='Benchmark against this existing log file instead of generating one', default=None)
+p_bench.add_argument('--latency', help="Comma separated seconds the fake DB writer waits per batch in the 'stages' "
+                                        "baseline / end-to-end / pipeline benchmarks, e.g. 0,0.05,0.2", default='0')
+p_bench.add_argument('--workers', help="Comma separated worker counts for the 'workers' benchmark", default='1,2,4,8')
+p_bench.add_argument('--backends', help="Comma separated storage backends for the 'storage' benchmark. WARNING: "
+                                     "'rethinkdb' empties the sent_mail table of RETHINK_DB", default='sqlite')
+p_bench.add_argument('--output', help='Also save the results as JSON to this file', default=None)
+p_bench.set_defaults(func=runbench)
+
 args = parser.parse_args()
 
 if 'func' in args:
@@ -0,0 +1,622 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Offline benchmarks for the log parser, runnable via ``./manage.py bench``. They don't need RethinkDB (except for
+the ``storage`` benchmark of the ``rethinkdb`` backend).
+
+Log files for the benchmarks are generated by :mod:`postfixparser.loggen`, so results are reproducible for a given
+seed, and can be compared between releases (``./manage.py bench --output results.json``).
+
+"""
+import asyncio
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Callable, Tuple
+
+from privex.helpers import Dictable
+
+from postfixparser import dates, settings
+from postfixparser.main import (
+    _message_doc, abatched, batched, track_logs, _tracked_docs, write_pipeline
+)
+from postfixparser.objects import PostfixMessage
+from postfixparser.parser import match, tokenize_line
+from postfixparser.stream import MessageTracker
+
+# The original regex based parser, kept here as a baseline to benchmark (and verify) the tokenizing parser against.
+_find_to = re.compile(r'.*to=<([a-zA-Z0-9-_.]+@[a-zA-Z0-9-_.]+)>')
+_find_from = re.compile(r'.*from=<([a-zA-Z0-9-_.]+@[a-zA-Z0-9-_.]+)>')
+_find_message_id = re.compile(r'.*message-id=<(.*)>')
+_find_status = re.compile(r'.*status=([a-zA-Z0-9-_.]+) (.*)?')
+_find_relay = re.compile(r'.*relay=([a-zA-Z0-9-._]+)\[(.*)\]:([0-9]+)')
+_find_client = re.compile(r'.*client=([a-zA-Z0-9-._]+)\[(.*)\]')
+
+
+def regex_parse_line(mline) -> dict:
+    """The original six-regex implementation of :func:`postfixparser.parser.parse_line`"""
+    lm = {}
+
+    _to = _find_to.match(mline)
+    _from = _find_from.match(mline)
+    _client = _find_client.match(mline)
+    _relay = _find_relay.match(mline)
+
+    if _to is not None: lm['mail_to'] = _to.group(1)
+    if _from is not None: lm['mail_from'] = _from.group(1)
+    if _client is not None: lm['client'] = dict(host=_client.group(1), ip=_client.group(2))
+    if _relay is not None: lm['relay'] = dict(host=_relay.group(1), ip=_relay.group(2), port=_relay.group(3))
+
+    _status = _find_status.match(mline)
+    if _status is not None:
+        lm['status'] = dict(code=_status.group(1), message="")
+        if len(_status.groups()) > 1:
+            lm['status']['message'] = _status.group(2)
+
+    _message_id = _find_message_id.match(mline)
+    if _message_id is not None: lm['message_id'] = _message_id.group(1)
+
+    return lm
+
+
+@dataclass
+class LegacyPostfixLog(Dictable):
+    """The original ``__dict__`` based :class:`postfixparser.objects.PostfixLog`, kept as a memory usage baseline"""
+    timestamp: datetime
+    queue_id: str
+    message: str
+
+    def __post_init__(self):
+        if type(self.timestamp) is not datetime:
+            self.timestamp = dates.parse_log_time(self.timestamp)
+        self.message = self.message.strip()
+        self.queue_id = self.queue_id.strip()
+
+
+@dataclass
+class LegacyPostfixMessage(Dictable):
+    """The original :class:`postfixparser.objects.PostfixMessage`, holding a list of :class:`.LegacyPostfixLog`'s"""
+    timestamp: datetime
+    queue_id: str
+    lines: List[LegacyPostfixLog] = field(default_factory=list)
+    mail_to: str = ""
+    mail_from: str = ""
+    message_id: str = ""
+    status: dict = field(default_factory=dict)
+    relay: dict = field(default_factory=dict)
+    client: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        if type(self.timestamp) is not datetime:
+            self.timestamp = dates.parse_log_time(self.timestamp)
+        self.queue_id = self.queue_id.strip()
+
+    def merge(self, dicdata: dict):
+        for k, v in dicdata.items():
+            if hasattr(self, k):
+                setattr(self, k, v)
+
+    def add_line(self, timestamp, message: str):
+        self.lines.append(LegacyPostfixLog(timestamp=timestamp, queue_id=self.queue_id, message=message))
+
+
+_DOMAINS = ['example.com', 'gmail.com', 'outlook.com', 'privex.io', 'mail.example.org', 'yahoo.co.uk']
+_USERS = ['john', 'jane.doe', 'support', 'no-reply', 'billing_dept', 'x.y.z']
+_STATUSES = [
+    ('sent', '(250 2.0.0 OK  1569921234 a1si123456qkb.12 - gsmtp)'),
+    ('deferred', '(host mx.example.com[1.2.3.4] said: 451 4.7.1 Please try again later (in reply to RCPT TO command))'),
+    ('deferred', '(connect to mx.example.com[1.2.3.4]:25: Connection timed out)'),
+    ('bounced', '(host mx.example.com[1.2.3.4] said: 550 5.1.1 <x@example.com>: Recipient address rejected: '
+                'User unknown in virtual mailbox table (in reply to RCPT TO command))'),
+]
+
+
+def synthetic_messages(count: int, seed: int = 1234) -> List[str]:
+    """
+    Generate ``count`` synthetic Postfix log messages (the part of each log line after the queue ID),
+    covering the smtpd / cleanup / qmgr / smtp / local / removed line formats - including the ``orig_to=<...>``
+    addresses and ``host[ip]:port`` status messages which the original regexes mis-parse (see :func:`.divergence`).
+    """
+    rnd = random.Random(seed)
+
+    def addr():
+        return f'{rnd.choice(_USERS)}@{rnd.choice(_DOMAINS)}'
+
+    def ip():
+        return '.'.join(str(rnd.randint(1, 254)) for _ in range(4))
+
+    out = []
+    while len(out) < count:
+        code, msg = rnd.choice(_STATUSES)
+        out += [
+            f'client=mail{rnd.randint(1, 99)}.{rnd.choice(_DOMAINS)}[{ip()}]',
+            f'message-id=<{rnd.getrandbits(64):x}.{rnd.randint(1, 9999)}@{rnd.choice(_DOMAINS)}>',
+            f'from=<{addr()}>, size={rnd.randint(300, 90000)}, nrcpt=1 (queue active)',
+            f'to=<{addr()}>, relay=mx{rnd.randint(1, 9)}.{rnd.choice(_DOMAINS)}[{ip()}]:25, '
+            f'delay={rnd.random() * 5:.2f}, delays=0.01/0/0.2/0.3, dsn=2.0.0, status={code} {msg}',
+            f'to=<{addr()}>, orig_to=<{addr()}>, relay=local, delay=0.1, delays=0/0/0/0.1, '
+            f'dsn=2.0.0, status=sent (delivered to mailbox)',
+            'removed',
+        ]
+    return out[:count]
+
+
+def _time_parser(func: Callable[[str], dict], lines: List[str], repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for l in lines:
+            func(l)
+        taken = time.perf_counter() - start
+        best = taken if best is None or taken < best else best
+    return best
+
+
+KNOWN_DIVERGENCES = {
+    'orig_to': 'regex took mail_to from orig_to=<...>',
+    'relay_in_status': 'regex ran relay= on to a host[ip]:port in the status',
+}
+"""
+The lines on which :func:`.tokenize_line` intentionally differs from :func:`.regex_parse_line`, as reported by
+:func:`.divergence` - anything else is ``unexpected``
+"""
+
+
+def divergence(line: str, old: dict, new: dict) -> str:
+    """
+    Explain why the original regex parser's result ``old`` differs from :func:`.tokenize_line`'s result ``new`` for
+    the log message ``line``: one of the :attr:`.KNOWN_DIVERGENCES`, or ``unexpected``.
+    """
+    fields = {k for k in set(old) | set(new) if old.get(k) != new.get(k)}
+    if fields == {'mail_to'} and 'orig_to=<' in line:
+        return 'orig_to'
+    if fields == {'relay'} and ']:' in line.partition('status=')[2]:
+        return 'relay_in_status'
+    return 'unexpected'
+
+
+def parser_divergences(lines: List[str]) -> Dict[str, int]:
+    """Count the lines where the regex parser and :func:`.tokenize_line` differ, by :func:`.divergence`"""
+    counts = dict.fromkeys([*KNOWN_DIVERGENCES, 'unexpected'], 0)
+    for l in lines:
+        old, new = regex_parse_line(l), tokenize_line(l)
+        if old != new:
+            counts[divergence(l, old, new)] += 1
+    return counts
+
+
+def bench_parser(count: int = 100000, repeat: int = 3, seed: int = 1234) -> dict:
+    """
+    Compare the throughput of the original regex parser against :func:`.tokenize_line` on a synthetic corpus,
+    after first counting the lines where their output differs (see :func:`.parser_divergences`).
+    """
+    lines = synthetic_messages(count, seed=seed)
+    divergences = parser_divergences(lines)
+    regex_secs = _time_parser(regex_parse_line, lines, repeat)
+    token_secs = _time_parser(tokenize_line, lines, repeat)
+    return dict(
+        lines=len(lines), divergences=divergences,
+        regex_lines_sec=len(lines) / regex_secs, tokenize_lines_sec=len(lines) / token_secs,
+        speedup=regex_secs / token_secs,
+    )
+
+
+def print_parser_bench(res: dict):
+    div = res['divergences']
+    print(f"Parsed {res['lines']} synthetic log messages - outputs differ on {sum(div.values())} lines:")
+    for k, desc in KNOWN_DIVERGENCES.items():
+        print(f"    {desc + ':':<55} {div[k]:>8}")
+    print(f"    {'unexpected differences:':<55} {div['unexpected']:>8}")
+    print(f"    regex parser:       {res['regex_lines_sec']:>12,.0f} lines/sec")
+    print(f"    tokenizing parser:  {res['tokenize_lines_sec']:>12,.0f} lines/sec")
+    print(f"    speedup:            {res['speedup']:>12.2f}x")
+
+
+def _track_messages(path: str, workers: int) -> List[PostfixMessage]:
+    """Every message :func:`.track_logs` finishes for ``path`` (plus those still in-flight at the end), in a stable order"""
+    async def _run():
+        tracker = MessageTracker(idle_timeout=timedelta(minutes=settings.flush_idle_minutes))
+        msgs = [m async for m in track_logs(tracker, [path], workers=workers)]
+        return msgs + list(tracker.messages.values())
+    return sorted(asyncio.run(_run()), key=lambda m: (m.queue_id, m.first_attempt))
+
+
+def bench_workers(path: str, worker_counts: List[int]) -> List[dict]:
+    """
+    Measure the throughput of parsing the log file ``path`` into a :class:`.MessageTracker` with each number of worker
+    processes in ``worker_counts`` (``1`` feeds the tracker line by line), and verify that each produces the same
+    messages as the serial tracker - including messages split by a re-used queue ID, or by being flushed as idle
+    (``split`` counts the queue ID's with more than one message).
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        lines = sum(1 for _ in f)
+    results, serial = [], None
+    for w in worker_counts:
+        start = time.perf_counter()
+        msgs = _track_messages(path, w)
+        taken = time.perf_counter() - start
+        if serial is None and w == 1:
+            serial = msgs
+        results.append(dict(
+            workers=w, secs=taken, lines_sec=lines / taken, mb_sec=size / taken / 1024 / 1024, messages=len(msgs),
+            split=len(msgs) - len({m.queue_id for m in msgs}), identical=None if serial is None else msgs == serial,
+        ))
+    return results
+
+
+def print_workers_bench(results: List[dict]):
+    base = results[0]['secs']
+    print(f"{'workers':>8} {'seconds':>10} {'lines/sec':>14} {'MB/sec':>8} {'speedup':>8} {'messages':>9} {'split':>6} "
+          f"{'identical':>10}")
+    for r in results:
+        print(f"{r['workers']:>8} {r['secs']:>10.2f} {r['lines_sec']:>14,.0f} {r['mb_sec']:>8.2f} "
+              f"{base / r['secs']:>7.2f}x {r['messages']:>9} {r['split']:>6} {str(r['identical']):>10}")
+
+
+def _build_messages(msg_class, lines: List[str]) -> Dict[str, object]:
+    messages = {}
+    for line in lines:
+        m = match.match(line)
+        if not m: continue
+        dtime, qid, msg = m.groups()
+        pm = messages.get(qid)
+        if pm is None:
+            pm = messages[qid] = msg_class(timestamp=dtime, queue_id=qid)
+        pm.merge(tokenize_line(msg))
+        pm.add_line(dtime, msg)
+    return messages
+
+
+def _clear_time_caches():
+    dates.parse_log_time.cache_clear(), dates.parse_log_epoch.cache_clear(), dates.from_epoch.cache_clear()
+
+
+def _measure_messages(msg_class, lines: List[str]) -> dict:
+    # Empty the timestamp caches first, so that neither representation benefits from the other's cached datetimes
+    _clear_time_caches()
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        messages = _build_messages(msg_class, lines)
+        taken = time.perf_counter() - start
+        # Only count the memory held by the messages themselves - not the (fixed size) timestamp caches
+        _clear_time_caches()
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return dict(messages=len(messages), bytes=size, bytes_msg=size / max(1, len(messages)), secs=taken)
+
+
+def bench_memory(path: str) -> dict:
+    """
+    Compare the memory held by the messages of the log file ``path`` when assembled into the original dataclass
+    objects (:class:`.LegacyPostfixMessage`), against the compact ``__slots__`` based :class:`.PostfixMessage`.
+
+    Memory is measured with :mod:`tracemalloc`, and includes the per-message dict which holds the messages, but not
+    the timestamp caches in :mod:`postfixparser.dates`. The result varies with the size and mix of the log - see
+    :class:`.PostfixMessage` - so it's worth checking at a few ``--messages`` sizes, or against a real log (``--log``).
+    """
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    return dict(
+        lines=len(lines), legacy=_measure_messages(LegacyPostfixMessage, lines),
+        compact=_measure_messages(PostfixMessage, lines),
+    )
+
+
+def print_memory_bench(res: dict):
+    legacy, compact = res['legacy'], res['compact']
+    print(f"Assembled {compact['messages']} messages from {res['lines']} log lines")
+    print(f"{'':>22} {'total MB':>10} {'bytes/msg':>10} {'seconds':>8}")
+    for name, r in [('dataclass + PostfixLog', legacy), ('compact (slots)', compact)]:
+        print(f"{name:>22} {r['bytes'] / 1024 / 1024:>10.2f} {r['bytes_msg']:>10,.0f} {r['secs']:>8.2f}")
+    print(f"{'reduction':>22} {legacy['bytes'] / max(1, compact['bytes']):>9.2f}x")
+
+
+def peak_rss_mb() -> float:
+    """The peak resident memory usage of the current process in megabytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+class FakeWriter:
+    """
+    Stands in for RethinkDB in the end-to-end benchmark - it just counts the documents and batches it receives,
+    optionally sleeping for ``latency`` seconds per batch to simulate a round trip.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency, self.docs, self.batches = latency, 0, 0
+
+    async def write(self, batch: List[dict]):
+        self.docs += len(batch)
+        self.batches += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+
+def _read_lines(path: str) -> List[str]:
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.readlines()
+
+
+def _build(lines: List[str]) -> List[PostfixMessage]:
+    tracker, msgs = MessageTracker(), []
+    for l in lines:
+        msgs += tracker.feed(l)
+    return msgs + list(tracker.messages.values())
+
+
+def _stage_parse(path: str) -> Tuple[float, int]:
+    lines = _read_lines(path)
+    start = time.perf_counter()
+    for l in lines:
+        m = match.match(l)
+        if m: tokenize_line(m.group(3))
+    return time.perf_counter() - start, 0
+
+
+def _stage_build(path: str) -> Tuple[float, int]:
+    lines = _read_lines(path)
+    start = time.perf_counter()
+    msgs = _build(lines)
+    return time.perf_counter() - start, len(msgs)
+
+
+def _stage_serialize(path: str) -> Tuple[float, int]:
+    from rethinkdb import r
+    msgs = _build(_read_lines(path))
+    start = time.perf_counter()
+    for m in msgs:
+        m.clean_dict(convert_time=r.expr)
+    return time.perf_counter() - start, len(msgs)
+
+
+async def _legacy_parse_line(mline: str) -> dict:
+    """:func:`postfixparser.parser.parse_line` as it was before the write pipeline - a coroutine per line"""
+    return tokenize_line(mline)
+
+
+def _stage_baseline(path: str, batch_size: int = 500, latency: float = 0.0) -> Tuple[float, int]:
+    """
+    The import loop from before :func:`.write_pipeline` - every line is parsed by awaiting a coroutine, and the
+    messages are only written (one batch at a time) once the whole file has been read
+    """
+    from rethinkdb import r
+
+    async def _run():
+        messages = {}
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                m = match.match(line)
+                if not m: continue
+                dtime, qid, msg = m.groups()
+                if qid not in messages:
+                    messages[qid] = PostfixMessage(timestamp=dtime, queue_id=qid)
+                messages[qid].merge(await _legacy_parse_line(msg))
+                messages[qid].add_line(dtime, msg)
+        writer = FakeWriter(latency=latency)
+        docs = [d for d in (_message_doc(m, convert_time=r.expr)[0] for m in messages.values()) if d is not None]
+        for batch in batched(docs, batch_size):
+            await writer.write(batch)
+        return writer.docs
+
+    start = time.perf_counter()
+    written = asyncio.run(_run())
+    return time.perf_counter() - start, written
+
+
+def _stage_end_to_end(path: str, batch_size: int = 500, latency: float = 0.0) -> Tuple[float, int]:
+    from rethinkdb import r
+
+    async def _run():
+        tracker = MessageTracker(idle_timeout=timedelta(minutes=settings.flush_idle_minutes))
+        writer = FakeWriter(latency=latency)
+        docs = _tracked_docs(track_logs(tracker, [path]), tracker, convert_time=r.expr)
+        async for batch in abatched(docs, batch_size):
+            await writer.write(batch)
+        return writer.docs
+
+    start = time.perf_counter()
+    written = asyncio.run(_run())
+    return time.perf_counter() - start, written
+
+
+def _stage_pipeline(path: str, batch_size: int = 500, latency: float = 0.0) -> Tuple[float, int]:
+    """Like :func:`._stage_end_to_end`, but writing through :func:`.write_pipeline` - as ``manage.py parse`` does"""
+    from rethinkdb import r
+
+    async def _run():
+        tracker = MessageTracker(idle_timeout=timedelta(minutes=settings.flush_idle_minutes))
+        writer = FakeWriter(latency=latency)
+        docs = _tracked_docs(track_logs(tracker, [path]), tracker, convert_time=r.expr)
+        await write_pipeline(docs, writer.write, batch_size, settings.write_concurrency)
+        return writer.docs
+
+    start = time.perf_counter()
+    written = asyncio.run(_run())
+    return time.perf_counter() - start, written
+
+
+STAGES = [
+    ('parse', _stage_parse, 'match + tokenize each line'),
+    ('build', _stage_build, 'assemble PostfixMessage objects'),
+    ('serialize', _stage_serialize, 'clean_dict() every message'),
+    ('baseline', _stage_baseline, 'old loop: await parse_line per line, then write one batch at a time'),
+    ('end-to-end', _stage_end_to_end, 'read file -> DB docs -> fake writer, one batch at a time'),
+    ('pipeline', _stage_pipeline, 'read file -> DB docs -> bounded queue -> concurrent fake writers'),
+]
+"""The stages measured by :func:`.bench_stages` - ``(name, function, description)``"""
+
+WRITE_STAGES = ('baseline', 'end-to-end', 'pipeline')
+"""The :attr:`.STAGES` which write to a :class:`.FakeWriter`, and so are run at each latency"""
+
+
+def _run_stage(func, path: str, kwargs: dict) -> dict:
+    secs, messages = func(path, **kwargs)
+    return dict(secs=secs, messages=messages, peak_rss_mb=peak_rss_mb())
+
+
+def bench_stages(path: str, stages: List[str] = None, batch_size: int = 500, latencies: List[float] = None) -> List[dict]:
+    """
+    Measure the throughput (lines/sec and messages/sec) and peak memory usage of each stage of an import of the log
+    file ``path``. Each stage runs in a new child process, so the peak RSS reported is that of the stage alone (including
+    holding the log file's lines in memory, for every stage except ``end-to-end`` and ``pipeline``).
+
+    The :attr:`.WRITE_STAGES` are run once for each of ``latencies``, and the ``end-to-end`` / ``pipeline`` results
+    include their speedup (``vs_baseline``) over the ``baseline`` stage at the same latency - if it was run.
+
+    :param path:        The log file to import (see :func:`postfixparser.loggen.write_mail_log`)
+    :param stages:      The names of the :attr:`.STAGES` to run (default: all)
+    :param batch_size:  The write stages' batch size
+    :param latencies:   Seconds the write stages' :class:`.FakeWriter` sleeps per batch (default: ``[0.0]``)
+    """
+    with open(path, 'rb') as f:
+        lines = sum(1 for _ in f)
+    results = []
+    for latency in [None] + list(latencies or [0.0]):
+        baseline = None
+        for name, func, desc in STAGES:
+            if (stages is not None and name not in stages) or (latency is None) != (name not in WRITE_STAGES):
+                continue
+            kwargs = {} if latency is None else dict(batch_size=batch_size, latency=latency)
+            with multiprocessing.Pool(1) as pool:
+                res = pool.apply(_run_stage, (func, path, kwargs))
+            if name == 'baseline':
+                baseline = res['secs']
+            results.append(dict(
+                stage=name, description=desc, lines=lines, latency=latency, **res,
+                lines_sec=lines / res['secs'], messages_sec=res['messages'] / res['secs'] if res['messages'] else None,
+                vs_baseline=None if baseline is None or name == 'baseline' else baseline / res['secs'],
+            ))
+    return results
+
+
+def print_stages_bench(results: List[dict]):
+    print(f"{'stage':>12} {'latency':>8} {'seconds':>8} {'lines/sec':>12} {'msgs/sec':>10} {'peak RSS':>10} "
+          f"{'vs baseline':>12}   description")
+    for r in results:
+        msgs_sec = '-' if r['messages_sec'] is None else f"{r['messages_sec']:,.0f}"
+        latency = '-' if r['latency'] is None else f"{r['latency']:.3f}s"
+        gain = '-' if r['vs_baseline'] is None else f"{r['vs_baseline']:.2f}x"
+        print(f"{r['stage']:>12} {latency:>8} {r['secs']:>8.2f} {r['lines_sec']:>12,.0f} {msgs_sec:>10} "
+              f"{r['peak_rss_mb']:>8.1f}MB {gain:>12}   {r['description']}")
+
+
+STORAGE_QUERIES = [
+    ('status.code=bounced', {'status.code': 'bounced'}),
+    ('mail_to=*@gmail.com', {'mail_to': '*@gmail.com'}),
+    ('mail_from=jane*', {'mail_from': 'jane*'}),
+    ('q=user unknown', {'q': 'user unknown'}),
+]
+"""The ``/api/emails`` filters timed by :func:`.bench_storage` - ``(name, filters)``"""
+
+
+async def _storage_conditions(store, filters: dict) -> list:
+    from postfixparser.query import parse_filters
+    from postfixparser.search import search_conditions
+    filters = dict(filters)
+    conds = search_conditions(filters.pop('q')) if 'q' in filters else []
+    conds += parse_filters(filters)
+    # Estimate the conditions the same way as the Web UI, so the planner picks the same indexes
+    for c in conds:
+        if c.op == 'contains':
+            c.estimate = await store.estimate('sent_mail', [c])
+    for f in {c.field for c in conds if c.op in ('ge', 'le')}:
+        bounds = [c for c in conds if c.field == f and c.op in ('ge', 'le')]
+        estimate = await store.estimate('sent_mail', bounds)
+        for c in bounds:
+            c.estimate = estimate
+    return conds
+
+
+async def _bench_store(store, path: str, batch_size: int, page_size: int, repeat: int) -> dict:
+    from postfixparser.storage import OnConflict
+    await store.bootstrap()
+    await store.delete_all('sent_mail')
+    # No idle timeout, so each message is read in full (as one document) before the timed inserts
+    tracker = MessageTracker()
+    docs = [d async for d in _tracked_docs(track_logs(tracker, [path]), tracker, convert_time=store.convert_time)]
+    res = dict(backend=store.name, messages=len(docs), queries=[])
+    for stage in ('insert', 'merge'):
+        start = time.perf_counter()
+        for batch in batched(docs, batch_size):
+            await store.insert('sent_mail', batch, OnConflict.MERGE)
+        res[f'{stage}_secs'] = time.perf_counter() - start
+        res[f'{stage}_msgs_sec'] = len(docs) / res[f'{stage}_secs']
+
+    for name, filters in STORAGE_QUERIES:
+        count_secs, page_secs = [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conds = await _storage_conditions(store, filters)
+            count, exact = await store.count('sent_mail', conds, cap=settings.count_cap)
+            count_secs.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            rows = [row async for row in store.find('sent_mail', conds, order_by='last_attempt', limit=page_size)]
+            page_secs.append(time.perf_counter() - start)
+        res['queries'].append(dict(
+            query=name, count=count, count_exact=exact, rows=len(rows), count_ms=min(count_secs) * 1000,
+            page_ms=min(page_secs) * 1000,
+        ))
+    await store.delete_all('sent_mail')
+    await store.close()
+    return res
+
+
+def bench_storage(path: str, backends: List[str], batch_size: int = 500, page_size: int = 50, repeat: int = 3) -> List[dict]:
+    """
+    Import the messages of the log file ``path`` into each storage backend in ``backends`` (as new messages, then
+    again as continuations merged into the stored ones), and time a count plus the first page of each of the
+    :attr:`.STORAGE_QUERIES`.
+
+    SQLite is benchmarked in a temporary file. The ``rethinkdb`` backend uses the configured ``RETHINK_DB`` - which
+    is **emptied** - so point it at a scratch database. Backends which can't connect are skipped.
+    """
+    import tempfile
+    from postfixparser.storage import BACKENDS, SQLiteStorage
+
+    results = []
+    for backend in backends:
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SQLiteStorage(path=os.path.join(tmp, 'bench.sqlite3')) if backend == 'sqlite' else BACKENDS[backend]()
+            try:
+                results.append(asyncio.run(_bench_store(store, path, batch_size, page_size, repeat)))
+            except Exception as e:
+                results.append(dict(backend=backend, error=f'{type(e).__name__}: {e}'))
+    return results
+
+
+def print_storage_bench(results: List[dict]):
+    for r in results:
+        if 'error' in r:
+            print(f"{r['backend']}: skipped - {r['error']}")
+            continue
+        print(f"{r['backend']}: inserted {r['messages']} messages at {r['insert_msgs_sec']:,.0f} msgs/sec, "
+              f"merged again at {r['merge_msgs_sec']:,.0f} msgs/sec")
+        print(f"    {'query':>22} {'count':>8} {'count ms':>10} {'page ms':>10}")
+        for q in r['queries']:
+            count = f"{q['count']}" + ('' if q['count_exact'] else '+')
+            print(f"    {q['query']:>22} {count:>8} {q['count_ms']:>10.2f} {q['page_ms']:>10.2f}")
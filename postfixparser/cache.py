@@ -0,0 +1,245 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Caches for the Web UI, and the "import generation" which tells them when the data has changed.
+
+The importer runs in a different process to the Web UI, so whenever it writes a batch to the DB it calls
+:func:`.bump_generation`, which increments a counter stored in :attr:`.settings.generation_file`. Cache entries
+remember the generation they were stored under, and are treated as missing once the generation changes.
+
+    >>> counts = TTLCache(maxsize=1000, ttl=60)
+    >>> counts.set(('status.code', 'eq', 'bounced'), 1234, generation=current_generation())
+    >>> counts.get(('status.code', 'eq', 'bounced'), generation=current_generation())
+    1234
+
+"""
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+from postfixparser import settings
+
+log = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    A least-recently-used cache holding at most ``maxsize`` entries, each of which expires ``ttl`` seconds after
+    it was stored, or as soon as the import generation changes.
+
+    :param int maxsize: Maximum number of entries - the least recently used entry is dropped to make room
+    :param float ttl:   Seconds until an entry expires. ``0`` disables the cache (every :meth:`.get` is a miss).
+    """
+
+    def __init__(self, maxsize: int = 1000, ttl: float = 60):
+        self.maxsize, self.ttl = maxsize, ttl
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key: Hashable, generation: int = 0, default: Any = None) -> Any:
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, gen, expires = entry
+            if gen == generation and expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, generation: int = 0):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        self.entries[key] = (value, generation, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class FileCache:
+    """
+    A cache of ``bytes`` values shared between processes (e.g. each hypercorn worker), storing each entry as a file
+    in ``folder`` - ideally on a tmpfs such as ``/dev/shm``, so reads and writes never touch the disk. Entries
+    expire ``ttl`` seconds after they were written, or when the import generation changes.
+
+    :param str folder:  The folder to store entries in - created if it doesn't exist
+    :param int maxsize: Roughly the maximum number of entries - the oldest are removed when there's more than this
+    :param float ttl:   Seconds until an entry expires
+    """
+    prune_every = 64
+    """Expired / excess entries are only removed every this many :meth:`.set` calls, as it lists the whole folder"""
+
+    def __init__(self, folder: str, maxsize: int = 1000, ttl: float = 60):
+        self.folder, self.maxsize, self.ttl = folder, maxsize, ttl
+        self.hits, self.misses = 0, 0
+        self._sets = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, key: Hashable) -> str:
+        return os.path.join(self.folder, hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def get(self, key: Hashable, generation: int = 0, default: Any = None) -> Any:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_mtime + self.ttl > time.time():
+                    # Each entry is the generation it was stored under, a newline, and then the value
+                    gen, _, value = f.read().partition(b'\n')
+                    if int(gen) == generation:
+                        self.hits += 1
+                        return value
+        except (OSError, ValueError):
+            pass
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: bytes, generation: int = 0):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        path = self._path(key)
+        tmp_file = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(str(generation).encode() + b'\n' + value)
+            os.replace(tmp_file, path)
+        except OSError as e:
+            log.warning('Could not write cache file %s (%s: %s)', path, type(e).__name__, str(e))
+        self._sets += 1
+        if self._sets % self.prune_every == 0:
+            self.prune()
+
+    def prune(self):
+        """Remove expired entries, and then the oldest entries while there are more than :attr:`.maxsize`"""
+        now, entries = time.time(), []
+        try:
+            with os.scandir(self.folder) as it:
+                for e in it:
+                    try:
+                        mtime = e.stat().st_mtime
+                    except OSError:
+                        continue
+                    if mtime + self.ttl <= now:
+                        _remove(e.path)
+                    else:
+                        entries.append((mtime, e.path))
+        except OSError:
+            return
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.maxsize, 0)]:
+            _remove(path)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class ResponseCache:
+    """
+    Caches whole API responses (as ``bytes``) - in an in-process :class:`.TTLCache`, and if ``folder`` is given,
+    also in a :class:`.FileCache` shared by every Web UI worker process.
+
+        >>> cache = ResponseCache(maxsize=256, ttl=30, folder='/dev/shm/postfix-parser')
+        >>> body, source = cache.get(key, current_generation())
+        >>> source
+        'miss'
+
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 30, folder: str = None):
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.shared = FileCache(folder, maxsize=maxsize, ttl=ttl) if folder else None
+
+    def get(self, key: Hashable, generation: int = 0) -> Tuple[Optional[bytes], str]:
+        """
+        :return tuple res: ``(value, source)`` - where source is ``memory``, ``shared`` or ``miss``
+                           (in which case value is ``None``)
+        """
+        value = self.local.get(key, generation)
+        if value is not None:
+            return value, 'memory'
+        if self.shared is not None:
+            value = self.shared.get(key, generation)
+            if value is not None:
+                self.local.set(key, value, generation)
+                return value, 'shared'
+        return None, 'miss'
+
+    def set(self, key: Hashable, value: bytes, generation: int = 0):
+        self.local.set(key, value, generation)
+        if self.shared is not None:
+            self.shared.set(key, value, generation)
+
+
+_generation = {'stat': None, 'value': 0}
+
+
+def current_generation(path: str = None) -> int:
+    """
+    Return the import generation last written by :func:`.bump_generation` - or ``0`` if nothing has been imported
+    yet. The file is only re-read when it's modification time / size changes, so this is cheap to call per request.
+    """
+    path = settings.generation_file if path is None else path
+    try:
+        st = os.stat(path)
+    except OSError:
+        return 0
+    stat = (path, st.st_ino, st.st_mtime_ns, st.st_size)
+    if stat != _generation['stat']:
+        try:
+            with open(path, 'r') as f:
+                _generation['value'] = int(f.read().strip() or 0)
+        except (OSError, ValueError) as e:
+            log.warning('Could not read import generation file %s (%s: %s)', path, type(e).__name__, str(e))
+            return _generation['value']
+        _generation['stat'] = stat
+    return _generation['value']
+
+
+def bump_generation(path: str = None) -> Optional[int]:
+    """
+    Increment the import generation, invalidating everything the Web UI has cached. Call this after writing to the DB.
+
+    :return int|None generation: The new generation, or ``None`` if the file couldn't be written
+    """
+    path = settings.generation_file if path is None else path
+    try:
+        with open(path, 'r') as f:
+            gen = int(f.read().strip() or 0) + 1
+    except (OSError, ValueError):
+        # Seed new files from the clock, so a deleted file can't bring back an old generation
+        gen = time.time_ns()
+    tmp_file = f'{path}.tmp'
+    try:
+        with open(tmp_file, 'w') as f:
+            f.write(str(gen))
+        os.replace(tmp_file, path)
+    except OSError as e:
+        log.warning('Could not write import generation file %s (%s: %s)', path, type(e).__name__, str(e))
+        return None
+    return gen
@@ -0,0 +1,119 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Persisted import state, allowing each ``parse`` run to resume reading the mail log from where the previous
+run finished, instead of re-reading the entire file from byte 0.
+
+A :class:`.Checkpoint` records the inode of the log file that was being read, the byte offset of the last
+complete line that was parsed, and any :class:`.PostfixMessage`'s which were still "in-flight" (Postfix hadn't
+logged ``removed`` for them yet), so that lines for the same queue ID in the next run are merged into the
+existing message rather than overwriting it.
+
+"""
+import logging
+import os
+import pickle
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Optional
+
+from privex.helpers import Dictable
+
+from postfixparser.objects import PostfixMessage
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 2
+"""Bump this whenever the structure of :class:`.Checkpoint` (or the objects it holds) changes incompatibly"""
+
+
+@dataclass
+class Checkpoint(Dictable):
+    path: str
+    inode: int = 0
+    offset: int = 0
+    head: bytes = b''
+    """The first few bytes of the log file, used to detect the file being truncated and re-written in place"""
+    messages: Dict[str, PostfixMessage] = field(default_factory=dict)
+    """Messages which haven't been ``removed`` from the Postfix queue yet, keyed by queue ID"""
+    flushed: Dict[str, datetime] = field(default_factory=dict)
+    """Queue ID's of messages which were written early due to being idle (see :class:`.MessageTracker`)"""
+    version: int = CHECKPOINT_VERSION
+
+
+def load_checkpoint(filename: str, logfile: str) -> Checkpoint:
+    """
+    Load the :class:`.Checkpoint` stored at ``filename``. If the file doesn't exist, can't be read, was written
+    by an incompatible version, or belongs to a different log file than ``logfile`` - then a fresh checkpoint
+    starting at byte 0 of ``logfile`` is returned instead.
+    """
+    if not os.path.exists(filename):
+        return Checkpoint(path=logfile)
+    try:
+        with open(filename, 'rb') as f:
+            cp = pickle.load(f)
+    except Exception as e:
+        log.warning('Could not read checkpoint file %s (%s: %s) - starting from scratch', filename, type(e), str(e))
+        return Checkpoint(path=logfile)
+
+    if isinstance(cp, Checkpoint) and cp.version == 1:
+        # Version 1 checkpoints were written before idle messages could be flushed early
+        cp.flushed, cp.version = {}, 2
+    if not isinstance(cp, Checkpoint) or cp.version != CHECKPOINT_VERSION:
+        log.warning('Checkpoint file %s is from an incompatible version - starting from scratch', filename)
+        return Checkpoint(path=logfile)
+    if os.path.abspath(cp.path) != os.path.abspath(logfile):
+        log.warning('Checkpoint file %s is for log %s, not %s - starting from scratch', filename, cp.path, logfile)
+        return Checkpoint(path=logfile)
+    return cp
+
+
+def save_checkpoint(cp: Checkpoint, filename: str):
+    """
+    Atomically write the :class:`.Checkpoint` ``cp`` to ``filename`` - the checkpoint is written to a temporary
+    file first, and then renamed over the original, so a crash mid-write can never leave a corrupt checkpoint.
+    """
+    tmp_file = f'{filename}.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(cp, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, filename)
+
+
+def find_rotated(logfile: str, inode: int) -> Optional[str]:
+    """
+    Search the folder containing ``logfile`` for the file with the inode ``inode`` - i.e. where logrotate
+    moved the log file that we were previously reading (usually ``mail.log.1``).
+
+        >>> find_rotated('/var/log/mail.log', 1234567)
+        '/var/log/mail.log.1'
+
+    :return str|None path: The full path to the rotated log file, or ``None`` if it couldn't be found.
+    """
+    folder, name = os.path.split(os.path.abspath(logfile))
+    try:
+        candidates = sorted(f for f in os.listdir(folder) if f.startswith(name) and f != name)
+    except OSError:
+        return None
+    for c in candidates:
+        path = os.path.join(folder, c)
+        try:
+            if os.stat(path).st_ino == inode:
+                return path
+        except OSError:
+            continue
+    return None
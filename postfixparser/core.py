@@ -15,12 +15,15 @@ Copyright::
     +===================================================+
 
 """
+import asyncio
 import json
 import logging
 import rethinkdb.ast
 import rethinkdb.query
 
-from typing import Tuple, List, Union
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, Deque, Dict, Optional, Tuple, List, Union
 
 from privex.helpers import empty
 from quart import request
@@ -28,9 +31,12 @@ from quart import request
 from werkzeug.exceptions import BadRequest
 from rethinkdb import RethinkDB
 from rethinkdb.ast import DB
+from rethinkdb.errors import ReqlDriverError, ReqlError, ReqlTimeoutError
 from rethinkdb.net import DefaultConnection
 
-from postfixparser import settings
+from postfixparser import metrics, settings
+from postfixparser.exceptions import PoolTimeout
+from postfixparser.query import index_create_args, index_options, index_spec
 from privex.loghelper import LogHelper
 
 from postfixparser.settings import AppError, DEFAULT_ERR, ERRORS
@@ -43,7 +49,206 @@ log = logging.getLogger(__name__)
 __STORE = {}
 
 
-async def get_rethink() -> Tuple[DB, DefaultConnection, RethinkDB]:
+class RethinkPool:
+    """
+    A pool of RethinkDB connections, which can be passed to ``.run()`` in place of a single connection - each query
+    borrows a connection for as long as it takes to start, then returns it to the pool. Cursors keep reading from
+    the connection they started on, as RethinkDB connections can carry many queries at once.
+
+    When a connection is borrowed, it's replaced if it has been closed (e.g. RethinkDB was restarted), and it's
+    pinged first if it has been idle for longer than ``check_interval``. A query whose connection is lost before
+    it returns is re-run once on a fresh connection, so a DB restart doesn't fail every request that follows it.
+
+        >>> pool = RethinkPool(r, min_size=1, max_size=10)
+        >>> await pool.start()
+        >>> await r.db('maildata').table('sent_mail').count().run(pool)
+        1234
+
+    :param RethinkDB r:         The RethinkDB driver object, with the ``asyncio`` loop type set
+    :param int min_size:        Connections to open up-front in :meth:`.start`
+    :param int max_size:        Maximum connections open at once - queries wait for a free one beyond this
+    :param float timeout:       Seconds to wait for a free connection (or to connect) before raising :class:`.PoolTimeout`
+    :param float check_interval: Ping connections which have been idle for longer than this many seconds before use
+    """
+
+    def __init__(self, r: RethinkDB, host: str = None, port: int = None, min_size: int = None, max_size: int = None,
+                 timeout: float = None, check_interval: float = None):
+        self.r = r
+        self.host = settings.rethink_host if host is None else host
+        self.port = settings.rethink_port if port is None else port
+        self.min_size = settings.rethink_pool_min if min_size is None else min_size
+        self.max_size = max(1, settings.rethink_pool_max if max_size is None else max_size)
+        self.timeout = settings.rethink_pool_timeout if timeout is None else timeout
+        self.check_interval = settings.rethink_pool_check_interval if check_interval is None else check_interval
+        # Idle connections with the loop time they were returned at. Most recently used last, and taken from the end,
+        # so a quiet process keeps re-using the same few connections.
+        self._idle: Deque[Tuple[DefaultConnection, float]] = deque()
+        self._size = 0
+        """Connections which are idle, in use, or being opened"""
+        self._waiting = 0
+        self._cond = asyncio.Condition()
+
+    async def start(self):
+        """Open :attr:`.min_size` connections. Failures are only logged, as queries will try to connect again."""
+        conns = []
+        try:
+            for _ in range(self.min_size - self._size):
+                conns.append(await self.acquire())
+        except ReqlDriverError as e:
+            log.warning('Could not open RethinkDB connection pool to %s:%s (%s: %s)', self.host, self.port,
+                        type(e).__name__, str(e))
+        for conn in conns:
+            await self.release(conn)
+
+    async def _connect(self) -> DefaultConnection:
+        try:
+            conn = await asyncio.wait_for(self.r.connect(self.host, self.port), self.timeout)
+        except asyncio.TimeoutError:
+            metrics.DB_POOL_CONNECTS.inc(result='error')
+            raise ReqlDriverError(f'Could not connect to {self.host}:{self.port}. Timed out after {self.timeout}s')
+        except ReqlDriverError:
+            metrics.DB_POOL_CONNECTS.inc(result='error')
+            raise
+        metrics.DB_POOL_CONNECTS.inc(result='ok')
+        return conn
+
+    async def _is_alive(self, conn: DefaultConnection, idle_since: float) -> bool:
+        if not conn.is_open():
+            return False
+        if asyncio.get_event_loop().time() - idle_since < self.check_interval:
+            return True
+        try:
+            await asyncio.wait_for(self.r.expr(1).run(conn), self.timeout)
+            return True
+        except (ReqlError, asyncio.TimeoutError, OSError):
+            return False
+
+    async def acquire(self) -> DefaultConnection:
+        """
+        Borrow a connection - which must be given back with :meth:`.release` - waiting up to :attr:`.timeout`
+        seconds for one to become free. Prefer :meth:`.connection`, or just passing the pool to ``.run()``.
+        """
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        deadline = started + self.timeout
+        while True:
+            async with self._cond:
+                while len(self._idle) == 0 and self._size >= self.max_size:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        metrics.DB_POOL_TIMEOUTS.inc()
+                        raise PoolTimeout(f'No RethinkDB connection became free within {self.timeout}s '
+                                          f'({self._size} connections in use)')
+                    self._waiting += 1
+                    self._update_gauges()
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                    finally:
+                        self._waiting -= 1
+                if len(self._idle) > 0:
+                    conn, idle_since = self._idle.pop()
+                else:
+                    # Reserve a slot for the new connection before giving up the lock
+                    conn, idle_since = None, None
+                    self._size += 1
+                self._update_gauges()
+
+            try:
+                if conn is None:
+                    conn = await self._connect()
+                elif not await self._is_alive(conn, idle_since):
+                    metrics.DB_POOL_CHECK_FAILURES.inc()
+                    log.warning('Pooled RethinkDB connection to %s:%s is dead - replacing it', self.host, self.port)
+                    await self._discard(conn)
+                    continue
+            except BaseException:
+                await self._discard(conn)
+                raise
+            metrics.DB_POOL_ACQUIRE_SECONDS.observe(loop.time() - started)
+            return conn
+
+    async def release(self, conn: DefaultConnection):
+        """Give back a connection borrowed with :meth:`.acquire`. Closed connections are dropped from the pool."""
+        if not conn.is_open():
+            return await self._discard(conn)
+        async with self._cond:
+            self._idle.append((conn, asyncio.get_event_loop().time()))
+            self._cond.notify()
+            self._update_gauges()
+
+    async def _discard(self, conn: Optional[DefaultConnection]):
+        """Close ``conn`` (if given) and free up it's slot in the pool"""
+        if conn is not None:
+            try:
+                await conn.close(noreply_wait=False)
+            except Exception:
+                pass
+        async with self._cond:
+            self._size -= 1
+            self._cond.notify()
+            self._update_gauges()
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncGenerator[DefaultConnection, None]:
+        """
+        Borrow a single connection for several queries, e.g. to read changefeeds
+
+            >>> async with pool.connection() as conn:
+            ...     await r.table('sent_mail').get('ABCD123').run(conn)
+
+        """
+        conn = await self.acquire()
+        try:
+            yield conn
+        finally:
+            await self.release(conn)
+
+    async def _start(self, term, **global_optargs):
+        """Called by ``.run()`` - runs ``term`` on a pooled connection, retrying once if the connection is lost"""
+        for attempt in range(2):
+            conn = await self.acquire()
+            try:
+                return await conn._start(term, **global_optargs)
+            except ReqlDriverError as e:
+                if isinstance(e, ReqlTimeoutError) or conn.is_open() or attempt > 0:
+                    raise
+                metrics.DB_POOL_RETRIES.inc()
+                log.warning('Lost RethinkDB connection while running a query (%s) - retrying on a new connection', str(e))
+            finally:
+                await self.release(conn)
+
+    def is_open(self) -> bool:
+        return True
+
+    async def close(self):
+        """Close every idle connection. Connections in use are closed when they're released."""
+        async with self._cond:
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+            self._update_gauges()
+        for conn, _ in idle:
+            try:
+                await conn.close(noreply_wait=False)
+            except Exception:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        """
+            >>> pool.stats()
+            {'idle': 2, 'in_use': 1, 'waiting': 0, 'max_size': 10}
+        """
+        return dict(idle=len(self._idle), in_use=self._size - len(self._idle), waiting=self._waiting,
+                    max_size=self.max_size)
+
+    def _update_gauges(self):
+        metrics.DB_POOL_CONNECTIONS.set(len(self._idle), state='idle')
+        metrics.DB_POOL_CONNECTIONS.set(self._size - len(self._idle), state='in_use')
+        metrics.DB_POOL_WAITING.set(self._waiting)
+
+
+async def get_rethink() -> Tuple[DB, RethinkPool, RethinkDB]:
     """
 
     Usage:
@@ -53,9 +258,11 @@ async def get_rethink() -> Tuple[DB, DefaultConnection, RethinkDB]:
         >>> r, conn, rDB = await get_rethink()
         >>> r.table('blocks').insert(dict(block_num=1234)).run(conn)
 
+    The connection is a :class:`.RethinkPool`, created on the first call in each process. It doesn't create the
+    database / tables / indexes - that's done once, by :func:`.bootstrap_db` (``manage.py initdb``).
 
     :return DB rethink: (Tuple Param 1) - Main RethinkDB database query object :class:`rethinkdb.RethinkDB`
-    :return DefaultConnection conn: (Tuple Param 2) - Rethink Connection Object :class:`rethinkdb.net.DefaultConnection`
+    :return RethinkPool conn: (Tuple Param 2) - Pool of connections, which can be used like a single connection
     """
     if 'rethink' in __STORE:
         return __STORE['rethink']
@@ -64,30 +271,48 @@ async def get_rethink() -> Tuple[DB, DefaultConnection, RethinkDB]:
     # log.debug('Initialising RethinkDB connector')
     r: rethinkdb.query = RethinkDB()
     r.set_loop_type('asyncio')
-    conn = await r.connect(settings.rethink_host, settings.rethink_port)
-
-    dbs = await r.db_list().run(conn)
-    if settings.rethink_db not in dbs:
-        log.debug('Database %s did not exist. Creating.', settings.rethink_db)
-        await r.db_create(settings.rethink_db).run(conn)
-
-    # Create required tables inside of database
-    db = r.db(settings.rethink_db)   # type: DB
-    rtables = await db.table_list().run(conn)
-    for t, indexes in settings.rethink_tables:
-        if t not in rtables:
-            log.debug('Table %s did not exist. Creating.', t)
-            await db.table_create(t).run(conn)
-        idxs = await db.table(t).index_list().run(conn)
-        for index in indexes:
-            if index not in idxs:
-                log.debug('Index %s on table %s did not exist. Creating.', index, t)
-                await db.table(t).index_create(index).run(conn)
-
-    __STORE['rethink'] = db, conn, r
+    # Stored before opening any connections, so concurrent callers share the same pool
+    pool = RethinkPool(r)
+    __STORE['rethink'] = r.db(settings.rethink_db), pool, r
+    await pool.start()
     return __STORE['rethink']
 
 
+async def bootstrap_db():
+    """
+    Create the database, tables and indexes from :attr:`.settings.rethink_tables` if they don't exist yet. Runs
+    at most once per process, on it's own connection - called by ``manage.py initdb``, and by the importer
+    before it's first write, so the Web UI workers never have to.
+    """
+    if __STORE.get('bootstrapped'):
+        return
+    r: rethinkdb.query = RethinkDB()
+    r.set_loop_type('asyncio')
+    conn = await r.connect(settings.rethink_host, settings.rethink_port)
+    try:
+        dbs = await r.db_list().run(conn)
+        if settings.rethink_db not in dbs:
+            log.debug('Database %s did not exist. Creating.', settings.rethink_db)
+            await r.db_create(settings.rethink_db).run(conn)
+
+        # Create required tables inside of database
+        db = r.db(settings.rethink_db)   # type: DB
+        rtables = await db.table_list().run(conn)
+        for t, indexes in settings.rethink_tables:
+            if t not in rtables:
+                log.debug('Table %s did not exist. Creating.', t)
+                await db.table_create(t).run(conn)
+            idxs = await db.table(t).index_list().run(conn)
+            for index in indexes:
+                name, fields = index_spec(index)
+                if name not in idxs:
+                    log.debug('Index %s on table %s did not exist. Creating.', name, t)
+                    await db.table(t).index_create(*index_create_args(index), **index_options(index)).run(conn)
+    finally:
+        await conn.close(noreply_wait=False)
+    __STORE['bootstrapped'] = True
+
+
 async def extract_json(rq: request) -> Union[list, dict]:
     """
     Extract JSON formatted POST data from a Quart request.
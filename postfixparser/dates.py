@@ -0,0 +1,118 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Fast parsing of the timestamps at the start of each mail.log line.
+
+Supports the traditional syslog format (``Oct  1 12:34:56`` - in :attr:`.settings.log_timezone`, with no year), and
+the RFC3339 format written by rsyslog's ``RSYSLOG_FileFormat`` high precision template
+(``2019-10-01T12:34:56.123456+00:00``). Anything else falls back to :func:`dateutil.parser.parse`.
+
+"""
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from dateutil.parser import parse
+
+from postfixparser.settings import log_timezone
+
+MONTHS = {m: i + 1 for i, m in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])}
+
+FUTURE_TOLERANCE = timedelta(days=1)
+"""How far in the future a year-less syslog timestamp may be, before we assume it's actually from the previous year"""
+
+
+def _localize(dt: datetime) -> datetime:
+    return log_timezone.localize(dt) if dt.tzinfo is None else dt
+
+
+def infer_year(month: int, day: int, hour: int, minute: int, second: int, now: datetime = None) -> datetime:
+    """
+    Syslog timestamps don't include a year, so assume the timestamp is from the current year - unless that would
+    place it in the future (e.g. importing December's logs in January), in which case it must be from the year before.
+
+        >>> infer_year(12, 31, 23, 59, 59, now=datetime(2020, 1, 1, 0, 5))
+        datetime.datetime(2019, 12, 31, 23, 59, 59)
+
+    :return datetime dt: A naive :class:`.datetime` for the inferred year
+    """
+    now = datetime.now(log_timezone).replace(tzinfo=None) if now is None else now
+    year = now.year
+    # Feb 29th only exists in leap years, so keep stepping back a year until the date is valid
+    for _ in range(8):
+        try:
+            dt = datetime(year, month, day, hour, minute, second)
+        except ValueError:
+            year -= 1
+            continue
+        if dt - now > FUTURE_TOLERANCE:
+            year -= 1
+            continue
+        return dt
+    raise ValueError(f'Could not infer a valid year for the date {month}/{day}')
+
+
+def parse_syslog(raw: str) -> datetime:
+    """Parse a traditional syslog timestamp such as ``Oct  1 12:34:56`` into a :attr:`.log_timezone` aware datetime"""
+    mon, day, hms = raw.split()
+    h, m, s = hms.split(':')
+    return log_timezone.localize(infer_year(MONTHS[mon.title()], int(day), int(h), int(m), int(s)))
+
+
+def parse_rfc3339(raw: str) -> datetime:
+    """Parse an RFC3339 timestamp such as ``2019-10-01T12:34:56.123456+00:00`` into a timezone aware datetime"""
+    if raw.endswith('Z'):
+        raw = raw[:-1] + '+00:00'
+    return _localize(datetime.fromisoformat(raw))
+
+
+@lru_cache(maxsize=8192)
+def parse_log_time(raw: str) -> datetime:
+    """
+    Parse the timestamp ``raw`` from the start of a mail.log line into a timezone aware :class:`.datetime`.
+
+    Results are cached by the raw string, since busy mail servers log many lines within the same second.
+    Note that for year-less syslog timestamps, the year is inferred relative to the time the timestamp
+    was *first* parsed.
+
+        >>> parse_log_time('Oct  1 12:34:56')
+        datetime.datetime(2019, 10, 1, 12, 34, 56, tzinfo=<UTC>)
+
+    """
+    try:
+        if raw[:1].isdigit():
+            return parse_rfc3339(raw)
+        return parse_syslog(raw)
+    except (ValueError, KeyError):
+        return _localize(parse(raw))
+
+
+@lru_cache(maxsize=8192)
+def parse_log_epoch(raw: str) -> float:
+    """
+    Same as :func:`.parse_log_time`, but returns the timestamp as UNIX epoch seconds - which is how the lines of a
+    :class:`.PostfixMessage` are stored in memory.
+
+        >>> parse_log_epoch('Oct  1 12:34:56')
+        1569933296.0
+
+    """
+    return parse_log_time(raw).timestamp()
+
+
+@lru_cache(maxsize=8192)
+def from_epoch(ts: float) -> datetime:
+    """Convert the UNIX epoch seconds ``ts`` back into a :attr:`.log_timezone` aware :class:`.datetime`"""
+    return datetime.fromtimestamp(ts, log_timezone)
@@ -0,0 +1,121 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Per-recipient delivery records.
+
+A ``sent_mail`` message only holds the recipient, relay and status of the last ``to=<...>`` line logged for it, so
+the other recipients of a multi-recipient message can't be searched for. The importer also writes a record for each
+recipient of each message into the ``deliveries`` table - the latest delivery attempt to that recipient, linked to
+the message by it's ``queue_id`` - which is indexed by recipient (and the lowercase parts of the address, like
+:func:`.query.address_fields`).
+
+``/api/emails`` filters on ``mail_to`` are looked up in the ``deliveries`` indexes first (see
+:func:`.recipient_conditions`), and the matching queue IDs are then fetched from ``sent_mail``.
+
+    >>> message_deliveries({'id': '5E0F2C06A2', 'lines': [
+    ...     {'timestamp': t, 'message': 'to=<john@example.com>, relay=mx.example.com[1.2.3.4]:25, delay=0.5, '
+    ...                                 'delays=0.1/0/0.2/0.2, dsn=2.0.0, status=sent (250 OK)'},
+    ... ]})
+    [{'id': '5E0F2C06A2/john@example.com', 'queue_id': '5E0F2C06A2', 'recipient': 'john@example.com',
+      'recipient_local': 'john', 'recipient_domain': 'example.com', 'recipient_rdomain': 'moc.elpmaxe',
+      'relay': {'host': 'mx.example.com', 'ip': '1.2.3.4', 'port': '25'}, 'status': {'code': 'sent', ...},
+      'delay': 0.5, 'dsn': '2.0.0', 'timestamp': t}]
+
+"""
+import re
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from postfixparser.parser import tokenize_line
+from postfixparser.query import Condition, split_address
+
+DELIVERIES_TABLE = 'deliveries'
+
+RECIPIENT_FIELDS = {
+    'mail_to': 'recipient', 'mail_to_local': 'recipient_local', 'mail_to_domain': 'recipient_domain',
+    'mail_to_rdomain': 'recipient_rdomain',
+}
+"""Maps the ``sent_mail`` recipient fields (see :func:`.query.address_conditions`) to their ``deliveries`` fields"""
+
+INDEXED_OPS = ('eq', 'le', 'ge')
+"""Condition ops which can be answered from a ``deliveries`` index"""
+
+find_delivery_keys = re.compile(r'(?<![\w-])(?:delay=(?P<delay>[0-9.]+)|dsn=(?P<dsn>[0-9.]+)|relay=(?P<relay>[^\s,\[]+))')
+"""Matches the ``delay=``, ``dsn=`` and ``relay=`` (including ``relay=local`` / ``relay=none``) of a delivery line"""
+
+
+def line_delivery(message: str) -> Optional[dict]:
+    """
+    Parse a single log message into a delivery record (without it's ``id`` / ``queue_id`` / ``timestamp``), or
+    return ``None`` if it isn't a delivery attempt - i.e. it doesn't have both a ``to=<...>`` and a ``status=``.
+
+        >>> line_delivery('to=<john@example.com>, relay=none, delay=3.2, dsn=4.4.1, status=deferred (connect timed out)')
+        {'recipient': 'john@example.com', 'relay': {'host': 'none', 'ip': '', 'port': ''}, 'delay': 3.2,
+         'dsn': '4.4.1', 'status': {'code': 'deferred', 'message': '(connect timed out)'}, ...}
+
+    """
+    lm = tokenize_line(message)
+    if 'mail_to' not in lm or 'status' not in lm:
+        return None
+    d = dict(recipient=lm['mail_to'], relay=lm.get('relay', {}), status=lm['status'], delay=None, dsn='')
+    # Only look before the status, as the status message is free text from the remote server
+    for m in find_delivery_keys.finditer(message, 0, message.find('status=')):
+        if m.lastgroup == 'delay':
+            try:
+                d['delay'] = float(m['delay'])
+            except ValueError:
+                pass
+        elif m.lastgroup == 'dsn':
+            d['dsn'] = m['dsn']
+        elif 'relay' not in lm:
+            d['relay'] = {'host': m['relay'], 'ip': '', 'port': ''}
+    local, domain = split_address(d['recipient'])
+    d.update(recipient_local=local, recipient_domain=domain, recipient_rdomain=domain[::-1])
+    return d
+
+
+def message_deliveries(doc: Mapping) -> List[dict]:
+    """
+    The delivery records for each recipient of the ``sent_mail`` document ``doc``, built from it's log ``lines``.
+    Each record is the last delivery attempt to that recipient within ``doc`` - records written for earlier lines
+    (e.g. a deferral before the message was later delivered) are replaced when they're merged into the table.
+    """
+    latest: Dict[str, dict] = {}
+    for line in doc.get('lines') or []:
+        d = line_delivery(line['message'])
+        if d is not None:
+            latest[d['recipient']] = dict(
+                id=f"{doc['id']}/{d['recipient']}", queue_id=doc['id'], **d, timestamp=line['timestamp']
+            )
+    return list(latest.values())
+
+
+def recipient_conditions(conditions: List[Condition]) -> Optional[Tuple[List[Condition], List[Condition]]]:
+    """
+    Split out the recipient filters from ``sent_mail`` ``conditions``, as conditions on the ``deliveries`` table.
+
+        >>> recipient_conditions(parse_filters({'mail_to': '*@example.com', 'status.code': 'sent'}))
+        ([Condition(field='recipient_domain', op='eq', value='example.com')],
+         [Condition(field='status.code', op='eq', value='sent')])
+
+    :return tuple|None conds: ``(deliveries conditions, remaining sent_mail conditions)``, or ``None`` if there are
+                              no recipient filters which a ``deliveries`` index could answer (e.g. only
+                              ``mail_to=*smith*``), so they should stay on ``sent_mail``
+    """
+    rconds = [c for c in conditions if c.field in RECIPIENT_FIELDS]
+    if not any(c.op in INDEXED_OPS for c in rconds):
+        return None
+    rest = [c for c in conditions if c.field not in RECIPIENT_FIELDS]
+    return [Condition(RECIPIENT_FIELDS[c.field], c.op, c.value, c.estimate) for c in rconds], rest
@@ -1,4 +1,5 @@
 from privex.helpers import PrivexException, empty_if
+from rethinkdb.errors import ReqlDriverError, ReqlTimeoutError
 
 
 class MyAppException(PrivexException):
@@ -51,3 +52,21 @@ class APIException(MyAppException):
         self.template = template
         self.extra = {} if extra is None else extra
 
+
+
+class PoolTimeout(ReqlTimeoutError):
+    """
+    Raised by :class:`postfixparser.core.RethinkPool` when no DB connection became free within
+    :attr:`.settings.rethink_pool_timeout`. It's a :class:`rethinkdb.errors.ReqlTimeoutError`, so the importer
+    retries it like any other transient DB error.
+    """
+    def __init__(self, message: str):
+        # ReqlTimeoutError's own constructor discards the message
+        ReqlDriverError.__init__(self, message)
+
+
+class DatabaseLocked(Exception):
+    """
+    Raised by :class:`postfixparser.storage.sqlite.SQLiteStorage` when the SQLite database stayed locked by another
+    process for longer than :attr:`.settings.sqlite_timeout`. The importer retries it like a transient RethinkDB error.
+    """
@@ -0,0 +1,111 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Skips re-writing messages which haven't changed since they were last imported.
+
+Each ``sent_mail`` document stores the :attr:`.PostfixMessage.fingerprint` of the message it was written from
+(in :attr:`.FINGERPRINT_FIELD`), and the importer keeps a local copy of the fingerprint it last wrote for each
+queue ID in a small SQLite file (:attr:`.settings.fingerprint_cache`), which survives between runs. A message whose
+fingerprint matches the cache - e.g. when ``parse --full`` or ``--glob`` re-reads a log which was already imported -
+isn't serialized or sent to the DB at all.
+
+    >>> fingerprints = open_fingerprints(get_storage())
+    >>> fingerprints.unchanged(msg)
+    False
+    >>> fingerprints.record([{'id': msg.queue_id, 'fingerprint': msg.fingerprint}])
+    >>> fingerprints.unchanged(msg)
+    True
+
+"""
+import logging
+import sqlite3
+import time
+from datetime import timedelta
+from typing import Iterable, Optional
+
+from privex.helpers import empty
+
+from postfixparser import settings
+from postfixparser.objects import PostfixMessage
+from postfixparser.storage import Storage
+
+log = logging.getLogger(__name__)
+
+FINGERPRINT_FIELD = 'fingerprint'
+
+
+class FingerprintCache:
+    """
+    The fingerprint last written for each queue ID, stored in the SQLite database file ``path``.
+
+    The cache only applies to the DB it was filled from (``location`` - see :attr:`.Storage.location`), so it's
+    emptied if the importer is pointed at a different DB. If the DB is emptied or restored from a backup, empty the
+    cache too with ``./manage.py parse --rewrite``.
+    """
+
+    def __init__(self, path: str, location: str):
+        self.path, self.location = path, location
+        self.conn = sqlite3.connect(path, timeout=settings.sqlite_timeout, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS fingerprints '
+                          '(id TEXT PRIMARY KEY NOT NULL, fingerprint TEXT NOT NULL, written REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS fingerprints__written ON fingerprints (written)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY NOT NULL, value TEXT NOT NULL)')
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'location'").fetchone()
+        if row is None or row[0] != location:
+            if row is not None:
+                log.info('Emptying the fingerprint cache %s, as it was filled from a different DB (%s)', path, row[0])
+            self.clear()
+
+    def get(self, queue_id: str) -> Optional[str]:
+        """The fingerprint last written for ``queue_id``, or ``None`` if it's not in the cache"""
+        row = self.conn.execute('SELECT fingerprint FROM fingerprints WHERE id = ?', [queue_id]).fetchone()
+        return None if row is None else row[0]
+
+    def unchanged(self, msg: PostfixMessage) -> bool:
+        """``True`` if ``msg`` is identical to when it was last written"""
+        return self.get(msg.queue_id) == msg.fingerprint
+
+    def record(self, docs: Iterable[dict]):
+        """Remember the fingerprints of the ``sent_mail`` documents ``docs``, once they've been written to the DB"""
+        now = time.time()
+        rows = [(d['id'], d[FINGERPRINT_FIELD], now) for d in docs if FINGERPRINT_FIELD in d]
+        if len(rows) > 0:
+            self.conn.executemany('INSERT OR REPLACE INTO fingerprints (id, fingerprint, written) VALUES (?, ?, ?)', rows)
+
+    def prune(self, max_age: timedelta) -> int:
+        """Forget the fingerprints which were last written more than ``max_age`` ago. Returns how many were removed."""
+        cur = self.conn.execute('DELETE FROM fingerprints WHERE written < ?', [time.time() - max_age.total_seconds()])
+        return cur.rowcount
+
+    def clear(self):
+        """Forget every fingerprint, so the next import writes every message it reads"""
+        self.conn.execute('DELETE FROM fingerprints')
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('location', ?)", [self.location])
+
+    def close(self):
+        self.conn.close()
+
+
+def open_fingerprints(store: Storage) -> Optional[FingerprintCache]:
+    """
+    Open the fingerprint cache at :attr:`.settings.fingerprint_cache` for the storage backend ``store``, or return
+    ``None`` if it's disabled
+    """
+    if empty(settings.fingerprint_cache):
+        return None
+    return FingerprintCache(settings.fingerprint_cache, store.location)
@@ -0,0 +1,205 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Continuously tails the mail log and imports new lines within seconds, as a long running alternative to running
+``manage.py parse`` from cron every minute (see ``manage.py follow``).
+
+"""
+import asyncio
+import logging
+import os
+import signal
+from datetime import timedelta
+from typing import List, Optional
+
+from postfixparser import settings
+from postfixparser.checkpoint import Checkpoint, load_checkpoint, save_checkpoint
+from postfixparser.fingerprints import FingerprintCache, open_fingerprints
+from postfixparser.main import _insert_batch, _tracked_docs, track_incremental
+from postfixparser.metrics import save_metrics
+from postfixparser.storage import OnConflict, get_storage
+from postfixparser.stream import MessageTracker
+
+log = logging.getLogger(__name__)
+
+
+class LogFollower:
+    """
+    Tails ``logfile`` and writes new and updated messages to the DB, as a pipeline of two asyncio tasks:
+
+     - The reader (:meth:`.read_loop`) polls the log file for new lines every ``poll_interval`` seconds (handling
+       rotation and truncation in the same way as ``manage.py parse``), feeds them into a :class:`.MessageTracker`,
+       and puts the finished and updated messages onto a bounded queue.
+     - The writer (:meth:`.write_loop`) takes messages off the queue and inserts them in batches of at most
+       ``batch_size``, writing a partial batch once it's ``flush_interval`` seconds old.
+
+    The queue is bounded, so if the DB falls behind (or is down), the reader pauses rather than buffering the log
+    in memory. The checkpoint is only saved once every queued message has been written, so after a crash or
+    a failed write, the follower resumes from the last point where everything before it was safely stored.
+
+        >>> follower = LogFollower('/var/log/mail.log', load_checkpoint('.mail_log_checkpoint', '/var/log/mail.log'))
+        >>> asyncio.ensure_future(follower.run())
+        >>> follower.stop()    # Finishes writing, saves the checkpoint, and returns from run()
+
+    """
+
+    def __init__(self, logfile: str, cp: Checkpoint, checkpoint_file: str = None, batch_size: int = None,
+                 poll_interval: float = None, flush_interval: float = None, checkpoint_interval: float = None,
+                 fingerprints: FingerprintCache = None):
+        self.logfile, self.cp, self.fingerprints = logfile, cp, fingerprints
+        self.checkpoint_file = settings.checkpoint_file if checkpoint_file is None else checkpoint_file
+        self.batch_size = settings.write_batch_size if batch_size is None else batch_size
+        self.poll_interval = settings.follow_poll_interval if poll_interval is None else poll_interval
+        self.flush_interval = settings.follow_flush_interval if flush_interval is None else flush_interval
+        self.checkpoint_interval = settings.follow_checkpoint_interval if checkpoint_interval is None else checkpoint_interval
+
+        self.tracker = MessageTracker(cp.messages, cp.flushed, idle_timeout=timedelta(minutes=settings.flush_idle_minutes))
+        # Must be constructed inside of the running event loop, since (on older Pythons) these bind to the current loop
+        self.queue = asyncio.Queue(maxsize=self.batch_size * 4)
+        self.stopping = asyncio.Event()
+        self.failed = False
+        """Set to ``True`` if a batch was given up on during shutdown, so the checkpoint must not be advanced"""
+        self.written = 0
+
+    def stop(self):
+        """Ask the follower to finish writing any queued messages, save the checkpoint, and exit"""
+        log.info('Stopping - finishing writes and saving the checkpoint...')
+        self.stopping.set()
+
+    async def _sleep(self, secs: float) -> bool:
+        """Sleep for ``secs`` seconds, or until :meth:`.stop` is called. Returns ``True`` if stopping."""
+        try:
+            await asyncio.wait_for(self.stopping.wait(), secs)
+        except asyncio.TimeoutError:
+            pass
+        return self.stopping.is_set()
+
+    async def run(self):
+        """Follow the log file until :meth:`.stop` is called"""
+        log.info('Following log file %s from byte %d (%d messages in-flight)',
+                 self.logfile, self.cp.offset, len(self.tracker.messages))
+        writer = asyncio.ensure_future(self.write_loop())
+        try:
+            await self.read_loop()
+        finally:
+            await self.queue.put(None)
+            await writer
+        self.save_checkpoint()
+        log.info('Stopped following %s at byte %d. %d messages written.', self.logfile, self.cp.offset, self.written)
+
+    async def read_loop(self):
+        store = get_storage()
+        loop = asyncio.get_event_loop()
+        last_checkpoint, saved_position = loop.time(), (self.cp.inode, self.cp.offset)
+        while not self.stopping.is_set():
+            try:
+                st = os.stat(self.logfile)
+            except FileNotFoundError:
+                # logrotate has moved the log, but syslog hasn't created the new one yet
+                st = None
+            if st is not None and (st.st_ino != self.cp.inode or st.st_size != self.cp.offset):
+                msgs = track_incremental(self.tracker, self.logfile, self.cp, stop=self.stopping.is_set)
+                try:
+                    docs = _tracked_docs(msgs, self.tracker, convert_time=store.convert_time, fingerprints=self.fingerprints)
+                    async for doc in docs:
+                        await self.queue.put(doc)
+                except FileNotFoundError as e:
+                    log.warning('Log file went missing while reading it (%s) - will try again shortly', str(e))
+
+            position = (self.cp.inode, self.cp.offset)
+            if position != saved_position and loop.time() - last_checkpoint >= self.checkpoint_interval:
+                # Wait for the writer to catch up, so the checkpoint never skips past a message that wasn't stored
+                await self.queue.join()
+                self.save_checkpoint()
+                last_checkpoint, saved_position = loop.time(), position
+            await self._sleep(self.poll_interval)
+
+    async def write_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch: List[Optional[dict]] = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(0.0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+            docs = [d for d in batch if d is not None]
+            if len(docs) > 0:
+                await self.write_batch(docs)
+            for _ in batch:
+                self.queue.task_done()
+            if batch[-1] is None:
+                return
+
+    async def write_batch(self, docs: List[dict]):
+        """
+        Insert ``docs``, retrying for as long as it takes (pausing the reader via the bounded queue) - unless
+        the follower is stopping, in which case the batch is given up on, and the checkpoint won't be advanced.
+        """
+        delay, retried = settings.write_retry_delay, False
+        while True:
+            try:
+                await _insert_batch('sent_mail', docs, OnConflict.MERGE, settings.write_retries, rollup=True,
+                                    fingerprints=self.fingerprints, deliveries=True, retried=retried)
+                self.written += len(docs)
+                return
+            except Exception:
+                log.exception('Error while writing a batch of %d messages. Retrying in %.1f seconds.', len(docs), delay)
+            # The failed attempt may have been applied before the error, so the retry can't count it's rollups
+            retried = True
+            if await self._sleep(delay):
+                log.error('Giving up on writing %d messages due to shutdown. They will be re-read on the next start.',
+                          len(docs))
+                self.failed = True
+                return
+            delay = min(delay * 2, 60.0)
+
+    def save_checkpoint(self):
+        if self.failed:
+            log.warning('Not saving the checkpoint, as some messages could not be written to the DB')
+            return
+        pruned = self.tracker.prune(timedelta(hours=settings.checkpoint_max_age))
+        self.cp.messages, self.cp.flushed = dict(self.tracker.messages), self.tracker.flushed
+        save_checkpoint(self.cp, self.checkpoint_file)
+        self.tracker.record_metrics()
+        save_metrics()
+        log.info('Saved checkpoint - read up to byte %d, %d messages written, %d in-flight (%d expired)',
+                 self.cp.offset, self.written, len(self.cp.messages), pruned)
+
+
+async def follow(full: bool = False):
+    """
+    Follow :attr:`.settings.mail_log` until the process receives SIGTERM or SIGINT, resuming from (and updating)
+    the same checkpoint as ``manage.py parse`` - so don't run both at the same time.
+
+    :param bool full: If ``True``, discard the existing checkpoint and import the whole log file before following it
+    """
+    store = get_storage()
+    await store.bootstrap()
+    logfile = settings.mail_log
+    cp = Checkpoint(path=logfile) if full else load_checkpoint(settings.checkpoint_file, logfile)
+    fingerprints = open_fingerprints(store)
+    follower = LogFollower(logfile, cp, fingerprints=fingerprints)
+    loop = asyncio.get_event_loop()
+    for sig in [signal.SIGTERM, signal.SIGINT]:
+        loop.add_signal_handler(sig, follower.stop)
+    try:
+        await follower.run()
+    finally:
+        if fingerprints is not None:
+            fingerprints.prune(timedelta(days=settings.fingerprint_cache_days))
+            fingerprints.close()
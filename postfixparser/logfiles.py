@@ -0,0 +1,98 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Helpers for reading a set of rotated (and possibly compressed) mail logs, e.g. ``mail.log``, ``mail.log.1``,
+``mail.log.2.gz`` ... in chronological order, without decompressing them to disk.
+
+"""
+import bz2
+import glob
+import gzip
+import logging
+import lzma
+import os
+import re
+from typing import List, TextIO, Tuple
+
+log = logging.getLogger(__name__)
+
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', gzip.open),
+    (b'\xfd7zXZ\x00', lzma.open),
+    (b'BZh', bz2.open),
+]
+"""A list of ``(magic_bytes, open_func)`` used to detect and open compressed log files"""
+
+COMPRESSION_EXTS = ['.gz', '.xz', '.lzma', '.bz2']
+
+_find_num = re.compile(r'\.([0-9]+)$')
+"""Matches numbered logrotate suffixes, e.g. ``mail.log.3``"""
+_find_date = re.compile(r'-([0-9]{8,10})$')
+"""Matches logrotate ``dateext`` suffixes, e.g. ``mail.log-20191001``"""
+
+
+def open_log(path: str) -> TextIO:
+    """
+    Open the log file ``path`` for reading in text mode. Files compressed with gzip, xz/lzma or bzip2 are detected
+    by their magic bytes, and are decompressed on the fly while reading.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+    for m, opener in COMPRESSION_MAGIC:
+        if magic.startswith(m):
+            return opener(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, 'r', encoding='utf-8', errors='replace')
+
+
+def _rotation_key(path: str) -> Tuple[int, str, int, float]:
+    name = os.path.basename(path)
+    for ext in COMPRESSION_EXTS:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    mtime = os.path.getmtime(path)
+    num, date = _find_num.search(name), _find_date.search(name)
+    if num is not None:
+        # mail.log.1 is newer than mail.log.2, so higher numbers need to sort first
+        return 0, '', -int(num.group(1)), mtime
+    if date is not None:
+        return 0, date.group(1), 0, mtime
+    # The un-suffixed, currently active log file is always the newest
+    return 1, '', 0, mtime
+
+
+def sort_logs(paths: List[str]) -> List[str]:
+    """
+    Sort a list of rotated log file paths into chronological order (oldest first), based on their logrotate
+    suffix, falling back to the file modification time.
+
+        >>> sort_logs(['/var/log/mail.log', '/var/log/mail.log.1', '/var/log/mail.log.3.gz', '/var/log/mail.log.2.gz'])
+        ['/var/log/mail.log.3.gz', '/var/log/mail.log.2.gz', '/var/log/mail.log.1', '/var/log/mail.log']
+
+    """
+    return sorted(paths, key=_rotation_key)
+
+
+def find_logs(pattern: str) -> List[str]:
+    """Expand the glob ``pattern`` (e.g. ``/var/log/mail.log*``) into a chronologically sorted list of log files"""
+    return sort_logs([p for p in glob.glob(pattern) if os.path.isfile(p)])
+
+
+def is_compressed(path: str) -> bool:
+    """Returns ``True`` if the file ``path`` starts with the magic bytes of a supported compression format"""
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+    return any(magic.startswith(m) for m, _ in COMPRESSION_MAGIC)
@@ -0,0 +1,204 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+A seeded generator for realistic Postfix mail logs, used by the benchmarks in :mod:`postfixparser.benchmark`.
+
+Each generated email goes through the same lines a real Postfix server logs - ``smtpd`` connect / ``client=``,
+``cleanup`` ``message-id=``, ``qmgr`` ``from=``, one ``smtp`` delivery line per recipient, and ``qmgr`` ``removed``.
+A configurable share of deliveries are deferred (and retried minutes later by ``qmgr`` / ``smtp``), or bounced (with
+``bounce`` logging a non-delivery notification, which is itself delivered as a new message). Emails arrive at a
+configurable rate, so the lines of many emails are interleaved - and deferred emails interleave with emails
+received long after them. Like a real server, queue ID's can optionally be re-used once their email was removed.
+
+"""
+import heapq
+import random
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+_DOMAINS = ['example.com', 'gmail.com', 'outlook.com', 'privex.io', 'mail.example.org', 'yahoo.co.uk']
+_USERS = ['john', 'jane.doe', 'support', 'no-reply', 'billing_dept', 'x.y.z', 'info', 'admin']
+_SENT = '(250 2.0.0 OK  {ts} a1si{n}qkb.12 - gsmtp)'
+_DEFERRED = [
+    '(host {mx}[{ip}] said: 451 4.7.1 Please try again later (in reply to RCPT TO command))',
+    '(connect to {mx}[{ip}]:25: Connection timed out)',
+    '(host {mx}[{ip}] said: 421 4.7.0 Try again later, closing connection. (in reply to end of DATA command))',
+]
+_BOUNCED = [
+    '(host {mx}[{ip}] said: 550 5.1.1 <{to}>: Recipient address rejected: User unknown in virtual mailbox table '
+    '(in reply to RCPT TO command))',
+    '(host {mx}[{ip}] said: 552 5.2.2 <{to}>: Mailbox full (in reply to RCPT TO command))',
+]
+
+Event = Tuple[datetime, int, str]
+"""A log line to be written at a given time - ``(timestamp, sequence, line)``. The sequence keeps ties in order."""
+
+
+class MailLogGenerator:
+    """
+    Generates the log lines for a stream of emails. Use :func:`.write_mail_log` to write them to a file.
+
+        >>> gen = MailLogGenerator(seed=1234, defer_rate=0.1, bounce_rate=0.02)
+        >>> for line in gen.lines(1000):
+        ...     print(line)
+        Oct  1 00:00:00 mx1 postfix/smtpd[1234]: connect from mail12.outlook.com[1.2.3.4]
+        ...
+
+    :param int seed:           Random seed - the same seed (and parameters) always generates the same log
+    :param float rate:         The average number of emails received per second. Higher rates mean more emails
+                               are in-flight at once, so more of their lines are interleaved.
+    :param float defer_rate:   The probability that each delivery attempt is deferred
+    :param float bounce_rate:  The probability that a delivery attempt bounces (checked before ``defer_rate``)
+    :param int max_retries:    Deferred deliveries are bounced after this many retries
+    :param int retry_minutes:  Deferred deliveries are retried 5 to this many minutes later - more than
+                               :attr:`.settings.flush_idle_minutes` makes the importer flush them as idle in between
+    :param float reuse_rate:   The probability that a received email re-uses the queue ID of a removed one
+    :param datetime start:     The timestamp of the first line
+    """
+
+    def __init__(self, seed: int = 1234, rate: float = 20.0, defer_rate: float = 0.1, bounce_rate: float = 0.02,
+                 max_retries: int = 3, retry_minutes: int = 30, reuse_rate: float = 0.0,
+                 start: datetime = datetime(2019, 10, 1)):
+        self.rnd = random.Random(seed)
+        self.rate, self.defer_rate, self.bounce_rate, self.max_retries = rate, defer_rate, bounce_rate, max_retries
+        self.retry_minutes, self.reuse_rate = max(5, retry_minutes), reuse_rate
+        self.now = start
+        self._events: List[Event] = []
+        self._seq = 0
+        self._qids = set()
+        self._removed: List[Tuple[datetime, str]] = []
+        """A heap of the queue ID's which can be re-used, and when they were removed"""
+
+    def _qid(self) -> str:
+        while True:
+            qid = f'{self.rnd.getrandbits(40):010X}'
+            if qid not in self._qids:
+                self._qids.add(qid)
+                return qid
+
+    def _received_qid(self, ts: datetime) -> str:
+        """A queue ID for an email received at ``ts`` - the longest removed one if it's re-used (see ``reuse_rate``)"""
+        if self.reuse_rate > 0 and len(self._removed) > 0 and self._removed[0][0] < ts and \
+                self.rnd.random() < self.reuse_rate:
+            return heapq.heappop(self._removed)[1]
+        return self._qid()
+
+    def _addr(self) -> str:
+        return f'{self.rnd.choice(_USERS)}@{self.rnd.choice(_DOMAINS)}'
+
+    def _ip(self) -> str:
+        return '.'.join(str(self.rnd.randint(1, 254)) for _ in range(4))
+
+    def _pid(self) -> int:
+        return self.rnd.randint(1000, 32000)
+
+    def _emit(self, ts: datetime, prog: str, text: str):
+        self._seq += 1
+        heapq.heappush(self._events, (ts, self._seq, f"{ts.strftime('%b %e %H:%M:%S')} mx1 postfix/{prog}[{self._pid()}]: {text}"))
+
+    def _after(self, ts: datetime, lo_ms: int, hi_ms: int) -> datetime:
+        return ts + timedelta(milliseconds=self.rnd.randint(lo_ms, hi_ms))
+
+    def _deliver(self, ts: datetime, qid: str, mail_from: str, size: int, rcpts: List[str], attempt: int = 0):
+        """Log a delivery attempt to each of ``rcpts`` at ``ts``, scheduling retries for any that are deferred"""
+        rnd, deferred = self.rnd, []
+        for to in rcpts:
+            ts = self._after(ts, 50, 1500)
+            mx, ip = f'mx{rnd.randint(1, 9)}.{to.split("@")[1]}', self._ip()
+            roll = rnd.random()
+            if roll < self.bounce_rate or (roll < self.bounce_rate + self.defer_rate and attempt >= self.max_retries):
+                code, dsn, reason = 'bounced', '5.1.1', rnd.choice(_BOUNCED).format(mx=mx, ip=ip, to=to)
+            elif roll < self.bounce_rate + self.defer_rate:
+                code, dsn, reason = 'deferred', '4.7.1', rnd.choice(_DEFERRED).format(mx=mx, ip=ip)
+                deferred.append(to)
+            else:
+                code, dsn, reason = 'sent', '2.0.0', _SENT.format(ts=int(ts.timestamp()), n=rnd.randint(1000, 999999))
+            self._emit(ts, 'smtp', f'{qid}: to=<{to}>, relay={mx}[{ip}]:25, delay={rnd.random() * 5:.2f}, '
+                                   f'delays=0.01/0/0.2/0.3, dsn={dsn}, status={code} {reason}')
+            if code == 'bounced' and mail_from != '':
+                ts = self._bounce(self._after(ts, 1, 50), qid, mail_from)
+
+        if len(deferred) > 0:
+            retry = ts + timedelta(minutes=rnd.randint(5, self.retry_minutes))
+            self._emit(retry, 'qmgr', f'{qid}: from=<{mail_from}>, size={size}, nrcpt={len(rcpts)} (queue active)')
+            self._deliver(retry, qid, mail_from, size, deferred, attempt + 1)
+        else:
+            removed = self._after(ts, 1, 100)
+            self._emit(removed, 'qmgr', f'{qid}: removed')
+            if self.reuse_rate > 0:
+                heapq.heappush(self._removed, (removed, qid))
+
+    def _bounce(self, ts: datetime, qid: str, mail_from: str) -> datetime:
+        """
+        Log the non-delivery notification for ``qid``, which is delivered to ``mail_from`` as a new message.
+
+        :return datetime ts: The time of the ``bounce`` line - any further lines for ``qid`` must come after it
+        """
+        ndr = self._qid()
+        self._emit(ts, 'cleanup', f'{ndr}: message-id=<{ts.strftime("%Y%m%d%H%M%S")}.{ndr}@mx1.privex.io>')
+        self._emit(ts, 'bounce', f'{qid}: sender non-delivery notification: {ndr}')
+        bounced_at, ts = ts, self._after(ts, 1, 50)
+        size = self.rnd.randint(2000, 8000)
+        self._emit(ts, 'qmgr', f'{ndr}: from=<>, size={size}, nrcpt=1 (queue active)')
+        self._deliver(ts, ndr, '', size, [mail_from], attempt=self.max_retries)
+        return bounced_at
+
+    def _receive(self, ts: datetime):
+        """Log an email being received over SMTP at ``ts``, and it's first delivery attempt"""
+        rnd, qid = self.rnd, self._received_qid(ts)
+        host, ip = f'mail{rnd.randint(1, 99)}.{rnd.choice(_DOMAINS)}', self._ip()
+        mail_from, size = self._addr(), rnd.randint(300, 90000)
+        rcpts = [self._addr() for _ in range(rnd.choice([1, 1, 1, 1, 2, 3]))]
+
+        self._emit(ts, 'smtpd', f'connect from {host}[{ip}]')
+        ts = self._after(ts, 10, 300)
+        self._emit(ts, 'smtpd', f'{qid}: client={host}[{ip}]')
+        ts = self._after(ts, 10, 300)
+        self._emit(ts, 'cleanup', f'{qid}: message-id=<{rnd.getrandbits(64):x}.{rnd.randint(1, 9999)}@{rnd.choice(_DOMAINS)}>')
+        ts = self._after(ts, 1, 50)
+        self._emit(ts, 'qmgr', f'{qid}: from=<{mail_from}>, size={size}, nrcpt={len(rcpts)} (queue active)')
+        self._emit(self._after(ts, 1, 50), 'smtpd',
+                   f'disconnect from {host}[{ip}] ehlo=1 mail=1 rcpt={len(rcpts)} data=1 quit=1 commands={4 + len(rcpts)}')
+        self._deliver(ts, qid, mail_from, size, rcpts)
+
+    def lines(self, messages: int):
+        """Generate the log lines for ``messages`` received emails (plus any bounce notifications), in time order"""
+        for _ in range(messages):
+            self.now += timedelta(seconds=self.rnd.expovariate(self.rate))
+            # Everything logged before this email arrived can be written out
+            while len(self._events) > 0 and self._events[0][0] <= self.now:
+                yield heapq.heappop(self._events)[2]
+            self._receive(self.now)
+        while len(self._events) > 0:
+            yield heapq.heappop(self._events)[2]
+
+
+def write_mail_log(path: str, messages: int, seed: int = 1234, **kwargs) -> int:
+    """
+    Write a realistic mail.log containing ``messages`` received emails to ``path``. Any extra keyword arguments are
+    passed to :class:`.MailLogGenerator`.
+
+        >>> write_mail_log('/tmp/mail.log', 10000, defer_rate=0.2)
+        78311
+
+    :return int lines: The number of lines written
+    """
+    written = 0
+    with open(path, 'w') as f:
+        for line in MailLogGenerator(seed=seed, **kwargs).lines(messages):
+            f.write(line + '\n')
+            written += 1
+    return written
@@ -17,43 +17,45 @@ Copyright::
 """
 import asyncio
 import logging
-import re
-import rethinkdb.query
-from enum import Enum
-from typing import Dict
+import os
+import time
+from datetime import timedelta
+from itertools import islice
+from time import perf_counter
+from typing import (
+    Dict, Iterable, BinaryIO, Generator, List, Optional, Tuple, Union, AsyncIterable, AsyncGenerator, Awaitable,
+    Callable
+)
 from postfixparser import settings
-from postfixparser.core import get_rethink
-from postfixparser.objects import PostfixLog, PostfixMessage
-from postfixparser.parser import parse_line
+from postfixparser.cache import bump_generation
+from postfixparser.checkpoint import Checkpoint, find_rotated, load_checkpoint, save_checkpoint
+from postfixparser.deliveries import DELIVERIES_TABLE, message_deliveries
+from postfixparser.fingerprints import FINGERPRINT_FIELD, FingerprintCache, open_fingerprints
+from postfixparser.logfiles import find_logs, open_log, is_compressed
+from postfixparser.metrics import (
+    DELIVERY_ERRORS, MESSAGES, ROLLUP_ERRORS, STAGE_SECONDS, WRITE_BATCH_SIZE, WRITE_ERRORS, WRITE_RETRIES, save_metrics
+)
+from postfixparser.objects import PostfixMessage
+from postfixparser.parallel import iter_range_results
+from postfixparser.query import address_fields
+from postfixparser.search import TOKENS_FIELD, message_tokens
+from postfixparser.stats import STATS_TABLE, rollup_deltas
+from postfixparser.storage import OnConflict, get_storage
+from postfixparser.stream import MessageTracker
 
 log = logging.getLogger(__name__)
 
 
-_match = r'([A-Za-z]+[ \t]+[0-9]+[ \t]+[0-9]+\:[0-9]+:[0-9]+).*'
-"""(0) Regex to match the Date/Time at the start of each log line"""
-
-_match += r'([A-F0-9]{10})\:[ \t]+?(.*)'
-"""Regex to match the (1) Queue ID and the (2) Log Message"""
-
-match = re.compile(_match)
-
-
 class ObjectExists(BaseException):
     pass
 
 
-class OnConflict(Enum):
-    QUIET = "quiet"
-    EXCEPT = "except"
-    UPDATE = "update"
-
-
 async def save_obj(table, data, primary=None, onconflict: OnConflict = OnConflict.EXCEPT):
-    r, conn, _ = await get_rethink()
+    store = get_storage()
     _data = dict(data)
     if primary is not None:
         if 'id' not in _data: _data['id'] = _data[primary]
-        g = await r.table(table).get(data[primary]).run(conn)
+        g = await store.get(table, data[primary])
 
         if g is not None:
             if onconflict == OnConflict.QUIET:
@@ -61,54 +63,554 @@ async def save_obj(table, data, primary=None, onconflict: OnConflict = OnConflic
             if onconflict == OnConflict.EXCEPT:
                 raise ObjectExists(f"Table '{table}' entry with '{primary} = {data[primary]}' already exists!")
             if onconflict == OnConflict.UPDATE:
-                return await r.table(table).get(data[primary]).update(_data).run(conn)
+                return await store.insert(table, [_data], OnConflict.UPDATE)
             raise AttributeError("'saveobj' onconflict must be either 'quiet', 'except', or 'update'")
-    return await r.table(table).insert(_data).run(conn)
+    return await store.insert(table, [_data], OnConflict.EXCEPT)
 
 
-async def import_log(logfile: str) -> Dict[str, PostfixMessage]:
-    log.info('Opening log file %s', logfile)
-    messages = {}
-    with open(logfile, 'r') as f:
-        while True:
-            line = f.readline()
-            if not line: break
+def read_lines(f: BinaryIO, cp: Checkpoint = None, stop: Callable[[], bool] = None) -> Generator[str, None, None]:
+    """
+    Iterate over the complete lines of the binary file ``f`` from it's current position, decoding them as UTF-8.
+
+    If a :class:`.Checkpoint` is passed, then ``cp.offset`` is advanced past each line after it has been consumed.
+    A trailing line without a newline (i.e. Postfix / syslog is still writing it) is not yielded, so that it
+    can be read in full by the next run.
+
+    If ``stop`` is passed, it's called before reading each line, and reading ends early once it returns ``True``.
+    """
+    for raw in f:
+        if not raw.endswith(b'\n') or (stop is not None and stop()):
+            break
+        if cp is not None:
+            cp.offset += len(raw)
+        yield raw.decode('utf-8', errors='replace')
+
+
+def batched(data: Iterable, size: int) -> Generator[list, None, None]:
+    """Split the iterable ``data`` into lists of at most ``size`` items"""
+    it = iter(data)
+    while True:
+        batch = list(islice(it, size))
+        if len(batch) == 0: return
+        yield batch
 
-            m = match.match(line)
-            if not m: continue
 
-            dtime, qid, msg = m.groups()
-            if qid not in messages:
-                messages[qid] = PostfixMessage(timestamp=dtime, queue_id=qid)
+async def abatched(data: Union[Iterable, AsyncIterable], size: int) -> AsyncGenerator[list, None]:
+    """Split the iterable or async iterable ``data`` into lists of at most ``size`` items"""
+    if not hasattr(data, '__aiter__'):
+        for batch in batched(data, size):
+            yield batch
+        return
+    batch = []
+    async for d in data:
+        batch.append(d)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
 
-            messages[qid].merge(await parse_line(msg))
-            messages[qid].lines.append(PostfixLog(timestamp=dtime, queue_id=qid, message=msg))
 
-    log.info('Finished parsing log file %s', logfile)
-    return messages
+READER_YIELD_EVERY = 50
+"""The reader task of :func:`.write_pipeline` lets the writer tasks run after producing this many documents"""
 
 
-async def main():
-    r, conn, r_q = await get_rethink()
-    r_q: rethinkdb.query
+async def _aiter(data: Union[Iterable, AsyncIterable]) -> AsyncGenerator:
+    if hasattr(data, '__aiter__'):
+        async for d in data:
+            yield d
+    else:
+        for d in data:
+            yield d
+
+
+async def write_pipeline(data: Union[Iterable[dict], AsyncIterable[dict]], write: Callable[[List[dict]], Awaitable[dict]],
+                         batch_size: int, concurrency: int, queue_size: int = None) -> List[dict]:
+    """
+    Pass the documents from ``data`` to ``write`` in batches of at most ``batch_size``, as a pipeline of asyncio tasks:
+
+     - A reader task pulls documents from ``data`` - i.e. reads and parses the log, which is plain synchronous
+       code - and puts each full batch onto a queue holding at most ``queue_size`` batches. Every
+       :attr:`.READER_YIELD_EVERY` documents it lets the other tasks run, so batches are sent to the DB (and their
+       replies handled) while the rest of the log is still being parsed.
+     - ``concurrency`` writer tasks take batches off the queue and ``await write(batch)``.
+
+    As the queue is bounded, the reader pauses whenever the DB falls behind, rather than buffering the log in memory.
+    If ``write`` raises, the other tasks are cancelled and the exception is re-raised.
+
+        >>> results = await write_pipeline(docs, lambda batch: store.insert('sent_mail', batch), 500, 4)
+
+    :return list results: What ``write`` returned for each batch, in the order they finished
+    """
+    queue = asyncio.Queue(maxsize=max(1, settings.write_queue_size if queue_size is None else queue_size))
+    results = []
+
+    async def _reader():
+        batch, n = [], 0
+        async for doc in _aiter(data):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                await queue.put(batch)
+                batch = []
+            n += 1
+            if n % READER_YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+        if len(batch) > 0:
+            await queue.put(batch)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def _writer():
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                return
+            results.append(await write(batch))
+
+    tasks = [asyncio.ensure_future(_reader())] + [asyncio.ensure_future(_writer()) for _ in range(max(1, concurrency))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return results
 
-    log.info('Importing log file')
-    msgs = await import_log(settings.mail_log)
-    log.info('Converting log data into list')
-    msg_list = [{"id": qid, **msg.clean_dict(convert_time=r_q.expr)} for qid, msg in msgs.items()]
-    log.info('Total of %d message entries', len(msg_list))
-    log.info('Generating async batch save list')
-    save_list = []
-    for m in msg_list:
+
+async def _insert_batch(table: str, batch: List[dict], conflict: OnConflict, retries: int, rollup: bool = False,
+                        fingerprints: FingerprintCache = None, deliveries: bool = False, retried: bool = False) -> dict:
+    """
+    Insert ``batch`` into ``table``, retrying transient errors (see :attr:`.Storage.transient_errors`). If ``rollup``
+    is ``True`` (and :attr:`.settings.stats_rollups` is enabled), the changed messages are also counted into the
+    stats rollups. If ``deliveries`` is ``True``, the per-recipient delivery records of the messages are written too.
+    Once the whole batch is written, it's fingerprints are saved into ``fingerprints`` (if given).
+
+    The rollups are counted from the changes reported by the insert, so if the batch is retried after an error which
+    happened once the DB had already applied it, those messages are missed. This is logged (and counted in
+    :attr:`.metrics.ROLLUP_ERRORS`) - the rollups can be recounted with ``./manage.py rebuild_stats``. Callers which
+    retry a failed batch themselves (e.g. :meth:`.LogFollower.write_batch`) must pass ``retried=True`` when they do.
+    """
+    store = get_storage()
+    rollup = rollup and settings.stats_rollups
+    attempt = 0
+    WRITE_BATCH_SIZE.observe(len(batch))
+    while True:
         try:
-            mfrom, mto = m.get('mail_from'), m.get('mail_to')
-            mfrom_dom, mto_dom = mfrom.split('@')[1], mto.split('@')[1]
-            if mfrom_dom in settings.ignore_domains or mto_dom in settings.ignore_domains:
-                continue
-            save_list.append(save_obj('sent_mail', m, primary="id", onconflict=OnConflict.UPDATE))
-        except Exception:
-            log.exception('Error while parsing email %s', m)
-    log.info('Firing off asyncio.gather(save_list)...')
-    await asyncio.gather(*save_list)
-    log.info('Finished!')
+            start = perf_counter()
+            res = await store.insert(table, batch, conflict, return_changes=rollup)
+            STAGE_SECONDS.observe(perf_counter() - start, stage='write')
+            break
+        except store.transient_errors as e:
+            attempt += 1
+            if attempt > retries:
+                raise e
+            WRITE_RETRIES.inc()
+            delay = settings.write_retry_delay * (2 ** (attempt - 1))
+            log.warning('Transient error while inserting batch of %d into %s (%s: %s). Retrying in %.1f seconds (attempt %d of %d)',
+                        len(batch), table, type(e).__name__, str(e), delay, attempt, retries)
+            await asyncio.sleep(delay)
+    if rollup:
+        if attempt > 0 or retried:
+            ROLLUP_ERRORS.inc()
+            log.error('The batch of %d messages was retried, so the stats rollups may not include those of them which '
+                      'were written before the error. Run "./manage.py rebuild_stats" to recount them.', len(batch))
+        await _save_rollups(res.pop('changes', []))
+    saved_deliveries = await _save_deliveries(batch, retries) if deliveries else True
+    WRITE_ERRORS.inc(res.get('errors', 0))
+    if res.get('inserted', 0) + res.get('replaced', 0) > 0:
+        # Let the Web UI know that it's cached responses / counts are out of date
+        bump_generation()
+    if res.get('errors', 0) > 0 and conflict == OnConflict.QUIET:
+        return res
+    if res.get('errors', 0) > 0 and conflict == OnConflict.EXCEPT:
+        raise ObjectExists(f"Error inserting batch into table '{table}': {res.get('first_error')}")
+    if res.get('errors', 0) > 0:
+        log.error('%d errors while inserting batch of %d into %s. First error: %s',
+                  res['errors'], len(batch), table, res.get('first_error'))
+    elif fingerprints is not None and saved_deliveries:
+        fingerprints.record(batch)
+    return res
+
+
+async def _save_rollups(changes: List[dict]):
+    """
+    Apply the ``changes`` of a ``sent_mail`` insert to the stats rollups (see :mod:`postfixparser.stats`).
+
+    The messages themselves have already been written by this point, so a failure here isn't retried by
+    the caller - it's logged, and the rollups can be recounted with ``./manage.py rebuild_stats``. The rollup
+    insert itself isn't retried either, as the counts are added to the stored ones, so re-applying a batch
+    which the DB had already applied before the error would count it twice.
+    """
+    deltas = rollup_deltas(changes)
+    if len(deltas) == 0:
+        return
+    start = perf_counter()
+    try:
+        await _insert_batch(STATS_TABLE, list(deltas.values()), OnConflict.MERGE, retries=0)
+    except Exception as e:
+        ROLLUP_ERRORS.inc()
+        log.error('Could not update the stats rollups for %d changed messages (%s: %s). Run "./manage.py rebuild_stats" '
+                  'to recount them.', len(changes), type(e).__name__, str(e))
+    STAGE_SECONDS.observe(perf_counter() - start, stage='rollup')
+
+
+async def _save_deliveries(batch: List[dict], retries: int) -> bool:
+    """
+    Write the per-recipient delivery records of the ``sent_mail`` documents ``batch`` (see
+    :mod:`postfixparser.deliveries`), keeping the latest attempt for each recipient.
+
+    Like :func:`._save_rollups`, a failure here is logged rather than raised, as the messages have already been
+    written - the records can be rebuilt with ``./manage.py reindex``.
+
+    :return bool saved: ``True`` if every record was written
+    """
+    records = [d for m in batch for d in message_deliveries(m)]
+    if len(records) == 0:
+        return True
+    start = perf_counter()
+    try:
+        res = await _insert_batch(DELIVERIES_TABLE, records, OnConflict.MERGE, retries)
+        saved = res.get('errors', 0) == 0
+    except Exception as e:
+        log.error('Could not write the delivery records for %d messages (%s: %s). Run "./manage.py reindex" to '
+                  'rebuild them.', len(batch), type(e).__name__, str(e))
+        saved = False
+    if not saved:
+        DELIVERY_ERRORS.inc()
+    STAGE_SECONDS.observe(perf_counter() - start, stage='deliveries')
+    return saved
+
+
+async def save_many(table: str, data: Union[Iterable[dict], AsyncIterable[dict]], conflict: OnConflict = OnConflict.UPDATE,
+                    batch_size: int = None, concurrency: int = None, retries: int = None,
+                    rollup: bool = False, fingerprints: FingerprintCache = None,
+                    deliveries: bool = False) -> Dict[str, int]:
+    """
+    Bulk insert the documents in ``data`` into ``table``, in chunked :meth:`.Storage.insert` batches, with at most
+    ``concurrency`` batches in-flight at once - while ``data`` is still being read (see :func:`.write_pipeline`).
+    Batches which fail with a transient error (see :attr:`.Storage.transient_errors`) are retried with exponential
+    backoff.
+
+        >>> res = await save_many('sent_mail', [dict(id='ABCD1234', mail_to='john@example.com'), ...])
+        >>> res['inserted'], res['replaced']
+        (1, 0)
+
+    :param str table:         The name of the table to insert into
+    :param data:              An iterable or async iterable (list / generator etc.) of documents to insert.
+                              Each must contain an ``id``.
+    :param OnConflict conflict: What to do if a document with the same ``id`` already exists - e.g.
+                              :attr:`.OnConflict.MERGE` to merge newly imported lines into a stored message
+    :param int batch_size:    Maximum documents per batch (default: :attr:`.settings.write_batch_size`)
+    :param int concurrency:   Maximum batches being written at once (default: :attr:`.settings.write_concurrency`)
+    :param int retries:       Maximum retries per batch (default: :attr:`.settings.write_retries`)
+    :param bool rollup:       Count the changed messages into the stats rollups (see :func:`._insert_batch`)
+    :param FingerprintCache fingerprints: Save the fingerprints of the written messages into this cache
+    :param bool deliveries:   Also write the per-recipient delivery records of each ``sent_mail`` message
+    :return dict totals:      The summed ``inserted``, ``replaced``, ``unchanged`` and ``errors`` of every batch
+    """
+    batch_size = settings.write_batch_size if batch_size is None else batch_size
+    concurrency = settings.write_concurrency if concurrency is None else concurrency
+    retries = settings.write_retries if retries is None else retries
+    totals = dict(inserted=0, replaced=0, unchanged=0, errors=0, batches=0)
+
+    def _write(batch: List[dict]) -> Awaitable[dict]:
+        return _insert_batch(table, batch, conflict, retries, rollup=rollup, fingerprints=fingerprints,
+                             deliveries=deliveries)
+
+    for res in await write_pipeline(data, _write, batch_size, concurrency):
+        totals['batches'] += 1
+        for k in ['inserted', 'replaced', 'unchanged', 'errors']:
+            totals[k] += res.get(k, 0)
+    return totals
+
+
+def sample_reads(lines: Iterable[str], every: int = None) -> Generator[str, None, None]:
+    """
+    Pass through each line from ``lines``, recording how long every ``every``-th line (default:
+    :attr:`.settings.metrics_sample_every`) took to read in the ``read`` stage metrics.
+    """
+    it, every, n = iter(lines), max(1, settings.metrics_sample_every if every is None else every), 0
+    while True:
+        n += 1
+        if n == every:
+            n, start = 0, perf_counter()
+            line = next(it, None)
+            STAGE_SECONDS.observe(perf_counter() - start, stage='read')
+        else:
+            line = next(it, None)
+        if line is None:
+            return
+        yield line
+
+
+async def track_file(tracker: MessageTracker, path: str, workers: int = 1, start: int = 0,
+                     cp: Checkpoint = None, stop: Callable[[], bool] = None) -> AsyncGenerator[PostfixMessage, None]:
+    """
+    Feed the log file ``path`` (from byte ``start``) into ``tracker``, yielding each message as soon as it's finished.
 
+    If a :class:`.Checkpoint` is passed, only complete lines are read, and ``cp.offset`` is advanced as they're consumed.
+    Reading then ends early (leaving ``cp.offset`` at the next unread line) once ``stop()`` returns ``True``.
+    If ``workers`` is more than 1 and the file isn't compressed, it's parsed in parallel using that many processes.
+    """
+    if workers > 1 and not is_compressed(path):
+        async for segments, stats, end in iter_range_results(path, workers, start=start, idle_timeout=tracker.idle_timeout):
+            for msg in tracker.add_partials(segments, stats):
+                yield msg
+            if cp is not None:
+                cp.offset = end
+        return
+
+    if start == 0 and cp is None:
+        with open_log(path) as f:
+            for line in sample_reads(f):
+                for msg in tracker.feed(line):
+                    yield msg
+        return
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = read_lines(f, cp, stop) if cp is not None else (l.decode('utf-8', errors='replace') for l in f)
+        for line in sample_reads(lines):
+            for msg in tracker.feed(line):
+                yield msg
+
+
+async def track_logs(tracker: MessageTracker, logfiles: List[str], workers: int = 1) -> AsyncGenerator[PostfixMessage, None]:
+    """Feed each log file in ``logfiles`` into ``tracker`` in order, yielding each message as soon as it's finished"""
+    for logfile in logfiles:
+        log.info('Opening log file %s', logfile)
+        async for msg in track_file(tracker, logfile, workers=workers):
+            yield msg
+        log.info('Finished parsing log file %s - %d messages in-flight', logfile, len(tracker.messages))
+
+
+async def track_incremental(tracker: MessageTracker, logfile: str, cp: Checkpoint, workers: int = 1,
+                            stop: Callable[[], bool] = None) -> AsyncGenerator[PostfixMessage, None]:
+    """
+    Feed only the lines of ``logfile`` which were written since the :class:`.Checkpoint` ``cp`` was saved into
+    ``tracker``, yielding each message as soon as it's finished. ``cp.offset`` / ``cp.inode`` are updated in-place.
+
+    If the log file was rotated since the last run, the remainder of the rotated file (e.g. ``mail.log.1``) is
+    read first. If it was truncated / re-written in place, it's re-read from the start.
+
+    If ``stop`` is passed, reading of ``logfile`` ends early once ``stop()`` returns ``True`` (see :func:`.read_lines`).
+    """
+    with open(logfile, 'rb') as f:
+        st = os.fstat(f.fileno())
+        head = f.read(len(cp.head)) if len(cp.head) > 0 else b''
+        f.seek(0)
+        new_head = f.read(64)
+    rotated = None
+    if cp.inode not in [0, st.st_ino]:
+        rotated = find_rotated(logfile, cp.inode)
+        if rotated is None:
+            log.warning('Log file %s was rotated, but the old log could not be found. Some lines may be missed.', logfile)
+    elif st.st_size < cp.offset or head != cp.head:
+        log.warning('Log file %s was truncated or replaced since the last run. Reading from the start.', logfile)
+        cp.offset = 0
+
+    if rotated is not None:
+        log.info('Log file %s was rotated - reading remainder of %s from byte %d', logfile, rotated, cp.offset)
+        async for msg in track_file(tracker, rotated, start=cp.offset):
+            yield msg
+    if cp.inode != st.st_ino:
+        cp.offset = 0
+    cp.inode, cp.head = st.st_ino, new_head
+
+    log.debug('Reading log file %s from byte %d', logfile, cp.offset)
+    async for msg in track_file(tracker, logfile, workers=workers, start=cp.offset, cp=cp, stop=stop):
+        yield msg
+
+
+def _is_ignored(m: dict) -> bool:
+    mfrom, mto = m.get('mail_from', ''), m.get('mail_to', '')
+    if '@' not in mfrom or '@' not in mto:
+        # Rejected, or not yet delivered (it will be saved once the delivery is logged)
+        log.debug('Skipping message %s as it does not have both a sender and recipient', m.get('id'))
+        MESSAGES.inc(result='incomplete')
+        return True
+    mfrom_dom, mto_dom = mfrom.split('@')[1], mto.split('@')[1]
+    if mfrom_dom in settings.ignore_domains or mto_dom in settings.ignore_domains:
+        MESSAGES.inc(result='ignored')
+        return True
+    return False
+
+
+def derived_fields(m: dict) -> dict:
+    """
+    Fields computed from the ``sent_mail`` document ``m`` when it's imported, so they can be indexed - the full-text
+    search :attr:`.search.TOKENS_FIELD`, and the parts of each address (:func:`.query.address_fields`).
+    Run ``./manage.py reindex`` after changing these.
+    """
+    return {TOKENS_FIELD: message_tokens(m), **address_fields(m)}
+
+
+def _serialize(msg: PostfixMessage, convert_time) -> dict:
+    start = perf_counter()
+    m = {"id": msg.queue_id, **msg.clean_dict(convert_time=convert_time), FINGERPRINT_FIELD: msg.fingerprint}
+    m.update(derived_fields(m))
+    STAGE_SECONDS.observe(perf_counter() - start, stage='serialize')
+    return m
+
+
+def _message_doc(msg: PostfixMessage, convert_time,
+                 fingerprints: FingerprintCache = None) -> Tuple[Optional[dict], bool]:
+    """
+    Serialize ``msg`` into a ``sent_mail`` document, unless it's incomplete / ignored, or hasn't changed since it was
+    last written (according to ``fingerprints``).
+
+    :return tuple res: ``(document, stored)`` - the document is ``None`` if ``msg`` shouldn't be written, and
+                       ``stored`` is ``True`` if ``msg`` is (or already was) in the DB
+    """
+    if fingerprints is not None and fingerprints.unchanged(msg):
+        MESSAGES.inc(result='unchanged')
+        return None, True
+    m = _serialize(msg, convert_time)
+    try:
+        if _is_ignored(m):
+            return None, False
+    except Exception:
+        log.exception('Error while parsing email %s', m)
+        MESSAGES.inc(result='error')
+        return None, False
+    MESSAGES.inc(result='saved')
+    return m, True
+
+
+def _tracked_doc(msg: PostfixMessage, tracker: MessageTracker, convert_time,
+                 fingerprints: FingerprintCache = None) -> Tuple[Optional[dict], bool]:
+    """Like :func:`._message_doc`, but continuations (see :meth:`.MessageTracker.is_continuation`) are always written"""
+    # Continuations don't hold the addresses of their original message, so they can't be checked for ignored domains.
+    # They're also always written, since re-writing the start of a message drops the stored lines after it.
+    if tracker.is_continuation(msg.queue_id):
+        MESSAGES.inc(result='saved')
+        return _serialize(msg, convert_time), True
+    return _message_doc(msg, convert_time, fingerprints)
+
+
+async def _tracked_docs(msgs: AsyncIterable[PostfixMessage], tracker: MessageTracker, convert_time,
+                        fingerprints: FingerprintCache = None) -> AsyncGenerator[dict, None]:
+    async for msg in msgs:
+        m, stored = _tracked_doc(msg, tracker, convert_time, fingerprints)
+        if m is not None:
+            yield m
+        tracker.written(msg, stored)
+    # Messages which are still in the Postfix queue are saved in their current state
+    for msg in tracker.drain_touched():
+        m, _ = _tracked_doc(msg, tracker, convert_time, fingerprints)
+        if m is not None:
+            yield m
+
+
+async def save_stream(msgs: AsyncIterable[PostfixMessage], tracker: MessageTracker,
+                      fingerprints: FingerprintCache = None) -> Dict[str, int]:
+    """
+    Write each message from ``msgs`` to the DB as soon as it's yielded, followed by the messages still in-flight
+    in ``tracker`` once ``msgs`` is exhausted. Messages which haven't changed since they were last written
+    (according to ``fingerprints``) are skipped.
+    """
+    store = get_storage()
+
+    log.info('Streaming messages to the DB in batches of %d (max %d batches in-flight)',
+             settings.write_batch_size, settings.write_concurrency)
+    docs = _tracked_docs(msgs, tracker, convert_time=store.convert_time, fingerprints=fingerprints)
+    res = await save_many('sent_mail', docs, conflict=OnConflict.MERGE, rollup=True, fingerprints=fingerprints,
+                          deliveries=True)
+    log.info('Saved messages in %d batches: %d inserted, %d replaced, %d unchanged, %d errors',
+             res['batches'], res['inserted'], res['replaced'], res['unchanged'], res['errors'])
+    return res
+
+
+async def reindex(batch_size: int = None) -> Dict[str, int]:
+    """
+    Recompute the :func:`.derived_fields` of every message already in ``sent_mail`` (e.g. the search tokens of
+    messages imported before full-text search existed), writing them back in batches - then rebuild the
+    per-recipient ``deliveries`` records from each message's log lines.
+    """
+    async def _docs():
+        async for m in get_storage().scan('sent_mail', fields=('id', 'mail_to', 'mail_from', 'status', 'lines')):
+            yield {'id': m['id'], **derived_fields(m)}
+
+    async def _deliveries():
+        async for m in get_storage().scan('sent_mail', fields=('id', 'lines')):
+            for d in message_deliveries(m):
+                yield d
+
+    res = await save_many('sent_mail', _docs(), conflict=OnConflict.UPDATE, batch_size=batch_size)
+    log.info('Re-indexed %d messages in %d batches (%d errors)', res['replaced'] + res['unchanged'], res['batches'],
+             res['errors'])
+    dres = await save_many(DELIVERIES_TABLE, _deliveries(), conflict=OnConflict.MERGE, batch_size=batch_size)
+    log.info('Rebuilt %d delivery records in %d batches (%d errors)', dres['inserted'] + dres['replaced'] + dres['unchanged'],
+             dres['batches'], dres['errors'])
+    return res
+
+
+def record_run(tracker: MessageTracker, started: float):
+    """Log a summary of the import run which began at ``started`` (a :func:`time.time`), and save it's metrics"""
+    taken = max(time.time() - started, 0.000001)
+    lines, unmatched = tracker.lines_read, tracker.lines_unmatched
+    log.info('Read %d lines in %.2f seconds (%.0f lines/sec). %d lines (%.1f%%) did not match the log line format.',
+             lines, taken, lines / taken, unmatched, 100 * unmatched / max(lines, 1))
+    tracker.record_metrics()
+    save_metrics(started=started)
+
+
+async def main(full: bool = False, pattern: str = None, workers: int = 1, rewrite: bool = False):
+    """
+    Import any new lines from :attr:`.settings.mail_log` into the DB, resuming from the checkpoint saved by
+    the previous run.
+
+    Messages are written to the DB as soon as they're finished (see :class:`.MessageTracker`), so memory usage
+    depends on the number of messages in-flight, rather than the size of the log. Messages which are identical to
+    when they were last written are skipped (see :mod:`postfixparser.fingerprints`).
+
+    :param bool full: If ``True``, discard the existing checkpoint and re-import the whole log file
+    :param str pattern: Instead of :attr:`.settings.mail_log`, import every (rotated / compressed) log file matching
+                        this glob pattern, e.g. ``/var/log/mail.log*``. The checkpoint is neither used nor updated.
+    :param int workers: Parse uncompressed logs in parallel using this many processes
+    :param bool rewrite: If ``True``, empty the fingerprint cache first, so every message read is written again
+    """
+    started = time.time()
+    store = get_storage()
+    await store.bootstrap()
+    fingerprints = open_fingerprints(store)
+    if fingerprints is not None and rewrite:
+        log.info('Emptying the fingerprint cache %s - every message read will be written', fingerprints.path)
+        fingerprints.clear()
+    try:
+        await _import(started, full, pattern, workers, fingerprints)
+    finally:
+        if fingerprints is not None:
+            pruned = fingerprints.prune(timedelta(days=settings.fingerprint_cache_days))
+            log.debug('Pruned %d expired entries from the fingerprint cache', pruned)
+            fingerprints.close()
+
+
+async def _import(started: float, full: bool, pattern: Optional[str], workers: int,
+                  fingerprints: Optional[FingerprintCache]):
+    idle_timeout = timedelta(minutes=settings.flush_idle_minutes)
+    if pattern is not None:
+        logfiles = find_logs(pattern)
+        if len(logfiles) == 0:
+            log.error('No log files found matching the pattern %s', pattern)
+            return
+        log.info('Importing %d log files: %s', len(logfiles), ', '.join(logfiles))
+        tracker = MessageTracker(idle_timeout=idle_timeout)
+        await save_stream(track_logs(tracker, logfiles, workers=workers), tracker, fingerprints)
+        record_run(tracker, started)
+        log.info('Finished!')
+        return
+
+    log.info('Importing log file %s', settings.mail_log)
+    cp = Checkpoint(path=settings.mail_log) if full else load_checkpoint(settings.checkpoint_file, settings.mail_log)
+    tracker = MessageTracker(cp.messages, cp.flushed, idle_timeout=idle_timeout)
+    await save_stream(track_incremental(tracker, settings.mail_log, cp, workers=workers), tracker, fingerprints)
+
+    pruned = tracker.prune(timedelta(hours=settings.checkpoint_max_age))
+    cp.messages, cp.flushed = dict(tracker.messages), tracker.flushed
+    log.info('Saving checkpoint to %s - read up to byte %d, %d messages carried over to the next run (%d expired)',
+             settings.checkpoint_file, cp.offset, len(cp.messages), pruned)
+    save_checkpoint(cp, settings.checkpoint_file)
+    record_run(tracker, started)
+    log.info('Finished!')
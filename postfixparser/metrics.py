@@ -0,0 +1,306 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Lightweight counters, gauges and histograms, rendered in the Prometheus text exposition format.
+
+The importer (``manage.py parse`` / ``follow``) records it's metrics into :attr:`.IMPORT`, and adds them into the
+JSON file :attr:`.settings.metrics_file` at the end of each run (see :func:`.save_metrics`) - so counters keep
+increasing across runs, like Prometheus expects. The Web UI serves those alongside it's own request metrics
+(:attr:`.WEB`) at ``/metrics``.
+
+    >>> LINES_READ.inc()
+    >>> STAGE_SECONDS.observe(0.0012, stage='write')
+    >>> print(IMPORT.render())
+    # HELP postfix_import_lines_total Log lines read
+    # TYPE postfix_import_lines_total counter
+    postfix_import_lines_total 1
+    ...
+
+"""
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from postfixparser import settings
+
+log = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+
+def _fmt(v: float) -> str:
+    if v == float('inf'):
+        return '+Inf'
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+def _escape(v: str) -> str:
+    """Escape a label value for the Prometheus text format - backslash, double quote and newline"""
+    return v.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _label_str(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values: Dict[LabelValues, object] = {}
+
+    def _key(self, labels: dict) -> LabelValues:
+        return tuple(str(labels[l]) for l in self.labels)
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        """Yield ``(name_suffix, label_string, value)`` for each sample of this metric"""
+        for k, v in sorted(self.values.items()):
+            yield '', _label_str(self.labels, k), v
+
+    def render(self) -> List[str]:
+        out = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, lbl, v in self.samples():
+            out.append(f'{self.name}{suffix}{lbl} {_fmt(v)}')
+        return out
+
+    def dump(self) -> list:
+        return [[list(k), v] for k, v in self.values.items()]
+
+    def merge(self, values: list):
+        """Combine the dumped ``values`` of the same metric (e.g. from a previous run) into this one"""
+        for k, v in values:
+            self.values[tuple(k)] = self.values.get(tuple(k), 0) + v
+
+    def reset(self):
+        self.values = {}
+
+    def empty_copy(self) -> "Metric":
+        """Return a new, empty metric with the same name, help text and labels"""
+        return type(self)(self.name, self.help, self.labels)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        k = self._key(labels) if labels else ()
+        self.values[k] = self.values.get(k, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels) if labels else ()] = value
+
+    def merge(self, values: list):
+        # Gauges hold the latest value - so only take the other values where we haven't set our own
+        for k, v in values:
+            self.values.setdefault(tuple(k), v)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = None):
+        super().__init__(name, help, labels)
+        self.buckets = list(buckets or [.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, 10]) + [float('inf')]
+
+    def empty_copy(self) -> "Histogram":
+        return Histogram(self.name, self.help, self.labels, self.buckets[:-1])
+
+    def observe(self, value: float, **labels):
+        k = self._key(labels) if labels else ()
+        v = self.values.get(k)
+        if v is None:
+            # Per-bucket (non-cumulative) counts, followed by the sum of all observations
+            v = self.values[k] = [0] * len(self.buckets) + [0.0]
+        v[bisect_left(self.buckets, value)] += 1
+        v[-1] += value
+
+    def samples(self):
+        for k, v in sorted(self.values.items()):
+            total = 0
+            for b, c in zip(self.buckets, v):
+                total += c
+                yield '_bucket', _label_str(self.labels, k, f'le="{_fmt(b)}"'), total
+            yield '_sum', _label_str(self.labels, k), v[-1]
+            yield '_count', _label_str(self.labels, k), total
+
+    def merge(self, values: list):
+        for k, v in values:
+            if len(v) != len(self.buckets) + 1:
+                continue    # Saved by a version with different buckets, so it can't be combined
+            cur = self.values.get(tuple(k))
+            self.values[tuple(k)] = list(v) if cur is None else [a + b for a, b in zip(cur, v)]
+
+
+class Registry:
+    """A named collection of metrics, which can be rendered for Prometheus, or dumped to / merged from JSON"""
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def _add(self, metric: Metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = None) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        return '\n'.join(line for m in self.metrics.values() for line in m.render()) + '\n'
+
+    def dump(self) -> dict:
+        return {name: m.dump() for name, m in self.metrics.items()}
+
+    def merge(self, data: dict):
+        for name, values in data.items():
+            if name in self.metrics:
+                self.metrics[name].merge(values)
+
+    def reset(self):
+        for m in self.metrics.values():
+            m.reset()
+
+
+IMPORT = Registry()
+"""Metrics recorded by the importer, which are persisted to :attr:`.settings.metrics_file`"""
+WEB = Registry()
+"""Metrics recorded by the Web UI process, including it's DB connection pool (not persisted)"""
+
+LINES_READ = IMPORT.counter('postfix_import_lines_total', 'Log lines read')
+LINES_UNMATCHED = IMPORT.counter(
+    'postfix_import_lines_unmatched_total', 'Log lines which did not match the Postfix queue ID line format'
+)
+MESSAGES = IMPORT.counter(
+    'postfix_import_messages_total', 'Messages handed to the DB writer, or skipped (by reason)', ['result']
+)
+STAGE_SECONDS = IMPORT.histogram(
+    'postfix_import_stage_seconds', 'Time taken per item by each import stage (read/match/parse are sampled per line, '
+                                    'serialize is per message, write / rollup are per batch)', ['stage'],
+    buckets=[.000001, .000005, .00001, .00005, .0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, 10, 30]
+)
+WRITE_BATCH_SIZE = IMPORT.histogram(
+    'postfix_import_write_batch_size', 'Number of documents per DB insert batch',
+    buckets=[1, 5, 10, 50, 100, 250, 500, 1000, 2500, 5000]
+)
+WRITE_RETRIES = IMPORT.counter('postfix_import_write_retries_total', 'DB insert batches retried after a transient error')
+WRITE_ERRORS = IMPORT.counter('postfix_import_write_errors_total', 'Documents which the DB reported errors for')
+ROLLUP_ERRORS = IMPORT.counter(
+    'postfix_import_rollup_errors_total', 'Batches whose stats rollups could not be updated (see manage.py rebuild_stats)'
+)
+DELIVERY_ERRORS = IMPORT.counter(
+    'postfix_import_delivery_errors_total', 'Batches whose per-recipient delivery records could not be written (see manage.py reindex)'
+)
+RUNS = IMPORT.counter('postfix_import_runs_total', 'Completed import runs (or metric flushes for manage.py follow)')
+LAST_RUN = IMPORT.gauge('postfix_import_last_run_timestamp_seconds', 'UNIX time at which the last import run finished')
+LAST_RUN_DURATION = IMPORT.gauge('postfix_import_last_run_duration_seconds', 'How long the last import run took')
+
+CACHE_REQUESTS = WEB.counter(
+    'postfix_api_cache_requests_total', 'Web UI cache lookups by cache and result (memory / shared hit, or miss)',
+    ['cache', 'result']
+)
+API_SECONDS = WEB.histogram(
+    'postfix_api_request_seconds', 'Web UI / API request latency by route', ['route', 'method', 'status'],
+    buckets=[.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30]
+)
+
+DB_POOL_CONNECTIONS = WEB.gauge(
+    'postfix_db_pool_connections', 'RethinkDB connections in this process\'s pool, by state (idle / in_use)', ['state']
+)
+DB_POOL_WAITING = WEB.gauge('postfix_db_pool_waiting', 'Queries waiting for a free RethinkDB connection')
+DB_POOL_CONNECTS = WEB.counter(
+    'postfix_db_pool_connects_total', 'RethinkDB connections opened by the pool, by result (ok / error)', ['result']
+)
+DB_POOL_CHECK_FAILURES = WEB.counter(
+    'postfix_db_pool_check_failures_total', 'Pooled RethinkDB connections found dead and replaced'
+)
+DB_POOL_RETRIES = WEB.counter(
+    'postfix_db_pool_retries_total', 'Queries re-run on a new connection after their connection was lost'
+)
+DB_POOL_TIMEOUTS = WEB.counter(
+    'postfix_db_pool_timeouts_total', 'Queries which gave up waiting for a free RethinkDB connection'
+)
+DB_POOL_ACQUIRE_SECONDS = WEB.histogram(
+    'postfix_db_pool_acquire_seconds', 'Time spent waiting for (and health checking) a pooled RethinkDB connection',
+    buckets=[.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, 10, 30]
+)
+
+
+def load_metrics(path: str = None) -> Optional[dict]:
+    """Load the importer metrics previously saved to ``path`` (default: :attr:`.settings.metrics_file`)"""
+    path = settings.metrics_file if path is None else path
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.warning('Could not read metrics file %s (%s: %s)', path, type(e).__name__, str(e))
+        return None
+
+
+def save_metrics(started: float = None, path: str = None, registry: Registry = IMPORT):
+    """
+    Add the metrics recorded in ``registry`` since the last save into the metrics file ``path``
+    (default: :attr:`.settings.metrics_file`), then reset them - so calling this repeatedly never double counts.
+
+    :param float started: The :func:`time.time` at which the run started, to record it's duration
+    """
+    path = settings.metrics_file if path is None else path
+    now = time.time()
+    RUNS.inc()
+    LAST_RUN.set(now)
+    if started is not None:
+        LAST_RUN_DURATION.set(now - started)
+    previous = load_metrics(path)
+    if previous is not None:
+        registry.merge(previous)
+    tmp_file = f'{path}.tmp'
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(registry.dump(), f)
+        os.replace(tmp_file, path)
+    except OSError as e:
+        log.warning('Could not write metrics file %s (%s: %s)', path, type(e).__name__, str(e))
+    registry.reset()
+
+
+def render_all() -> str:
+    """Render the Web UI's metrics, plus the importer metrics last saved to :attr:`.settings.metrics_file`"""
+    out = WEB.render()
+    saved = load_metrics()
+    if saved is not None:
+        imported = Registry()
+        for m in IMPORT.metrics.values():
+            imported._add(m.empty_copy())
+        imported.merge(saved)
+        out += imported.render()
+    return out
@@ -1,24 +1,73 @@
-from dataclasses import dataclass, field
+import hashlib
+import sys
+from array import array
 from datetime import datetime
-from typing import List
+from typing import Iterable, List, Union
 
-from dateutil.parser import parse
-from privex.helpers import Dictable, is_false
+from privex.helpers import is_false
 
-from postfixparser.settings import log_timezone
+from postfixparser.dates import from_epoch, parse_log_epoch, parse_log_time
 
+DateLike = Union[datetime, str]
 
-@dataclass
-class PostfixLog(Dictable):
-    timestamp: datetime
-    queue_id: str
-    message: str
+_INTERN_FIELDS = {'relay': ('host', 'ip', 'port'), 'client': ('host', 'ip'), 'status': ('code',)}
+"""Nested fields of parsed lines which repeat across many messages, and so are interned to share one string"""
 
-    def __post_init__(self):
-        if type(self.timestamp) is not datetime:
-            self.timestamp = log_timezone.localize(parse(self.timestamp))
-        self.message = self.message.strip()
-        self.queue_id = self.queue_id.strip()
+
+def _to_datetime(timestamp: DateLike) -> datetime:
+    return timestamp if type(timestamp) is datetime else parse_log_time(timestamp)
+
+
+def _to_epoch(timestamp: DateLike) -> float:
+    return timestamp.timestamp() if type(timestamp) is datetime else parse_log_epoch(timestamp)
+
+
+class SlotDictable:
+    """
+    A replacement for :class:`privex.helpers.Dictable` for classes using ``__slots__`` (which have no ``__dict__``).
+
+    Allows casting into a ``dict`` via ``dict(obj)``, dict-style item access, equality comparison, and pickling -
+    including un-pickling objects which were pickled before the class used ``__slots__``.
+    """
+    __slots__ = ()
+    _fields = ()
+    """The public field names of the class, in the order they're returned by ``dict(obj)``"""
+
+    def __iter__(self):
+        for k in self._fields: yield (k, getattr(self, k),)
+
+    def __getitem__(self, key):
+        if key in self._fields: return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        return setattr(self, key, value)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
+
+    def __getstate__(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __setstate__(self, state: dict):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def from_dict(cls, obj: dict):
+        return cls(**{k: v for k, v in obj.items() if k in cls._fields})
+
+
+class PostfixLog(SlotDictable):
+    __slots__ = ('timestamp', 'queue_id', 'message')
+    _fields = __slots__
+
+    def __init__(self, timestamp: DateLike, queue_id: str, message: str):
+        self.timestamp: datetime = _to_datetime(timestamp)
+        self.queue_id: str = sys.intern(queue_id.strip())
+        self.message: str = message.strip()
 
     def __repr__(self):
         return f'<PostfixLog timestamp="{self.timestamp}" queue_id="{self.queue_id}" message="{self.message}" />'
@@ -35,22 +84,41 @@ class PostfixLog(Dictable):
         return data
 
 
-@dataclass
-class PostfixMessage(Dictable):
-    timestamp: datetime
-    queue_id: str
-    lines: List[PostfixLog] = field(default_factory=list)
-    mail_to: str = ""
-    mail_from: str = ""
-    message_id: str = ""
-    status: dict = field(default_factory=dict)
-    relay: dict = field(default_factory=dict)
-    client: dict = field(default_factory=dict)
-
-    def __post_init__(self):
-        if type(self.timestamp) is not datetime:
-            self.timestamp = log_timezone.localize(parse(self.timestamp))
-        self.queue_id = self.queue_id.strip()
+class PostfixMessage(SlotDictable):
+    """
+    A single email, assembled from every mail.log line logged for it's queue ID.
+
+    The log lines aren't stored as :class:`.PostfixLog` objects - each line's timestamp is kept as a float epoch in
+    an ``array('d')``, alongside a parallel list of the line messages. :attr:`.lines` builds :class:`.PostfixLog`
+    objects from these on demand (see ``./manage.py bench memory`` for how this compares to the old layout).
+
+        >>> msg = PostfixMessage(timestamp='Oct  1 12:34:56', queue_id='5E0F2C06A2')
+        >>> msg.add_line('Oct  1 12:34:56', 'removed')
+        >>> msg.lines
+        [<PostfixLog timestamp="2019-10-01 12:34:56+00:00" queue_id="5E0F2C06A2" message="removed" />]
+
+    """
+    __slots__ = (
+        'timestamp', 'queue_id', 'mail_to', 'mail_from', 'message_id', 'status', 'relay', 'client',
+        '_times', '_messages',
+    )
+    _fields = ('timestamp', 'queue_id', 'lines', 'mail_to', 'mail_from', 'message_id', 'status', 'relay', 'client')
+
+    def __init__(self, timestamp: DateLike, queue_id: str, lines: List[PostfixLog] = None, mail_to: str = "",
+                 mail_from: str = "", message_id: str = "", status: dict = None, relay: dict = None,
+                 client: dict = None):
+        self.timestamp: datetime = _to_datetime(timestamp)
+        self.queue_id: str = sys.intern(queue_id.strip())
+        self.mail_to, self.mail_from, self.message_id = mail_to, mail_from, message_id
+        self.status: dict = {} if status is None else status
+        self.relay: dict = {} if relay is None else relay
+        self.client: dict = {} if client is None else client
+        self._times = array('d')
+        """The epoch timestamp of each log line"""
+        self._messages: List[str] = []
+        """The message of each log line (i.e. the text after the queue ID)"""
+        if lines:
+            self.lines = lines
 
     def __repr__(self):
         return f'<PostfixMessage timestamp="{self.timestamp}" queue_id="{self.queue_id}" status="{self.status}" />'
@@ -58,27 +126,88 @@ class PostfixMessage(Dictable):
     def __str__(self):
         return self.__repr__()
 
+    def __setstate__(self, state: dict):
+        # Messages pickled before lines were stored as arrays (e.g. in an old checkpoint) have a list of PostfixLog's
+        lines = state.pop('lines', None)
+        if lines is not None:
+            state['_times'], state['_messages'] = array('d'), []
+        super().__setstate__(state)
+        if lines:
+            self.lines = lines
+
+    @property
+    def lines(self) -> List[PostfixLog]:
+        """The log lines of this message as :class:`.PostfixLog` objects (built on each access - prefer :meth:`.add_line`)"""
+        return [
+            PostfixLog(timestamp=from_epoch(ts), queue_id=self.queue_id, message=m)
+            for ts, m in zip(self._times, self._messages)
+        ]
+
+    @lines.setter
+    def lines(self, lines: Iterable[PostfixLog]):
+        self._times, self._messages = array('d'), []
+        for l in lines:
+            self.add_line(l.timestamp, l.message)
+
+    @property
+    def line_count(self) -> int:
+        return len(self._messages)
+
+    @property
+    def last_message(self) -> str:
+        """The message of the most recent log line, or an empty string if there aren't any lines"""
+        return self._messages[-1] if self._messages else ''
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        A short hash of the state of this message - it's line count, last log line (and when it was logged) and
+        status. Re-importing the same lines gives the same fingerprint, while any new line or status changes it.
+
+            >>> msg.fingerprint
+            'f1f7a8dd4570889b'
+        """
+        last_time = self._times[-1] if self._times else 0.0
+        data = '\0'.join([
+            str(len(self._messages)), repr(last_time), self.last_message,
+            str(self.status.get('code', '')), str(self.status.get('message', '')),
+        ])
+        return hashlib.blake2b(data.encode('utf-8', 'replace'), digest_size=8).hexdigest()
+
+    def add_line(self, timestamp: DateLike, message: str):
+        """Append the log line ``message`` logged at ``timestamp`` (a :class:`.datetime` or raw log timestamp)"""
+        self._times.append(_to_epoch(timestamp))
+        self._messages.append(message.strip())
+
+    def extend_lines(self, times: Iterable[float], messages: Iterable[str]):
+        """Append several log lines at once, from parallel iterables of epoch timestamps and (stripped) messages"""
+        self._times.extend(times)
+        self._messages.extend(messages)
+
     @property
     def first_attempt(self) -> datetime:
-        return self.lines[0].timestamp
+        return from_epoch(self._times[0])
 
     @property
     def last_attempt(self) -> datetime:
-        return self.lines[-1].timestamp
+        return from_epoch(self._times[-1])
 
     def merge(self, dicdata: dict):
         for k, v in dicdata.items():
+            if k in _INTERN_FIELDS:
+                v = {dk: sys.intern(dv) if dk in _INTERN_FIELDS[k] and type(dv) is str else dv for dk, dv in v.items()}
             if hasattr(self, k):
                 setattr(self, k, v)
 
     def clean_dict(self, convert_time=str) -> dict:
-        data = dict(self)
-        if is_false(convert_time):
-            data['timestamp'] = self.timestamp
-            data['first_attempt'], data['last_attempt'] = self.first_attempt, self.last_attempt
-        else:
-            data['timestamp'] = convert_time(self.timestamp)
-            data['first_attempt'] = convert_time(self.first_attempt)
-            data['last_attempt'] = convert_time(self.last_attempt)
-        data['lines'] = [s.clean_dict(convert_time=convert_time) for s in self.lines]
+        convert_time = (lambda dt: dt) if is_false(convert_time) else convert_time
+        # Lines only become datetime's here, and are converted straight into dicts - skipping PostfixLog entirely
+        lines = [
+            dict(timestamp=convert_time(from_epoch(ts)), queue_id=self.queue_id, message=m)
+            for ts, m in zip(self._times, self._messages)
+        ]
+        data = {k: lines if k == 'lines' else getattr(self, k) for k in self._fields}
+        data['timestamp'] = convert_time(self.timestamp)
+        data['first_attempt'] = convert_time(self.first_attempt)
+        data['last_attempt'] = convert_time(self.last_attempt)
         return data
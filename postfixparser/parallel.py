@@ -0,0 +1,188 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Multi-process parsing of large, uncompressed log files.
+
+The file is split into byte ranges at line boundaries, and each range is parsed in a worker process by
+:func:`.parse_range`. Each worker returns the partial results for every message it saw, which are then added
+to a :class:`.MessageTracker` in file order (i.e. timestamp order) by :meth:`.MessageTracker.add_partials` - giving
+exactly the same messages as feeding the file through the tracker line by line.
+
+"""
+import asyncio
+import logging
+import os
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from typing import AsyncGenerator, Dict, List, Optional, Tuple
+
+from postfixparser import settings
+from postfixparser.dates import parse_log_epoch
+from postfixparser.parser import match, tokenize_line
+
+log = logging.getLogger(__name__)
+
+Partial = Tuple[dict, array, List[str]]
+"""
+The parsed fields (merged in order) of a single message from one byte range of a log file, plus the epoch timestamps
+and messages of it's log lines (the same compact form :class:`.PostfixMessage` stores them in)
+"""
+
+Segment = Tuple[str, Partial, float]
+"""
+A queue ID, the :attr:`.Partial` result of the lines logged for it until it was ``removed`` / went idle (or the byte
+range ended), and the epoch of the newest line read in the range before the first of them (``-inf`` if none were)
+"""
+
+
+def find_line_end(f, pos: int, end: int) -> int:
+    """Return the position just after the first newline at or after ``pos`` in the binary file ``f`` (max: ``end``)"""
+    if pos <= 0:
+        return 0
+    f.seek(pos - 1)
+    while pos < end:
+        buf = f.read(min(65536, end - pos + 1))
+        if not buf:
+            return end
+        nl = buf.find(b'\n')
+        if nl >= 0:
+            return min(pos + nl, end)
+        pos += len(buf)
+    return end
+
+
+def complete_end(f, end: int) -> int:
+    """Return the position just after the last newline before ``end`` - excluding a partially written final line"""
+    pos = end
+    while pos > 0:
+        start = max(0, pos - 65536)
+        f.seek(start)
+        buf = f.read(pos - start)
+        nl = buf.rfind(b'\n')
+        if nl >= 0:
+            return start + nl + 1
+        pos = start
+    return 0
+
+
+def split_ranges(path: str, parts: int, start: int = 0, end: int = None) -> List[Tuple[int, int]]:
+    """
+    Split the file ``path`` from byte ``start`` up to ``end`` (default: the last complete line) into at most ``parts``
+    byte ranges of roughly equal size, each starting at the beginning of a line and ending after a newline.
+
+        >>> split_ranges('/var/log/mail.log', 4)
+        [(0, 2621466), (2621466, 5242893), (5242893, 7864332), (7864332, 10485771)]
+
+    """
+    with open(path, 'rb') as f:
+        end = complete_end(f, os.fstat(f.fileno()).st_size if end is None else end)
+        if end <= start:
+            return []
+        step = max(1, (end - start) // max(1, parts))
+        bounds = [start]
+        for i in range(1, parts):
+            b = find_line_end(f, start + step * i, end)
+            if b > bounds[-1]:
+                bounds.append(b)
+        if bounds[-1] < end:
+            bounds.append(end)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+def parse_range(path: str, start: int, end: int,
+                idle_timeout: Optional[float] = None) -> Tuple[List[Segment], Dict[str, int]]:
+    """
+    Parse the lines of ``path`` between the byte offsets ``start`` and ``end``. This runs inside of worker processes.
+
+    The lines of each queue ID are collected into a :attr:`.Segment`, which ends once Postfix logs ``removed`` - so a
+    re-used queue ID starts a new one. If ``idle_timeout`` (seconds) is given, a new segment is also started when
+    a line newer than the queue ID's last line plus ``idle_timeout`` was read in between, as
+    :meth:`.MessageTracker.expire` would have flushed the message by then.
+
+    :return tuple result: The segments in the order their first lines appear in the range, and the number of
+                          ``lines`` read / ``unmatched``.
+    """
+    segments, current, stats = [], {}, dict(lines=0, unmatched=0)
+    latest = float('-inf')
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            raw = f.readline()
+            if not raw:
+                break
+            pos += len(raw)
+            stats['lines'] += 1
+            m = match.match(raw.decode('utf-8', errors='replace'))
+            if not m:
+                stats['unmatched'] += 1
+                continue
+
+            dtime, qid, msg = m.groups()
+            ts = parse_log_epoch(dtime)
+            p = current.get(qid)
+            if p is None or (idle_timeout is not None and latest - p[1][-1] > idle_timeout):
+                p = current[qid] = ({}, array('d'), [])
+                segments.append((qid, p, latest))
+            msg = msg.strip()
+            p[0].update(tokenize_line(msg))
+            p[1].append(ts)
+            p[2].append(msg)
+            if msg == 'removed':
+                del current[qid]
+            if ts > latest:
+                latest = ts
+    return segments, stats
+
+
+async def iter_range_results(path: str, workers: int, start: int = 0, chunk_size: int = None,
+                             idle_timeout: timedelta = None) \
+        -> AsyncGenerator[Tuple[List[Segment], Dict[str, int], int], None]:
+    """
+    Parse the complete lines of the uncompressed log file ``path`` from byte ``start`` onwards, using ``workers``
+    processes, yielding the results of each byte range in file order.
+
+    The file is split into ranges of at most ``chunk_size`` bytes (default: :attr:`.settings.parallel_chunk_size` MB),
+    and at most ``workers * 2`` ranges are queued at once - so the parent doesn't have to hold the results for the
+    whole file in memory at the same time.
+
+    :return tuple res: (yielded) The :attr:`.Segment`'s of a byte range, it's line counts (see :func:`.parse_range`
+                       - which is passed ``idle_timeout``), and the byte offset at which the range ends.
+    """
+    chunk_size = settings.parallel_chunk_size * 1024 * 1024 if chunk_size is None else chunk_size
+    with open(path, 'rb') as f:
+        end = complete_end(f, os.fstat(f.fileno()).st_size)
+    parts = max(workers, -(-(end - start) // max(1, chunk_size)))
+    ranges = split_ranges(path, parts, start=start, end=end)
+    if len(ranges) == 0:
+        return
+    log.info('Parsing %s from byte %d to %d in %d ranges across %d worker processes',
+             path, ranges[0][0], ranges[-1][1], len(ranges), workers)
+
+    idle_secs = None if idle_timeout is None else idle_timeout.total_seconds()
+    loop = asyncio.get_event_loop()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        queued = deque()
+        for s, e in ranges:
+            queued.append((loop.run_in_executor(pool, parse_range, path, s, e, idle_secs), e))
+            if len(queued) >= workers * 2:
+                fut, rng_end = queued.popleft()
+                yield (*await fut, rng_end)
+        while len(queued) > 0:
+            fut, rng_end = queued.popleft()
+            yield (*await fut, rng_end)
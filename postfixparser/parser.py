@@ -16,35 +16,97 @@ Copyright::
 
 """
 import re
+from typing import Callable, Dict, Match
 
-find_to = re.compile(r'.*to=<([a-zA-Z0-9-_.]+@[a-zA-Z0-9-_.]+)>')
-find_from = re.compile(r'.*from=<([a-zA-Z0-9-_.]+@[a-zA-Z0-9-_.]+)>')
-find_message_id = re.compile(r'.*message-id=<(.*)>')
-find_status = re.compile(r'.*status=([a-zA-Z0-9-_.]+) (.*)?')
-find_relay = re.compile(r'.*relay=([a-zA-Z0-9-._]+)\[(.*)\]:([0-9]+)')
-find_client = re.compile(r'.*client=([a-zA-Z0-9-._]+)\[(.*)\]')
+_match = r'([A-Za-z]+[ \t]+[0-9]+[ \t]+[0-9]+\:[0-9]+:[0-9]+'
+_match += r'|[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}(?:\.[0-9]+)?(?:Z|[+-][0-9]{2}:?[0-9]{2})?).*'
+"""(0) Regex to match the Date/Time at the start of each log line (traditional syslog, or RFC3339 high precision)"""
 
+_match += r'([A-F0-9]{10})\:[ \t]+?(.*)'
+"""Regex to match the (1) Queue ID and the (2) Log Message"""
+
+match = re.compile(_match)
+
+_addr = r'[a-zA-Z0-9-_.]+@[a-zA-Z0-9-_.]+'
+_host = r'[a-zA-Z0-9-._]+'
+
+find_keys = re.compile(
+    rf'to=<(?P<to>{_addr})>'
+    rf'|from=<(?P<from>{_addr})>'
+    rf'|client=(?P<client_host>{_host})\[(?P<client_ip>[^\]]*)\]'
+    rf'|relay=(?P<relay_host>{_host})\[(?P<relay_ip>[^\]]*)\]:(?P<relay_port>[0-9]+)'
+    rf'|status=(?P<status_code>[a-zA-Z0-9-_.]+) (?P<status_msg>.*)'
+    rf'|message-id=<(?P<message_id>.*)>'
+)
+"""
+Matches each of the ``key=value`` pairs we're interested in within a Postfix log message. Use with ``finditer``,
+and dispatch on ``match.lastgroup`` (the name of the final group in the alternative that matched) using
+:attr:`.KEY_HANDLERS`.
+
+The status message (``status_msg``) and ``message_id`` run until the end of the line, so no further keys will
+be found after them.
+"""
+
+_KEY_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-')
+
+
+def _set_to(m, lm: dict): lm['mail_to'] = m['to']
+
+
+def _set_from(m, lm: dict): lm['mail_from'] = m['from']
 
-async def parse_line(mline) -> dict:
-    lm = {}
 
-    _to = find_to.match(mline)
-    _from = find_from.match(mline)
-    _client = find_client.match(mline)
-    _relay = find_relay.match(mline)
+def _set_client(m, lm: dict): lm['client'] = {'host': m['client_host'], 'ip': m['client_ip']}
 
-    if _to is not None: lm['mail_to'] = _to.group(1)
-    if _from is not None: lm['mail_from'] = _from.group(1)
-    if _client is not None: lm['client'] = dict(host=_client.group(1), ip=_client.group(2))
-    if _relay is not None: lm['relay'] = dict(host=_relay.group(1), ip=_relay.group(2), port=_relay.group(3))
 
-    _status = find_status.match(mline)
-    if _status is not None:
-        lm['status'] = dict(code=_status.group(1), message="")
-        if len(_status.groups()) > 1:
-            lm['status']['message'] = _status.group(2)
+def _set_relay(m, lm: dict):
+    lm['relay'] = {'host': m['relay_host'], 'ip': m['relay_ip'], 'port': m['relay_port']}
 
-    _message_id = find_message_id.match(mline)
-    if _message_id is not None: lm['message_id'] = _message_id.group(1)
 
+def _set_status(m, lm: dict): lm['status'] = {'code': m['status_code'], 'message': m['status_msg']}
+
+
+def _set_message_id(m, lm: dict): lm['message_id'] = m['message_id']
+
+
+KEY_HANDLERS: Dict[str, Callable[[Match, dict], None]] = {
+    'to': _set_to,
+    'from': _set_from,
+    'client_ip': _set_client,
+    'relay_port': _set_relay,
+    'status_msg': _set_status,
+    'message_id': _set_message_id,
+}
+"""Maps the ``lastgroup`` of a :attr:`.find_keys` match to a function which stores it's value into the parsed dict"""
+
+
+def tokenize_line(mline: str) -> dict:
+    """
+    Parse the ``key=value`` pairs we're interested in out of a single Postfix log message, in a single pass over
+    the message.
+
+        >>> tokenize_line('to=<john@example.com>, relay=mx.example.com[1.2.3.4]:25, delay=0.5, status=sent (250 OK)')
+        {'mail_to': 'john@example.com', 'relay': {'host': 'mx.example.com', 'ip': '1.2.3.4', 'port': '25'},
+         'status': {'code': 'sent', 'message': '(250 OK)'}}
+
+    Keys which merely end with one of ours (e.g. ``orig_to=<...>``) are ignored.
+
+    :param str mline: The log message (everything after ``QUEUEID: ``)
+    :return dict lm:  A dict containing the keys ``mail_to``, ``mail_from``, ``client``, ``relay``, ``status`` and/or
+                      ``message_id`` - but only those which were present in the message.
+    """
+    lm = {}
+    for m in find_keys.finditer(mline):
+        start = m.start()
+        if start > 0 and mline[start - 1] in _KEY_CHARS:
+            continue
+        KEY_HANDLERS[m.lastgroup](m, lm)
     return lm
+
+
+def parse_line(mline) -> dict:
+    """
+    Parse a single log message - an alias of :func:`.tokenize_line`. This is plain synchronous code, so it can be
+    called for every line without the overhead of creating and awaiting a coroutine.
+    """
+    return tokenize_line(mline)
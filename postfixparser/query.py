@@ -0,0 +1,535 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Turns the filters and ordering of an API request into a RethinkDB query which uses the table's indexes
+(see :attr:`.settings.rethink_tables`) wherever it can, instead of filtering and sorting the whole table.
+
+    >>> conds = parse_filters({'status.code': 'bounced', 'last_attempt__gt': '2019-10-01'})
+    >>> plan = QueryPlanner.for_table('sent_mail').plan(conds, order_by='last_attempt', order_dir='desc')
+    >>> plan
+    <QueryPlan between(status_last_attempt) ordered by index (0 filters)>
+    >>> docs = await plan.build(r.table('sent_mail'), r_q).limit(20).run(conn)
+
+"""
+import base64
+import binascii
+import json
+import logging
+import operator
+import re
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import reduce
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
+
+from postfixparser import settings
+from postfixparser.dates import from_epoch, parse_log_time
+from postfixparser.exceptions import APIException
+
+log = logging.getLogger(__name__)
+
+TIME_FIELDS = ('timestamp', 'first_attempt', 'last_attempt')
+"""Fields which are stored as RethinkDB times, so filter values for them must be parsed into datetimes"""
+
+PRIMARY_KEY = 'id'
+
+ADDRESS_FIELDS = ('mail_to', 'mail_from')
+"""
+Email address fields which the importer also stores in lowercase parts, so wildcard filters on them can use an index
+(see :func:`.address_fields`)
+"""
+ADDRESS_PARTS = ('local', 'domain', 'rdomain')
+ADDRESS_DERIVED_FIELDS = tuple(f'{f}_{p}' for f in ADDRESS_FIELDS for p in ADDRESS_PARTS)
+
+MAX_CHAR = '\U0010ffff'
+"""Sorts after any other character - so every string starting with ``x`` is between ``x`` and ``x + MAX_CHAR``"""
+
+MULTI_INDEX_MAX_ROWS = 100000
+"""
+A multi index (e.g. the search ``tokens``) is only used to look up a value estimated to match fewer rows than this,
+as the rows it returns are sorted in memory - which RethinkDB limits to 100,000 rows.
+"""
+
+IndexSpec = Union[str, Tuple[str, Sequence[str]], Tuple[str, Sequence[str], dict]]
+
+
+def index_spec(spec: IndexSpec) -> Tuple[str, Tuple[str, ...]]:
+    """
+    Normalise an index from :attr:`.settings.rethink_tables` into ``(name, fields)``
+
+        >>> index_spec('mail_to')
+        ('mail_to', ('mail_to',))
+        >>> index_spec(('status_last_attempt', ['status.code', 'last_attempt']))
+        ('status_last_attempt', ('status.code', 'last_attempt'))
+
+    """
+    if isinstance(spec, str):
+        return spec, (spec,)
+    return spec[0], tuple(spec[1])
+
+
+def index_options(spec: IndexSpec) -> dict:
+    """
+    The extra ``index_create`` options for an index from :attr:`.settings.rethink_tables`, given as an optional
+    third tuple item
+
+        >>> index_options(('tokens', ['tokens'], {'multi': True}))
+        {'multi': True}
+
+    """
+    return dict(spec[2]) if not isinstance(spec, str) and len(spec) > 2 else {}
+
+
+def row_field(row, name: str):
+    """Access the (``x.y`` style) field ``name`` of the RethinkDB row ``row``"""
+    for k in name.split('.'):
+        row = row[k]
+    return row
+
+
+def index_function(fields: Sequence[str]):
+    """
+    Returns the index function to pass to ``index_create`` for an index over ``fields`` - a function returning the
+    (nested) field, or the list of values for compound indexes. Indexes named after the single field they cover
+    don't need one - see :func:`.index_create_args`.
+    """
+    if len(fields) == 1:
+        return lambda row: row_field(row, fields[0])
+    return lambda row: [row_field(row, f) for f in fields]
+
+
+def index_create_args(spec: IndexSpec) -> tuple:
+    """
+    The positional arguments for ``index_create`` - just the name for an index of the same named field, otherwise
+    the name and :func:`.index_function`
+
+        >>> index_create_args('mail_to')
+        ('mail_to',)
+
+    """
+    name, fields = index_spec(spec)
+    return (name,) if fields == (name,) else (name, index_function(fields))
+
+
+@dataclass
+class Condition:
+    """A single filter from the query string, e.g. ``timestamp__lt=2019-09-17`` is ``Condition('timestamp', 'le', ...)``"""
+    field: str
+    op: str
+    """
+    ``eq``, ``le`` (``__lt``), ``ge`` (``__gt``), ``match`` (a regex, from wildcard values like ``*@gmail.com``),
+    ``contains`` (an array field containing the value, e.g. a search token), or ``in`` (the field equals any value in
+    the tuple ``value``, e.g. the queue IDs found for a recipient - see :mod:`postfixparser.deliveries`)
+    """
+    value: Any
+    estimate: Optional[int] = None
+    """
+    For ``contains`` conditions on a multi index, or ``le`` / ``ge`` conditions on an indexed field - roughly how
+    many rows match (the whole range, for ``le`` / ``ge``), if known
+    """
+
+    def apply(self, query):
+        """Append this condition to the RethinkDB ``query`` as a ``.filter()``"""
+        f, v = self.field, self.value
+        if self.op == 'contains':
+            return query.filter(lambda m: row_field(m, f).default([]).contains(v))
+        if self.op == 'le':
+            return query.filter(lambda m: row_field(m, f) <= v)
+        if self.op == 'ge':
+            return query.filter(lambda m: row_field(m, f) >= v)
+        if self.op == 'match':
+            return query.filter(lambda m: row_field(m, f).match(v))
+        if self.op == 'in':
+            if len(v) == 0:
+                return query.limit(0)
+            return query.filter(lambda m: reduce(operator.or_, [row_field(m, f) == x for x in v]))
+        return query.filter(lambda m: row_field(m, f) == v)
+
+
+def _filter_value(fkey: str, fval: str) -> Any:
+    if fkey not in TIME_FIELDS:
+        return fval
+    try:
+        return parse_log_time(fval)
+    except (ValueError, OverflowError):
+        raise APIException('INVALID_FILTER', f"Could not parse the date/time '{fval}' for the filter '{fkey}'")
+
+
+def split_address(addr: str) -> Tuple[str, str]:
+    """
+    Split an email address into it's lowercased local part and domain
+
+        >>> split_address('John.Smith@Example.COM')
+        ('john.smith', 'example.com')
+        >>> split_address('MAILER-DAEMON')
+        ('mailer-daemon', '')
+
+    """
+    local, _, domain = str(addr).lower().rpartition('@')
+    return (local, domain) if _ else (domain, '')
+
+
+def address_fields(m: Mapping) -> Dict[str, str]:
+    """
+    The derived (indexed) fields for each of the :attr:`.ADDRESS_FIELDS` of the ``sent_mail`` document ``m`` - the
+    lowercase local part, domain, and reversed domain (for suffix matching). Empty addresses are left out, so that
+    merging a message into the stored copy doesn't blank them.
+
+        >>> address_fields({'mail_to': 'john@mx.Example.com', 'mail_from': ''})
+        {'mail_to_local': 'john', 'mail_to_domain': 'mx.example.com', 'mail_to_rdomain': 'moc.elpmaxe.xm'}
+
+    """
+    fields = {}
+    for f in ADDRESS_FIELDS:
+        if not m.get(f):
+            continue
+        local, domain = split_address(m[f])
+        fields.update({f'{f}_local': local, f'{f}_domain': domain, f'{f}_rdomain': domain[::-1]})
+    return fields
+
+
+def _prefix_conditions(fkey: str, prefix: str) -> List[Condition]:
+    """Conditions matching the strings in ``fkey`` which start with ``prefix``, as an (indexable) range"""
+    return [Condition(fkey, 'ge', prefix), Condition(fkey, 'le', prefix + MAX_CHAR)]
+
+
+def address_conditions(fkey: str, fval: str) -> Optional[List[Condition]]:
+    """
+    Turn a wildcard filter on one of the :attr:`.ADDRESS_FIELDS` into conditions on it's derived fields, which can
+    be answered with an index range (or lookup) rather than a regex over the whole table. Like the derived fields,
+    these are case insensitive.
+
+     - ``bob*`` - local part in the range ``bob`` .. ``bob\\U0010ffff``
+     - ``bob@exa*`` - local part ``bob``, and domain in the range ``exa`` .. ``exa\\U0010ffff``
+     - ``*@example.com`` - domain ``example.com``
+     - ``*example.com`` / ``*.example.com`` - reversed domain starting with ``moc.elpmaxe`` (sub-domains included)
+     - ``*n@example.com`` - domain ``example.com``, filtered to local parts ending in ``n``
+
+    :return list|None conditions: The conditions, or ``None`` if ``fval`` isn't a prefix / suffix wildcard on an
+                                  address field (e.g. ``*smith*``), so it should be parsed by :func:`.parse_condition`
+    """
+    if fkey not in ADDRESS_FIELDS or fval.startswith('*') == fval.endswith('*'):
+        return None
+    val = fval.strip('*').lower()
+    if '*' in val or val == '':
+        return None
+    if fval.endswith('*'):  # matches: something*
+        local, at, domain = val.partition('@')
+        if not at:
+            return _prefix_conditions(f'{fkey}_local', local)
+        conds = [Condition(f'{fkey}_local', 'eq', local)]
+        return conds + _prefix_conditions(f'{fkey}_domain', domain) if domain else conds
+    local, at, domain = val.rpartition('@')  # matches: *something
+    if at and not domain:
+        return None
+    if not at:
+        return _prefix_conditions(f'{fkey}_rdomain', domain[::-1])
+    conds = [Condition(f'{fkey}_domain', 'eq', domain)]
+    return conds + [Condition(f'{fkey}_local', 'match', f'{re.escape(local)}$')] if local else conds
+
+
+def parse_condition(fkey: str, fval: str) -> Condition:
+    """
+    Parse a single query string filter into a :class:`.Condition`. Use ``x.y`` to access sub-dict key's, and
+    append ``__lt`` / ``__gt`` to the end of a key for ``<=`` and ``>=`` respectively.
+
+    If the value starts or ends with an asterisk, then it's matched as a regex, to find items which start/end
+    with the actual value (without the asterisks).
+    """
+    if fkey.endswith('__lt'):
+        return Condition(fkey[:-4], 'le', _filter_value(fkey[:-4], fval))
+    if fkey.endswith('__gt'):
+        return Condition(fkey[:-4], 'ge', _filter_value(fkey[:-4], fval))
+    if fval.startswith('*') or fval.endswith('*'):
+        rval = fval.replace('*', '')  # fval but without asterisks
+        if fval.startswith('*') and fval.endswith('*'):  # matches: *something*
+            return Condition(fkey, 'match', rval)
+        if fval.startswith('*'):  # matches: *something
+            return Condition(fkey, 'match', f"{rval}$")
+        return Condition(fkey, 'match', f"^{rval}")  # matches: something*
+    return Condition(fkey, 'eq', _filter_value(fkey, fval))
+
+
+def parse_filters(frm: Mapping, skip_keys: Iterable[str] = ('limit', 'offset', 'page', 'cursor', 'fields')) -> List[Condition]:
+    """
+    Parse each key/value of the query string dict ``frm`` into :class:`.Condition`'s (except for ``skip_keys``).
+    Wildcards on email addresses become conditions on their derived fields - see :func:`.address_conditions`.
+    """
+    conds = []
+    for k, v in frm.items():
+        if k not in skip_keys:
+            conds += address_conditions(k, str(v)) or [parse_condition(k, str(v))]
+    return conds
+
+
+def filters_key(conditions: Iterable[Condition]) -> tuple:
+    """A hashable key for a set of conditions, which is the same whichever order the filters were passed in"""
+    return tuple(sorted(
+        (c.field, c.op, c.value.isoformat() if isinstance(c.value, datetime) else str(c.value)) for c in conditions
+    ))
+
+
+@dataclass
+class QueryPlan:
+    """
+    How a query will be executed - which index (if any) selects the rows, whether that index also returns them
+    in the requested order, and which conditions are left over to be applied with ``.filter()``.
+    """
+    order_by: Optional[str]
+    order_dir: str = 'desc'
+    index: Optional[str] = None
+    """The index used to select rows, or ``None`` for a full table scan"""
+    get_all: Optional[Any] = None
+    """If set, the rows are selected with ``get_all(get_all, index=index)``"""
+    get_all_keys: Optional[tuple] = None
+    """If set, the rows are selected with ``get_all(*get_all_keys, index=index)`` - i.e. any of several values"""
+    between: Optional[Tuple[list, list]] = None
+    """
+    If set, the rows are selected with ``between(lower, upper, index=index)`` (both bounds inclusive). Each bound is a
+    list of values for the index's fields, where ``None`` means unbounded.
+    """
+    index_ordered: bool = False
+    """``True`` if the rows are returned in order by ``order_by(index=index)``, rather than sorted in memory"""
+    filters: List[Condition] = field(default_factory=list)
+    after: Optional[Tuple[Any, str]] = None
+    """
+    A ``(sort key, id)`` pair from a :func:`.decode_cursor` - if set, only rows which come after that row in the
+    requested order are returned (keyset pagination).
+    """
+
+    def __repr__(self):
+        if self.index is None:
+            how = 'scan'
+        elif self.get_all is not None or self.get_all_keys is not None:
+            how = f'get_all({self.index})'
+        else:
+            how = f"{'index' if self.between is None else 'between'}({self.index})"
+        order = 'unordered' if self.order_by is None else 'ordered by index' if self.index_ordered else 'ordered in memory'
+        return f'<QueryPlan {how} {order} ({len(self.filters)} filters)>'
+
+    @staticmethod
+    def _bound(values: list, fill):
+        values = [fill if v is None else v for v in values]
+        return values[0] if len(values) == 1 else values
+
+    def _resume_between(self, desc: bool) -> Tuple[list, list]:
+        """Narrow :attr:`.between` on the ordered (last) field of the index, so the range starts at :attr:`.after`"""
+        key = self.after[0]
+        lower, upper = (list(b) for b in self.between) if self.between is not None else ([None], [None])
+        if desc and (upper[-1] is None or key < upper[-1]):
+            upper[-1] = key
+        elif not desc and (lower[-1] is None or key > lower[-1]):
+            lower[-1] = key
+        return lower, upper
+
+    def _after_filter(self, desc: bool):
+        """A filter function for the rows after :attr:`.after` - ties on the sort key are broken by the ``id``"""
+        key, last_id, f = self.after[0], self.after[1], self.order_by
+        if desc:
+            return lambda m: (row_field(m, f) < key) | ((row_field(m, f) == key) & (m[PRIMARY_KEY] < last_id))
+        return lambda m: (row_field(m, f) > key) | ((row_field(m, f) == key) & (m[PRIMARY_KEY] > last_id))
+
+    def select(self, table, r, between: Tuple[list, list] = None):
+        """Select the rows of ``table`` using the plan's index, without filtering or ordering them"""
+        between = self.between if between is None else between
+        if self.get_all is not None:
+            return table.get_all(self.get_all, index=self.index)
+        if self.get_all_keys is not None:
+            return table.get_all(*self.get_all_keys, index=self.index) if self.get_all_keys else table.limit(0)
+        if between is not None:
+            lower, upper = between
+            return table.between(
+                self._bound(lower, r.minval), self._bound(upper, r.maxval), index=self.index, right_bound='closed'
+            )
+        return table
+
+    def build(self, table, r, ordered: bool = True):
+        """
+        Build the RethinkDB query for this plan against ``table``.
+
+        :param table:          The RethinkDB table object, e.g. ``r.db('maildata').table('sent_mail')``
+        :param r:              The :class:`rethinkdb.RethinkDB` instance (for ``desc`` / ``minval`` / ``maxval``)
+        :param bool ordered:   If ``False``, the results aren't ordered or resumed from :attr:`.after`
+                               (e.g. when counting every matching row)
+        """
+        desc = self.order_dir != 'asc'
+        resume = ordered and self.after is not None and self.order_by is not None
+        query = self.select(table, r, self._resume_between(desc) if resume and self.index_ordered else None)
+        if ordered and self.index_ordered:
+            # Rows with the same index value are returned in order of their primary key, which is the same
+            # tie-breaker used by the cursor filter below
+            query = query.order_by(index=r.desc(self.index) if desc else r.asc(self.index))
+        for cond in self.filters:
+            query = cond.apply(query)
+        if resume:
+            query = query.filter(self._after_filter(desc))
+        if ordered and not self.index_ordered and self.order_by is not None:
+            key = self.order_by if '.' not in self.order_by else (lambda m: row_field(m, self.order_by))
+            query = query.order_by(r.desc(key), r.desc(PRIMARY_KEY)) if desc else query.order_by(key, PRIMARY_KEY)
+        return query
+
+
+def encode_cursor(row: Mapping, order_by: str, order_dir: str) -> Optional[str]:
+    """
+    Build an opaque cursor pointing just after ``row`` (the last row of a page) when ordered by ``order_by`` /
+    ``order_dir``, which can be passed back as ``?cursor=`` to fetch the next page (see :func:`.decode_cursor`).
+
+    :return str|None cursor: The cursor, or ``None`` if ``row`` is missing the sort key or ``id``
+    """
+    try:
+        key, row_id = row_field(row, order_by), row[PRIMARY_KEY]
+    except (KeyError, TypeError):
+        return None
+    if isinstance(key, datetime):
+        key = {'$time': key.timestamp()}
+    data = json.dumps(dict(o=order_by, d=order_dir, k=key, i=row_id), separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, order_by: str, order_dir: str) -> Tuple[Any, str]:
+    """
+    Decode a cursor from :func:`.encode_cursor` into the ``(sort key, id)`` of the row it points after, for
+    :meth:`.Storage.find` (or :attr:`.QueryPlan.after`). Raises a 400 :class:`.APIException` if the cursor is invalid, or was created for
+    a different ``order`` / ``order_dir``.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        key, row_id = data['k'], data['i']
+        if isinstance(key, dict):
+            key = from_epoch(float(key['$time']))
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        raise APIException('INVALID_CURSOR', 'The pagination cursor is invalid - please start again from page 1')
+    if data.get('o') != order_by or data.get('d') != order_dir:
+        raise APIException('INVALID_CURSOR', 'The pagination cursor was created for a different order / order_dir')
+    return key, row_id
+
+
+class QueryPlanner:
+    """
+    Picks the best :class:`.QueryPlan` for a set of :class:`.Condition`'s and an ordering, based on the indexes
+    of a table. In order of preference:
+
+     - An equality filter on the primary key (``id``) - at most one row, so it's looked up with ``get_all``
+     - An ``in`` filter on the primary key - each of it's values is looked up with ``get_all``, and sorted in memory
+     - A ``contains`` condition on a multi index, with an :attr:`.Condition.estimate` below
+       :attr:`.MULTI_INDEX_MAX_ROWS` - the rarest value is looked up with ``get_all``, and sorted in memory
+     - An index covering a range filter with an :attr:`.Condition.estimate` below :attr:`.MULTI_INDEX_MAX_ROWS`
+       (``between``), sorted in memory
+     - An index which returns the rows in the requested order - preferring compound indexes which also cover
+       equality filters (e.g. ``status.code`` + ``last_attempt``), then any range filter on the ordered field.
+       These are streamed straight from the index, so a page only reads as many rows as it needs.
+     - An index covering an equality filter (``get_all``), then a range filter (``between``), with the
+       (hopefully much smaller) selection sorted in memory.
+     - Otherwise, a full table scan.
+
+    Any conditions which aren't covered by the chosen index are applied with ``.filter()``.
+    """
+
+    def __init__(self, indexes: Iterable[IndexSpec] = ()):
+        indexes = list(indexes)
+        self.indexes: Dict[str, Tuple[str, ...]] = dict(index_spec(i) for i in indexes)
+        self.multi: Dict[str, str] = {
+            index_spec(i)[1][0]: index_spec(i)[0] for i in indexes if index_options(i).get('multi')
+        }
+        """The multi indexes, as ``{field: index_name}``"""
+
+    @classmethod
+    def for_table(cls, table: str) -> "QueryPlanner":
+        """Create a planner for ``table`` using it's indexes from :attr:`.settings.rethink_tables`"""
+        return cls(dict(settings.rethink_tables).get(table, []))
+
+    def _candidate(self, name: str, fields: Tuple[str, ...], eqs: Dict[str, Condition],
+                   ranges: Dict[str, List[Condition]], order_by: str):
+        """Work out how the index ``name`` could be used, and score it. Returns ``None`` if it isn't useful."""
+        prefix = []
+        for f in fields:
+            if f not in eqs:
+                break
+            prefix.append(f)
+        rest = fields[len(prefix):]
+        ordered = len(rest) == 1 and rest[0] == order_by
+        range_field = rest[0] if len(rest) > 0 and rest[0] in ranges else None
+        if len(prefix) == 0 and not ordered and range_field is None:
+            return None
+
+        used = [eqs[f] for f in prefix] + ranges.get(range_field, [])
+        plan = QueryPlan(order_by=order_by, index=name, index_ordered=ordered)
+        if len(prefix) == len(fields) and len(fields) == 1:
+            plan.get_all = eqs[prefix[0]].value
+        elif len(prefix) > 0 or range_field is not None:
+            lower, upper = [eqs[f].value for f in prefix], [eqs[f].value for f in prefix]
+            if len(rest) > 0:
+                lower.append(next((c.value for c in ranges.get(range_field, []) if c.op == 'ge'), None))
+                upper.append(next((c.value for c in ranges.get(range_field, []) if c.op == 'le'), None))
+                # Any further fields of the index are unbounded
+                lower += [None] * (len(rest) - 1)
+                upper += [None] * (len(rest) - 1)
+            plan.between = (lower, upper)
+        # A range known to be small (e.g. an address prefix, see :func:`.address_conditions`) beats streaming the
+        # whole table in order, as only it's rows need sorting in memory
+        selective = any(c.estimate is not None and c.estimate < MULTI_INDEX_MAX_ROWS for c in used)
+        return (selective, ordered, len(prefix), range_field is not None), plan, used
+
+    def plan(self, conditions: List[Condition], order_by: Optional[str] = 'last_attempt',
+             order_dir: str = 'desc') -> QueryPlan:
+        """
+        Plan a query returning the rows matching all of ``conditions``, ordered by ``order_by``.
+
+        When the order doesn't matter (e.g. for counting the matching rows), pass ``order_by=None`` - so an index
+        covering a filter is preferred over one which would only help with sorting.
+        """
+        eqs, ranges, ins = {}, {}, []
+        for c in conditions:
+            if c.op == 'eq' and c.field not in eqs:
+                eqs[c.field] = c
+            elif c.op in ('le', 'ge'):
+                # Only the first lower/upper bound per field can be used by an index - any others are filtered
+                if not any(r.op == c.op for r in ranges.get(c.field, [])):
+                    ranges.setdefault(c.field, []).append(c)
+            elif c.op == 'in' and c.field == PRIMARY_KEY:
+                ins.append(c)
+
+        # The rarest value of a multi index (e.g. search token) that's known to be selective enough to look up
+        lookups = [
+            c for c in conditions if c.op == 'contains' and c.field in self.multi
+            and c.estimate is not None and c.estimate < MULTI_INDEX_MAX_ROWS
+        ]
+        lookup = min(lookups, key=lambda c: c.estimate) if len(lookups) > 0 else None
+
+        best = None
+        if PRIMARY_KEY in eqs:
+            best = (None, QueryPlan(order_by=order_by, index=PRIMARY_KEY, get_all=eqs[PRIMARY_KEY].value),
+                    [eqs[PRIMARY_KEY]])
+        elif len(ins) > 0:
+            keys = min(ins, key=lambda c: len(c.value))
+            best = (None, QueryPlan(order_by=order_by, index=PRIMARY_KEY, get_all_keys=tuple(keys.value)), [keys])
+        elif lookup is not None:
+            best = (None, QueryPlan(order_by=order_by, index=self.multi[lookup.field], get_all=lookup.value), [lookup])
+        else:
+            for name, fields in self.indexes.items():
+                if name in self.multi.values():
+                    continue
+                cand = self._candidate(name, fields, eqs, ranges, order_by)
+                if cand is not None and (best is None or cand[0] > best[0]):
+                    best = cand
+
+        if best is None:
+            plan, used = QueryPlan(order_by=order_by), []
+        else:
+            _, plan, used = best
+        plan.order_dir = order_dir
+        plan.filters = [c for c in conditions if not any(c is u for u in used)]
+        return plan
@@ -0,0 +1,102 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Full-text search over the log lines and status message of each email.
+
+The importer stores the distinct words ("tokens") of each message in it's ``tokens`` field, which has a RethinkDB
+multi index - so the index holds a list of messages for each token (a posting list). A search for
+``550 5.1.1 user unknown`` looks up the messages for the rarest of those tokens with ``get_all``, and keeps
+the ones containing the other tokens too (see :class:`.QueryPlanner`).
+
+    >>> sorted(tokenize('status=bounced (host mx1.gmail.com said: 550 5.1.1 user unknown)'))
+    ['5.1.1', '550', 'bounced', 'com', 'gmail', 'gmail.com', 'host', 'mx1', 'mx1.gmail.com', 'said',
+     'status', 'unknown', 'user']
+    >>> search_conditions('550 5.1.1 user unknown')
+    [Condition(field='tokens', op='contains', value='550', estimate=None), ...]
+
+"""
+import re
+from functools import lru_cache
+from typing import Iterable, List, Mapping, Set, Tuple
+
+from postfixparser.exceptions import APIException
+from postfixparser.query import Condition
+
+TOKENS_FIELD = 'tokens'
+
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 64
+MAX_TOKENS = 256
+"""The most tokens stored per message - any more (sorted alphabetically) aren't searchable"""
+
+_WORD = re.compile(r'[a-z0-9]+(?:[._@+\-][a-z0-9]+)*')
+"""Words, including ones joined by ``.`` / ``@`` etc. such as ``5.1.1``, ``1.2.3.4`` and ``john@example.com``"""
+_SEPARATORS = re.compile(r'[._@+\-]')
+_LETTER = re.compile(r'[a-z]')
+
+
+def _expand(word: str) -> Iterable[str]:
+    """
+    Yield ``word``, and for joined words, each part of it - plus for domains, each domain suffix, so that
+    ``gmail.com`` finds ``mx1.gmail.com`` and ``john@gmail.com``
+    """
+    yield word
+    if _SEPARATORS.search(word) is None:
+        return
+    for side in word.split('@'):
+        labels = side.split('.')
+        # Only for domains - the suffixes of IPs, status codes etc. aren't useful
+        if len(labels) > 2 and _LETTER.search(side) is not None:
+            for i in range(1, len(labels) - 1):
+                yield '.'.join(labels[i:])
+        if side != word:
+            yield side
+        yield from _SEPARATORS.split(side)
+
+
+@lru_cache(maxsize=65536)
+def _word_tokens(word: str) -> Tuple[str, ...]:
+    return tuple(t for t in set(_expand(word)) if MIN_TOKEN_LENGTH <= len(t) <= MAX_TOKEN_LENGTH)
+
+
+def tokenize(text: str) -> Set[str]:
+    """The set of searchable tokens in ``text`` (lowercased)"""
+    tokens = set()
+    # Words repeat a lot, both across the lines of a message and between messages, so their expansions are cached
+    for word in set(_WORD.findall(text.lower())):
+        tokens.update(_word_tokens(word))
+    return tokens
+
+
+def message_tokens(msg: Mapping) -> List[str]:
+    """The tokens to store in the :attr:`.TOKENS_FIELD` of the ``sent_mail`` document ``msg``"""
+    texts = [(msg.get('status') or {}).get('message') or '']
+    texts += [line.get('message') or '' for line in msg.get('lines') or []]
+    return sorted(tokenize('\n'.join(texts)))[:MAX_TOKENS]
+
+
+def search_conditions(q: str) -> List[Condition]:
+    """
+    Turn the search query ``q`` into a ``contains`` :class:`.Condition` per token - messages must contain every token.
+    Unlike :func:`.tokenize`, joined words aren't split, so ``5.1.1`` only finds ``5.1.1``.
+    """
+    words = []
+    for w in _WORD.findall(q.lower()):
+        if MIN_TOKEN_LENGTH <= len(w) <= MAX_TOKEN_LENGTH and w not in words:
+            words.append(w)
+    if len(words) == 0:
+        raise APIException('INVALID_FILTER', f"The search '{q}' doesn't contain any searchable words")
+    return [Condition(TOKENS_FIELD, 'contains', w) for w in words]
@@ -16,6 +16,7 @@ Copyright::
 
 """
 from collections import namedtuple
+from os.path import abspath, dirname, join
 from typing import List, Dict
 
 import pytz
@@ -25,6 +26,8 @@ from privex.helpers import env_bool, env_csv, env_int
 
 load_dotenv()
 
+BASE_DIR = dirname(dirname(abspath(__file__)))
+
 DEBUG = env_bool('DEBUG', False)
 
 vue_debug = env_bool('VUE_DEBUG', False)
@@ -37,12 +40,140 @@ rethink_host = env('RETHINK_HOST', 'localhost')
 rethink_port = int(env('RETHINK_PORT', 28015))
 rethink_db = env('RETHINK_DB', 'maildata')
 
+rethink_pool_min = env_int('RETHINK_POOL_MIN', 1)
+"""Connections each process opens to RethinkDB up-front (more are opened on demand, up to ``RETHINK_POOL_MAX``)"""
+rethink_pool_max = env_int('RETHINK_POOL_MAX', 10)
+"""Maximum connections each process (i.e. each Web UI worker, or the importer) will open to RethinkDB"""
+rethink_pool_timeout = float(env('RETHINK_POOL_TIMEOUT', 10.0))
+"""
+Seconds to wait for a free connection (or to connect / health check one) before giving up on a query. Web UI
+requests which time out get a ``503``.
+"""
+rethink_pool_check_interval = float(env('RETHINK_POOL_CHECK_INTERVAL', 30.0))
+"""
+Connections which have been idle for longer than this many seconds are pinged before being used, and replaced if
+they don't answer (e.g. after RethinkDB was restarted).
+"""
+
+storage_backend = env('STORAGE_BACKEND', 'rethinkdb').lower()
+"""
+Where imported messages are stored - ``rethinkdb`` (default), or ``sqlite`` for an embedded database file at
+``SQLITE_PATH``, which needs no DB server (see :mod:`postfixparser.storage`)
+"""
+sqlite_path = env('SQLITE_PATH', join(BASE_DIR, 'maildata.sqlite3'))
+sqlite_timeout = float(env('SQLITE_TIMEOUT', 30.0))
+"""Seconds to wait for another process's write lock on the SQLite database before giving up"""
+sqlite_readers = env_int('SQLITE_READERS', 4)
+"""Threads running SQLite read queries in each process (writes always go through a single thread)"""
+
 rethink_tables = [
-    ('sent_mail', ['mail_to', 'timestamp', 'first_attempt', 'last_attempt']),
+    ('sent_mail', [
+        'mail_to', 'timestamp', 'first_attempt', 'last_attempt',
+        # Compound indexes are ``(name, [field, field])`` - they let the Web UI filter by the first field, and
+        # page through the results ordered by the second, without scanning or sorting the whole table.
+        ('status_last_attempt', ['status.code', 'last_attempt']),
+        ('mail_to_last_attempt', ['mail_to', 'last_attempt']),
+        ('mail_from_last_attempt', ['mail_from', 'last_attempt']),
+        # Indexes over the lowercase parts of each address (see query.address_fields), which serve wildcard filters
+        # such as mail_to=*@example.com / mail_from=bob*
+        ('mail_to_local_last_attempt', ['mail_to_local', 'last_attempt']),
+        ('mail_to_domain_last_attempt', ['mail_to_domain', 'last_attempt']),
+        ('mail_to_rdomain_last_attempt', ['mail_to_rdomain', 'last_attempt']),
+        ('mail_from_local_last_attempt', ['mail_from_local', 'last_attempt']),
+        ('mail_from_domain_last_attempt', ['mail_from_domain', 'last_attempt']),
+        ('mail_from_rdomain_last_attempt', ['mail_from_rdomain', 'last_attempt']),
+        # A multi index over the words of each message's log lines / status, for full-text search (?q=)
+        ('tokens', ['tokens'], {'multi': True}),
+    ]),
+    # Hourly / daily rollups maintained by the importer (see postfixparser.stats)
+    ('mail_stats', [
+        ('stats_series', ['period', 'dimension', 'value', 'bucket']),
+        ('stats_range', ['period', 'dimension', 'bucket']),
+    ]),
+    # A record per recipient of each message, so every recipient can be searched for (see postfixparser.deliveries)
+    ('deliveries', [
+        'queue_id', 'recipient', 'recipient_domain', 'recipient_rdomain',
+        ('recipient_local_domain', ['recipient_local', 'recipient_domain']),
+    ]),
 ]
+"""
+The tables to create, with their secondary indexes. An index is either a field name, or for compound indexes, a
+tuple of the index name and the (``x.y`` style) fields it covers - optionally followed by a dict of extra
+``index_create`` options. :mod:`postfixparser.query` uses these to plan queries.
+"""
 
 mail_log = env('MAIL_LOG', '/var/log/mail.log')
 
+flush_idle_minutes = env_int('FLUSH_IDLE_MINUTES', 60)
+"""
+While importing, a message is written to the DB (and released from memory) as soon as Postfix logs that it was
+``removed`` from the queue, or once no lines have been logged for it for this many minutes (e.g. a deferred
+message waiting to be retried). Any lines logged for it later on are merged into the stored message.
+"""
+
+parallel_chunk_size = env_int('PARALLEL_CHUNK_SIZE', 64)
+"""When parsing with ``--workers``, log files are split into byte ranges of at most this many megabytes"""
+
+write_batch_size = env_int('WRITE_BATCH_SIZE', 500)
+"""Maximum number of messages sent to RethinkDB in a single ``insert()`` query"""
+write_concurrency = env_int('WRITE_CONCURRENCY', 4)
+"""Maximum number of insert batches which may be in-flight at the same time"""
+write_queue_size = env_int('WRITE_QUEUE_SIZE', 4)
+"""
+Maximum number of parsed batches waiting for a free writer. Once the queue is full (i.e. the DB has fallen behind),
+the importer pauses reading the log until a batch has been written, rather than buffering the log in memory.
+"""
+write_retries = env_int('WRITE_RETRIES', 3)
+"""How many times a batch insert should be retried after a transient RethinkDB error"""
+write_retry_delay = float(env('WRITE_RETRY_DELAY', 0.5))
+"""Seconds to wait before the first retry of a failed batch. Doubles after each failed attempt."""
+
+checkpoint_file = env('CHECKPOINT_FILE', join(BASE_DIR, '.mail_log_checkpoint'))
+"""
+The file used to store the import checkpoint (inode + byte offset of ``MAIL_LOG`` that was last read, and any
+messages which are still in the Postfix queue), so that each ``parse`` run only has to read new log lines.
+"""
+
+checkpoint_max_age = env_int('CHECKPOINT_MAX_AGE', 120)
+"""
+Messages carried over in the checkpoint are dropped if their last log line is older than this many hours.
+Defaults to 120 hours (5 days), matching Postfix's default ``maximal_queue_lifetime``.
+"""
+
+fingerprint_cache = env('FINGERPRINT_CACHE', join(BASE_DIR, '.import_fingerprints.sqlite3'))
+"""
+A local SQLite file holding the fingerprint of each message the importer last wrote, so messages which haven't
+changed since (e.g. when re-importing a log with ``--full`` or ``--glob``) aren't written again - see
+:mod:`postfixparser.fingerprints`. Set to an empty string to disable.
+"""
+fingerprint_cache_days = env_int('FINGERPRINT_CACHE_DAYS', 30)
+"""Fingerprints of messages which haven't been written for this many days are dropped from the cache"""
+
+metrics_file = env('METRICS_FILE', join(BASE_DIR, '.import_metrics.json'))
+"""
+Each import run adds it's metrics (lines read, regex misses, stage timings, DB write latency etc.) into this JSON
+file, which the Web UI serves in the Prometheus format at ``/metrics``.
+"""
+metrics_sample_every = env_int('METRICS_SAMPLE_EVERY', 100)
+"""Only every Nth log line has it's read / match / parse time measured, to keep the overhead of metrics low"""
+metrics_token = env('METRICS_TOKEN', '')
+"""If set, requests to ``/metrics`` must include the header ``Authorization: Bearer <METRICS_TOKEN>``"""
+metrics_public = env_bool('METRICS_PUBLIC', False)
+"""
+``/metrics`` returns 404 unless :attr:`.metrics_token` is set. Set this to ``True`` to serve it to anyone
+without a token instead - only do this if the Web UI can't be reached from untrusted networks.
+"""
+
+follow_poll_interval = float(env('FOLLOW_POLL_INTERVAL', 1.0))
+"""``manage.py follow`` checks ``MAIL_LOG`` for new lines (and log rotation) every this many seconds"""
+follow_flush_interval = float(env('FOLLOW_FLUSH_INTERVAL', 2.0))
+"""
+``manage.py follow`` writes a batch to the DB once it holds ``WRITE_BATCH_SIZE`` messages, or this many seconds
+after the first message was added to it - whichever comes first.
+"""
+follow_checkpoint_interval = float(env('FOLLOW_CHECKPOINT_INTERVAL', 30.0))
+"""How often (in seconds) ``manage.py follow`` saves it's position in ``MAIL_LOG`` to the checkpoint file"""
+
 
 admin_pass = env('ADMIN_PASS', 'SetThis!InYourEnv')
 secret_key = env('SECRET_KEY', 'SetThis!InYourEnv')
@@ -57,11 +188,53 @@ ignore_domains = env_csv('IGNORE_DOMAINS', ['localhost', '127.0.0.1'])
 default_limit = env_int('DEFAULT_LIMIT', 50)
 max_limit = env_int('MAX_LIMIT', 1000)
 
+count_cache_ttl = env_int('COUNT_CACHE_TTL', 60)
+"""
+The total number of results for each set of filters on ``/api/emails`` is cached for this many seconds (or until the
+next import finishes), so paging through results doesn't re-count them every time. Set to ``0`` to disable.
+"""
+count_cache_size = env_int('COUNT_CACHE_SIZE', 1000)
+"""Maximum number of distinct filter combinations to keep cached counts for"""
+recipient_lookup_max = env_int('RECIPIENT_LOOKUP_MAX', 10000)
+"""
+Recipient filters on ``/api/emails`` (e.g. ``mail_to=*@example.com``) match any recipient of a message, by looking
+up the queue IDs in the ``deliveries`` table first. If more than this many messages match, the filter only matches
+each message's last recipient instead, as the queue IDs would be too many to look up at once.
+"""
+count_cap = env_int('COUNT_CAP', 0)
+"""
+If set, counts for filters which can't be answered from an index alone stop at this many results, and the Web UI
+shows e.g. "10000+" instead of the exact total. ``0`` always counts exactly.
+"""
+response_cache_ttl = env_int('RESPONSE_CACHE_TTL', 30)
+"""
+Identical ``/api/emails`` requests are answered from a cache for this many seconds, or until the importer next
+writes to the DB. Set to ``0`` to disable.
+"""
+response_cache_size = env_int('RESPONSE_CACHE_SIZE', 256)
+"""Maximum number of responses to cache (per Web UI worker, and in ``RESPONSE_CACHE_DIR``)"""
+response_cache_dir = env('RESPONSE_CACHE_DIR', '')
+"""
+If set, cached responses are also stored as files in this folder, so they're shared by every Web UI worker process.
+Use a folder on a tmpfs, e.g. ``/dev/shm/postfix-parser``.
+"""
+generation_file = env('GENERATION_FILE', join(BASE_DIR, '.import_generation'))
+"""The importer increments the number in this file after writing to the DB, so the Web UI knows to drop it's caches"""
+stats_rollups = env_bool('STATS_ROLLUPS', True)
+"""
+If True, the importer keeps the hourly / daily counts in the ``mail_stats`` table up to date as it writes messages
+(see :mod:`postfixparser.stats`). After enabling it on an existing DB, run ``./manage.py rebuild_stats`` once.
+"""
+
 AppError = namedtuple('AppError', 'code message status', defaults=['', 500])
 _ERRORS: List[AppError] = [
     AppError('UNKNOWN_ERROR', "An unknown error has occurred. Please contact the administrator of this site.", 500),
     AppError('NOT_FOUND', "The requested resource or URL was not found. You may wish to check the URL for typos.", 404),
     AppError('METHOD_NOT_ALLOWED', "This API endpoint does not allow the requested HTTP method (GET/POST/PUT etc.)", 405),
+    AppError('INVALID_FILTER', "One or more of the filters in your query were invalid.", 400),
+    AppError('INVALID_CURSOR', "The pagination cursor is invalid.", 400),
+    AppError('INVALID_FORMAT', "The requested export format is not supported.", 400),
+    AppError('DB_UNAVAILABLE', "The database is busy or unavailable. Please try again shortly.", 503),
 ]
 ERRORS: Dict[str, AppError] = {err.code: err for err in _ERRORS}
 DEFAULT_ERR: AppError = ERRORS['UNKNOWN_ERROR']
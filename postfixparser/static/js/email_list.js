@@ -16,7 +16,9 @@ window.addEventListener('load', () => {
             status_filter: "NOFILTER",
             page: 1,
             page_count: 1,
+            page_count_exact: true,
             page_reset: false,
+            cursors: {},
             msg: {},
             settings: {
                 page_limit: 20
@@ -74,6 +76,7 @@ window.addEventListener('load', () => {
                 this.page_reset = true;
                 this.page_count = 1;
                 this.page = 1;
+                this.cursors = {};
                 this.page_reset = false;
             },
             loadEmails() {
@@ -88,12 +91,23 @@ window.addEventListener('load', () => {
 
                 url += (queries === 0) ? '?' : '&';
                 url += `page=${this.page}&limit=${this.settings.page_limit}`;
+                // Pages we've already reached (via "next") have a cursor, which is much faster than skipping rows
+                let page = this.page;
+                if (page > 1 && this.cursors[page]) {
+                    url += `&cursor=${encodeURIComponent(this.cursors[page])}`;
+                }
 
                 return fetch(url).then(function (response) {
                     return response.json();
                 }).then((res) => {
                     this.emails = res['result'];
-                    this.page_count = res['total_pages'];
+                    // Capped counts (COUNT_CAP) are a lower bound, so allow paging on while there's a next page
+                    this.page_count_exact = res['count_exact'] !== false;
+                    this.page_count = this.page_count_exact ? res['total_pages'] :
+                        Math.max(res['total_pages'], page + (res['next_cursor'] ? 1 : 0));
+                    if (res['next_cursor']) {
+                        this.cursors[page + 1] = res['next_cursor'];
+                    }
                     this.loading = false;
                 }).catch((res) => {
                     console.error('Error:', res);
@@ -104,8 +118,17 @@ window.addEventListener('load', () => {
                 let newdate = `${d.toLocaleString()}`
             },
             show_modal(m) {
-                this.msg = m;
+                // The list only includes summary fields, so fetch the full email (with it's log lines) on demand
+                this.msg = Object.assign({}, m, {lines: null});
                 $('#mail-modal').modal('show');
+                return fetch(`${base_url}/${encodeURIComponent(m.id)}`).then(function (response) {
+                    return response.json();
+                }).then((res) => {
+                    if (res['error'] || this.msg.id !== m.id) return;
+                    this.msg = res['result'];
+                }).catch((res) => {
+                    console.error('Error:', res);
+                });
             },
             settings_saved(val) {
                 this.onSettingsUpdated(val);
@@ -124,6 +147,7 @@ window.addEventListener('load', () => {
                 this.settings = v;
                 this.loaded_settings = true;
                 if (updatePage) {
+                    this.cursors = {};
                     console.log("[onSettingsUpdated] calling debounce_emails");
                     debounce_emails();
                 }
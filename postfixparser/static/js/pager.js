@@ -6,7 +6,7 @@ window.addEventListener('load', () => {
                 <i class="left chevron icon"/>Previous Page
             </button>
             <button class="ui button disabled">
-                <i class="page icon"/><strong>Page {{ page }} of {{ pageCount }}</strong>
+                <i class="page icon"/><strong>Page {{ page }} of {{ pageCount }}{{ exact ? '' : '+' }}</strong>
             </button>
             <button class="ui right labeled icon button" :class="{disabled: !has_next}" 
                     @click="$emit('input', page + 1);">
@@ -22,6 +22,10 @@ window.addEventListener('load', () => {
             pageCount: {
                 default: 1,
                 type: Number
+            },
+            exact: {
+                default: true,
+                type: Boolean
             }
         },
         computed: {
@@ -0,0 +1,228 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Pre-aggregated message counts per hour / day ("rollups"), which ``/api/stats`` charts from without touching the
+``sent_mail`` table.
+
+The rollup table :attr:`.STATS_TABLE` holds a document per period (``hour`` / ``day``), bucket (the start of the
+hour / day, in UTC), dimension (see :attr:`.DIMENSIONS`) and value, counting the messages in it by status code::
+
+    {'id': 'hour|2019-10-01T12|to_domain|gmail.com', 'period': 'hour', 'bucket': <2019-10-01 12:00 UTC>,
+     'dimension': 'to_domain', 'value': 'gmail.com', 'counts': {'sent': 120, 'bounced': 3}}
+
+Each message is counted once - in the bucket of it's ``last_attempt``, under it's current status. The importer
+inserts messages with ``return_changes``, and :func:`.rollup_deltas` turns every change into ``-1`` for the old
+version of the message and ``+1`` for the new one. So a deferred message which is later delivered moves from
+``deferred`` to ``sent`` rather than being counted twice, and re-importing unchanged messages changes nothing.
+
+    >>> deltas = rollup_deltas(res['changes'])
+    >>> await get_storage().insert(STATS_TABLE, list(deltas.values()), OnConflict.MERGE)
+
+"""
+import hashlib
+import logging
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from typing import Dict, Iterable, Mapping, Optional
+
+from postfixparser import settings
+from postfixparser.exceptions import APIException
+from postfixparser.query import Condition
+from postfixparser.storage import OnConflict, get_storage
+
+log = logging.getLogger(__name__)
+
+STATS_TABLE = 'mail_stats'
+
+PERIODS = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+"""The bucket sizes which are counted, and how long each bucket is"""
+
+DIMENSIONS = ('all', 'from_domain', 'to_domain', 'relay')
+"""
+What messages are broken down by. ``all`` has a single value (``''``) - the totals per status. ``relay`` is the
+host the message was delivered to (or last attempted).
+"""
+
+MAX_BUCKETS = 1000
+"""The most buckets a single ``/api/stats`` request may cover, e.g. ~41 days of hours"""
+
+
+def floor_time(ts: datetime, period: str) -> datetime:
+    """
+    The start of the ``period`` (in UTC) which ``ts`` falls in
+
+        >>> floor_time(datetime(2019, 10, 1, 12, 34, 56, tzinfo=timezone.utc), 'hour')
+        datetime.datetime(2019, 10, 1, 12, 0, tzinfo=datetime.timezone.utc)
+
+    """
+    ts = ts.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0) if period == 'day' else ts
+
+
+def _domain(addr: str) -> str:
+    return addr.rpartition('@')[2].lower() if '@' in addr else ''
+
+
+def dimension_values(msg: Mapping) -> Dict[str, str]:
+    """
+    The value of each of the :attr:`.DIMENSIONS` for the ``sent_mail`` document ``msg``
+
+        >>> dimension_values({'mail_from': 'john@Example.com', 'mail_to': 'jane@gmail.com', 'relay': {'host': 'mx1.gmail.com'}})
+        {'all': '', 'from_domain': 'example.com', 'to_domain': 'gmail.com', 'relay': 'mx1.gmail.com'}
+
+    """
+    relay = msg.get('relay') or {}
+    return {
+        'all': '',
+        'from_domain': _domain(msg.get('mail_from') or ''),
+        'to_domain': _domain(msg.get('mail_to') or ''),
+        'relay': str(relay.get('host') or '').lower(),
+    }
+
+
+def _doc_id(period: str, bucket: datetime, dimension: str, value: str) -> str:
+    key = f"{period}|{bucket.strftime('%Y-%m-%dT%H')}|{dimension}|{value}"
+    # RethinkDB primary keys are limited to 127 bytes, which a long domain could go over
+    return key if len(key.encode()) <= 127 else f"{period}|{bucket.strftime('%Y-%m-%dT%H')}|{dimension}|" \
+                                                 f"#{hashlib.sha1(value.encode()).hexdigest()}"
+
+
+def add_message(deltas: Dict[str, dict], msg: Optional[Mapping], sign: int = 1):
+    """Add ``sign`` (``1`` or ``-1``) to each rollup document in ``deltas`` which the message ``msg`` counts towards"""
+    if not msg:
+        return
+    ts = msg.get('last_attempt') or msg.get('timestamp')
+    if not isinstance(ts, datetime):
+        return
+    status = (msg.get('status') or {}).get('code') or 'unknown'
+    for period in PERIODS:
+        bucket = floor_time(ts, period)
+        for dimension, value in dimension_values(msg).items():
+            key = _doc_id(period, bucket, dimension, value)
+            doc = deltas.get(key)
+            if doc is None:
+                doc = deltas[key] = dict(id=key, period=period, bucket=bucket, dimension=dimension, value=value, counts={})
+            doc['counts'][status] = doc['counts'].get(status, 0) + sign
+
+
+def rollup_deltas(changes: Iterable[Mapping]) -> Dict[str, dict]:
+    """
+    Turn the ``changes`` returned by a ``sent_mail`` insert (with ``return_changes=True``) into the rollup documents
+    to add to :attr:`.STATS_TABLE` with :attr:`.OnConflict.MERGE`. Counts which cancel out are left out.
+    """
+    deltas = {}
+    for c in changes:
+        add_message(deltas, c.get('old_val'), -1)
+        add_message(deltas, c.get('new_val'), 1)
+    for key in list(deltas.keys()):
+        counts = {s: n for s, n in deltas[key]['counts'].items() if n != 0}
+        if len(counts) == 0:
+            del deltas[key]
+        else:
+            deltas[key]['counts'] = counts
+    return deltas
+
+
+async def rebuild_stats(batch_size: int = None) -> int:
+    """
+    Recount :attr:`.STATS_TABLE` from scratch, from every message in ``sent_mail`` (a full table scan). Use this
+    to fill in the rollups for messages imported before they existed - with the importer stopped, as anything it
+    writes during the rebuild may be counted twice, or not at all.
+
+    :return int docs: The number of rollup documents written
+    """
+    store = get_storage()
+    batch_size = settings.write_batch_size if batch_size is None else batch_size
+    deltas, msgs = {}, 0
+    async for msg in store.scan('sent_mail', fields=('mail_from', 'mail_to', 'relay', 'status', 'timestamp', 'last_attempt')):
+        add_message(deltas, msg)
+        msgs += 1
+    log.info('Counted %d messages into %d rollup documents. Replacing the contents of %s...', msgs, len(deltas), STATS_TABLE)
+    await store.delete_all(STATS_TABLE)
+    docs = iter(deltas.values())
+    while True:
+        batch = list(islice(docs, batch_size))
+        if len(batch) == 0:
+            break
+        await store.insert(STATS_TABLE, batch, OnConflict.REPLACE)
+    return len(deltas)
+
+
+def parse_range(period: str, start: Optional[datetime], end: Optional[datetime], now: datetime = None):
+    """
+    Fill in the defaults for a stats time range (the last 24 hours for ``hour``, or 30 days for ``day``), and
+    floor both ends to the start of their bucket.
+
+    :return tuple range: ``(start, end, buckets)`` - where ``buckets`` lists every bucket from start to end
+    """
+    size = PERIODS[period]
+    end = floor_time(datetime.now(timezone.utc) if now is None else now, period) if end is None else floor_time(end, period)
+    start = end - size * (23 if period == 'hour' else 29) if start is None else floor_time(start, period)
+    if start > end:
+        raise APIException('INVALID_FILTER', "'start' must be before 'end'")
+    count = int((end - start) / size) + 1
+    if count > MAX_BUCKETS:
+        raise APIException('INVALID_FILTER', f"The time range covers {count} {period}s - the maximum is {MAX_BUCKETS}")
+    return start, end, [start + size * i for i in range(count)]
+
+
+async def query_stats(period: str = 'hour', dimension: str = 'all', start: datetime = None, end: datetime = None,
+                      value: str = None, status: str = None, top: int = 10) -> dict:
+    """
+    Chart data from the rollups - a series per value of ``dimension`` (the ``top`` values with the most messages,
+    or just ``value`` if given), with the number of messages in each bucket between ``start`` and ``end``.
+
+        >>> await query_stats('hour', 'to_domain', value='gmail.com', status='bounced')
+        {'period': 'hour', 'dimension': 'to_domain', 'status': 'bounced', 'buckets': [datetime(...), ...],
+         'series': [{'value': 'gmail.com', 'total': 12, 'counts': {'bounced': 12}, 'totals': [0, 3, ...],
+                     'by_status': {'bounced': [0, 3, ...]}}]}
+
+    Each list in ``totals`` / ``by_status`` has a number for every bucket in ``buckets`` (zero where nothing was
+    counted), so they can be passed straight to a chart.
+    """
+    if period not in PERIODS:
+        raise APIException('INVALID_FILTER', f"Unknown period '{period}' - must be one of: {', '.join(PERIODS)}")
+    if dimension not in DIMENSIONS:
+        raise APIException('INVALID_FILTER', f"Unknown dimension '{dimension}' - must be one of: {', '.join(DIMENSIONS)}")
+    start, end, buckets = parse_range(period, start, end)
+    value = '' if dimension == 'all' else value
+
+    conds = [Condition('period', 'eq', period), Condition('dimension', 'eq', dimension),
+             Condition('bucket', 'ge', start), Condition('bucket', 'le', end)]
+    if value is not None:
+        conds.append(Condition('value', 'eq', value.lower()))
+    docs = get_storage().find(STATS_TABLE, conds, fields=('bucket', 'value', 'counts'))
+
+    positions = {b: i for i, b in enumerate(buckets)}
+    series: Dict[str, dict] = {}
+    async for doc in docs:
+        counts = {s: n for s, n in doc['counts'].items() if status is None or s == status}
+        i = positions.get(floor_time(doc['bucket'], period))
+        if i is None:
+            continue
+        s = series.get(doc['value'])
+        if s is None:
+            s = series[doc['value']] = dict(value=doc['value'], total=0, counts={}, totals=[0] * len(buckets), by_status={})
+        for code, n in counts.items():
+            s['total'] += n
+            s['counts'][code] = s['counts'].get(code, 0) + n
+            s['totals'][i] += n
+            s['by_status'].setdefault(code, [0] * len(buckets))[i] += n
+
+    ranked = sorted(series.values(), key=lambda x: (-x['total'], x['value']))
+    return dict(period=period, dimension=dimension, status=status, buckets=buckets,
+                series=ranked if value is not None else ranked[:max(top, 1)])
+
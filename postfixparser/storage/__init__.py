@@ -0,0 +1,58 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Storage backends for the imported messages and stats rollups. The importer, Web UI and ``manage.py`` commands
+only talk to the DB through a :class:`.Storage`, picked by :attr:`.settings.storage_backend`:
+
+ - ``rethinkdb`` - :class:`.RethinkStorage` (the default)
+ - ``sqlite`` - :class:`.SQLiteStorage`, an embedded database file at :attr:`.settings.sqlite_path`
+
+    >>> store = get_storage()
+    >>> await store.bootstrap()
+    >>> res = await store.insert('sent_mail', docs, OnConflict.MERGE)
+    >>> await store.count('sent_mail', parse_filters({'status.code': 'bounced'}))
+    (12, True)
+
+"""
+from typing import Dict
+
+from postfixparser import settings
+from postfixparser.storage.base import OnConflict, Storage
+from postfixparser.storage.rethink import RethinkStorage, merge_counts, merge_message
+from postfixparser.storage.sqlite import SQLiteStorage
+
+BACKENDS = {'rethinkdb': RethinkStorage, 'sqlite': SQLiteStorage}
+
+__STORE: Dict[str, Storage] = {}
+
+
+def get_storage(backend: str = None) -> Storage:
+    """
+    The storage backend named ``backend`` (default: :attr:`.settings.storage_backend`), created on the first
+    call in each process
+    """
+    backend = settings.storage_backend if backend is None else backend
+    if backend not in __STORE:
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown STORAGE_BACKEND '{backend}' - must be one of: {', '.join(BACKENDS)}")
+        __STORE[backend] = BACKENDS[backend]()
+    return __STORE[backend]
+
+
+__all__ = [
+    'BACKENDS', 'OnConflict', 'RethinkStorage', 'SQLiteStorage', 'Storage', 'get_storage', 'merge_counts',
+    'merge_message',
+]
@@ -0,0 +1,121 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+The interface which each storage backend implements. Queries are described with the same :class:`.Condition`'s that
+the API parses from the query string (see :mod:`postfixparser.query`), so every backend gives the same results
+for the same ``/api/emails`` filters.
+
+"""
+from enum import Enum
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Sequence, Tuple, Type
+
+from postfixparser.query import MULTI_INDEX_MAX_ROWS, Condition
+
+
+class OnConflict(Enum):
+    QUIET = "quiet"
+    EXCEPT = "except"
+    UPDATE = "update"
+    """Update the stored document with the fields of the new one"""
+    REPLACE = "replace"
+    """Replace the stored document with the new one"""
+    MERGE = "merge"
+    """
+    Merge the new document into the stored one the way that table needs - log lines are appended to a ``sent_mail``
+    message (see :func:`.merge_message`), counts are added together in the ``mail_stats`` rollups, and the latest
+    attempt is kept for each ``deliveries`` record
+    """
+
+
+class Storage:
+    """
+    A place to store and query the imported messages (``sent_mail``), their per-recipient ``deliveries``, and their
+    stats rollups (``mail_stats``).
+
+    Documents are plain dicts keyed by ``id``, with :class:`datetime.datetime`'s for the time fields. The
+    :attr:`.convert_time` function is applied to times in documents before they're passed to :meth:`.insert`.
+    """
+    name = 'base'
+
+    transient_errors: Tuple[Type[Exception], ...] = ()
+    """Exceptions which are likely to be temporary, so failed writes should be retried"""
+
+    convert_time: Callable[[Any], Any] = staticmethod(lambda dt: dt)
+
+    @property
+    def location(self) -> str:
+        """A URL identifying the database this backend stores data in, e.g. ``sqlite:///srv/maildata.sqlite3``"""
+        raise NotImplementedError
+
+    async def bootstrap(self):
+        """Create the tables and indexes from :attr:`.settings.rethink_tables` if they don't exist yet"""
+        raise NotImplementedError
+
+    async def close(self):
+        """Release any connections / file handles held by this backend"""
+
+    async def insert(self, table: str, docs: List[dict], conflict: OnConflict = OnConflict.UPDATE,
+                     return_changes: bool = False) -> Dict[str, Any]:
+        """
+        Insert (or upsert, depending on ``conflict``) ``docs`` into ``table`` as a single batch.
+
+        :return dict res: The number of documents ``inserted``, ``replaced``, ``unchanged`` and ``errors``
+                          (plus ``first_error`` if there were any). With ``return_changes``, ``changes`` holds an
+                          ``{'old_val': ..., 'new_val': ...}`` dict for each changed document.
+        """
+        raise NotImplementedError
+
+    async def get(self, table: str, doc_id: str) -> Optional[dict]:
+        """The document with the ID ``doc_id``, or ``None`` if it doesn't exist"""
+        raise NotImplementedError
+
+    async def delete_all(self, table: str):
+        """Delete every document in ``table``"""
+        raise NotImplementedError
+
+    def find(self, table: str, conditions: List[Condition], order_by: Optional[str] = None, order_dir: str = 'desc',
+             after: Tuple[Any, str] = None, offset: int = 0, limit: int = None, fields: Sequence[str] = None,
+             strict_order: bool = True) -> AsyncGenerator[dict, None]:
+        """
+        Stream the documents in ``table`` matching all of ``conditions``.
+
+        :param order_by:      Order the documents by this (``x.y`` style) field, ties broken by ``id``. ``None`` for any order.
+        :param after:         A ``(sort key, id)`` from :func:`.decode_cursor` - only return documents after that one
+        :param fields:        Only return these top-level fields of each document (default: all)
+        :param strict_order:  If ``False``, the backend may skip the ordering when it can't be read from an index
+                              (e.g. for exports)
+        """
+        raise NotImplementedError
+
+    async def count(self, table: str, conditions: List[Condition], cap: int = 0) -> Tuple[int, bool]:
+        """
+        Count the documents in ``table`` matching all of ``conditions``. If ``cap`` is more than zero, the backend may
+        stop counting at ``cap`` when the count can't be read from an index.
+
+        :return tuple count: ``(count, exact)`` - ``exact`` is ``False`` if the count was capped
+        """
+        raise NotImplementedError
+
+    async def estimate(self, table: str, conditions: List[Condition], limit: int = MULTI_INDEX_MAX_ROWS) -> int:
+        """
+        Roughly how many documents match ``conditions`` (which must be covered by a single index - e.g. a search
+        token, or the two bounds of an address range), counting at most ``limit``
+        """
+        raise NotImplementedError
+
+    def scan(self, table: str, fields: Sequence[str] = None) -> AsyncGenerator[dict, None]:
+        """Stream every document in ``table`` (only ``fields``, if given)"""
+        return self.find(table, [], fields=fields)
@@ -0,0 +1,165 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+The RethinkDB storage backend (the default). Queries are planned onto the table's indexes by the
+:class:`.QueryPlanner`, and run on the connection pool from :func:`.get_rethink`.
+
+"""
+import logging
+from typing import Any, AsyncGenerator, Dict, List, Optional, Sequence, Tuple
+
+from rethinkdb import r as rq
+from rethinkdb.errors import ReqlAvailabilityError, ReqlTimeoutError
+
+from postfixparser import settings
+from postfixparser.core import bootstrap_db, get_rethink
+from postfixparser.query import MULTI_INDEX_MAX_ROWS, Condition, QueryPlan, QueryPlanner
+from postfixparser.search import TOKENS_FIELD
+from postfixparser.storage.base import OnConflict, Storage
+
+log = logging.getLogger(__name__)
+
+
+def merge_message(_id, old, new):
+    """
+    RethinkDB conflict function for ``sent_mail``, which merges a newly imported message into the stored copy.
+
+    Empty fields in ``new`` don't overwrite the stored values, and stored log lines from before the first line
+    of ``new`` are kept. Re-importing the same lines replaces them, while a continuation (the later lines of a message
+    which was flushed as idle) is appended to the stored lines.
+    """
+    non_empty = new.keys().filter(lambda k: (new[k] != '') & (new[k] != {}))
+    return old.merge(new.pluck(rq.args(non_empty))).merge({
+        'timestamp': rq.branch(old['timestamp'] < new['timestamp'], old['timestamp'], new['timestamp']),
+        'first_attempt': rq.branch(old['first_attempt'] < new['first_attempt'], old['first_attempt'], new['first_attempt']),
+        'lines': old['lines'].filter(lambda l: l['timestamp'] < new['first_attempt']).add(new['lines']),
+        TOKENS_FIELD: old[TOKENS_FIELD].default([]).set_union(new[TOKENS_FIELD].default([])),
+    })
+
+
+def merge_counts(_id, old, new):
+    """RethinkDB conflict function for ``mail_stats``, which adds the counts of ``new`` onto the stored counts"""
+    return old.merge({
+        'counts': new['counts'].keys().map(
+            lambda k: [k, old['counts'][k].default(0).add(new['counts'][k])]
+        ).coerce_to('object')
+    })
+
+
+def merge_delivery(_id, old, new):
+    """
+    RethinkDB conflict function for ``deliveries``, which keeps whichever of the stored and new delivery records is
+    the latest attempt - so re-importing older lines doesn't overwrite a later delivery
+    """
+    return rq.branch(new['timestamp'] >= old['timestamp'], new, old)
+
+
+class RethinkStorage(Storage):
+    name = 'rethinkdb'
+    transient_errors = (ReqlAvailabilityError, ReqlTimeoutError)
+    convert_time = staticmethod(rq.expr)
+
+    CONFLICTS = {
+        OnConflict.QUIET: 'error', OnConflict.EXCEPT: 'error', OnConflict.UPDATE: 'update',
+        OnConflict.REPLACE: 'replace',
+    }
+    """Maps :class:`.OnConflict` to the equivalent RethinkDB ``insert(conflict=...)`` strategy"""
+    MERGERS = {'sent_mail': merge_message, 'mail_stats': merge_counts, 'deliveries': merge_delivery}
+    """The conflict function used for :attr:`.OnConflict.MERGE` on each table"""
+
+    def __init__(self):
+        self.planners: Dict[str, QueryPlanner] = {}
+
+    @property
+    def location(self) -> str:
+        return f'rethinkdb://{settings.rethink_host}:{settings.rethink_port}/{settings.rethink_db}'
+
+    def planner(self, table: str) -> QueryPlanner:
+        if table not in self.planners:
+            self.planners[table] = QueryPlanner.for_table(table)
+        return self.planners[table]
+
+    def plan(self, table: str, conditions: List[Condition], order_by: Optional[str] = None, order_dir: str = 'desc',
+             after: Tuple[Any, str] = None, strict_order: bool = True) -> QueryPlan:
+        """The :class:`.QueryPlan` used by :meth:`.find` for these arguments"""
+        plan = self.planner(table).plan(conditions, order_by=order_by, order_dir=order_dir)
+        if not strict_order and not plan.index_ordered:
+            plan = self.planner(table).plan(conditions, order_by=None)
+        plan.after = after if plan.order_by is not None else None
+        return plan
+
+    async def bootstrap(self):
+        await bootstrap_db()
+
+    async def insert(self, table: str, docs: List[dict], conflict: OnConflict = OnConflict.UPDATE,
+                     return_changes: bool = False) -> Dict[str, Any]:
+        r, conn, _ = await get_rethink()
+        r_conflict = self.MERGERS[table] if conflict == OnConflict.MERGE else self.CONFLICTS[conflict]
+        return await r.table(table).insert(docs, conflict=r_conflict, return_changes=return_changes).run(conn)
+
+    async def get(self, table: str, doc_id: str) -> Optional[dict]:
+        r, conn, _ = await get_rethink()
+        return await r.table(table).get(doc_id).run(conn)
+
+    async def delete_all(self, table: str):
+        r, conn, _ = await get_rethink()
+        await r.table(table).delete().run(conn)
+
+    async def find(self, table: str, conditions: List[Condition], order_by: Optional[str] = None,
+                   order_dir: str = 'desc', after: Tuple[Any, str] = None, offset: int = 0, limit: int = None,
+                   fields: Sequence[str] = None, strict_order: bool = True) -> AsyncGenerator[dict, None]:
+        r, conn, r_q = await get_rethink()
+        plan = self.plan(table, conditions, order_by, order_dir, after, strict_order)
+        log.debug('Query plan for %s %s: %s', table, conditions, plan)
+        query = plan.build(r.table(table), r_q, ordered=plan.order_by is not None)
+        if offset > 0:
+            query = query.skip(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        if fields is not None:
+            query = query.pluck(*fields)
+        cursor = await query.run(conn)
+        if isinstance(cursor, list):
+            for row in cursor:
+                yield row
+            return
+        try:
+            async for row in cursor:
+                yield row
+        finally:
+            # Stop the server-side cursor early if the caller stopped part way through (e.g. a client disconnected)
+            await cursor.close()
+
+    async def count(self, table: str, conditions: List[Condition], cap: int = 0) -> Tuple[int, bool]:
+        r, conn, r_q = await get_rethink()
+        plan = self.planner(table).plan(conditions, order_by=None)
+        query = plan.build(r.table(table), r_q, ordered=False)
+        # Counting an index range is cheap, but filtering means reading every row in it - so that's capped
+        if cap > 0 and len(plan.filters) > 0:
+            count = await query.limit(cap + 1).count().run(conn)
+            return (cap, False) if count > cap else (count, True)
+        return await query.count().run(conn), True
+
+    async def estimate(self, table: str, conditions: List[Condition], limit: int = MULTI_INDEX_MAX_ROWS) -> int:
+        r, conn, r_q = await get_rethink()
+        planner = self.planner(table)
+        if len(conditions) == 1 and conditions[0].op == 'contains' and conditions[0].field in planner.multi:
+            c = conditions[0]
+            query = r.table(table).get_all(c.value, index=planner.multi[c.field])
+        else:
+            query = planner.plan(conditions, order_by=None).build(r.table(table), r_q, ordered=False)
+        return await query.limit(limit).count().run(conn)
+
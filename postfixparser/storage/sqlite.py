@@ -0,0 +1,514 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+An embedded SQLite storage backend (``STORAGE_BACKEND=sqlite``), for small relays which don't want to run a
+separate DB server - and for running the importer / API without one (e.g. in CI).
+
+Each table from :attr:`.settings.rethink_tables` is an SQLite table holding the JSON of each document (``doc``),
+plus a column for each field covered by an index, which are indexed the same way as in RethinkDB. Multi indexes
+(the search ``tokens``) become a separate ``<table>__<index>`` table of ``(value, id)`` rows. Times are stored as
+UNIX epoch seconds, and turned back into :class:`datetime.datetime`'s when documents are read.
+
+The database runs in WAL mode, so the Web UI can read while the importer writes. Writes go through a single
+writer thread, with each batch upserted in one transaction.
+
+    >>> store = SQLiteStorage('/tmp/maildata.sqlite3')
+    >>> await store.bootstrap()
+    >>> await store.insert('sent_mail', [dict(id='ABCD1234', mail_to='john@example.com', ...)], OnConflict.MERGE)
+    >>> [m async for m in store.find('sent_mail', parse_filters({'mail_to': '*@example.com'}), 'last_attempt')]
+    [{'id': 'ABCD1234', 'mail_to': 'john@example.com', ...}]
+
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from queue import Empty, SimpleQueue
+from typing import Any, AsyncGenerator, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from postfixparser import settings
+from postfixparser.dates import from_epoch
+from postfixparser.exceptions import DatabaseLocked
+from postfixparser.query import MULTI_INDEX_MAX_ROWS, PRIMARY_KEY, TIME_FIELDS, Condition, index_options, index_spec
+from postfixparser.search import TOKENS_FIELD
+from postfixparser.storage.base import OnConflict, Storage
+
+log = logging.getLogger(__name__)
+
+TIME_KEYS = frozenset(TIME_FIELDS + ('bucket',))
+"""Keys (at any depth, e.g. each log line's ``timestamp``) whose values are times, stored as epoch seconds"""
+
+FETCH_ROWS = 500
+"""Rows fetched from SQLite per round trip to the reader thread, when streaming query results"""
+
+MAX_VARIABLES = 500
+"""The most ``?`` parameters used in a single ``IN (...)`` lookup - older SQLite versions allow at most 999"""
+
+
+def _json_default(v):
+    if isinstance(v, datetime):
+        return v.timestamp()
+    raise TypeError(f'Object of type {type(v).__name__} is not JSON serializable')
+
+
+def _decode_times(d: dict) -> dict:
+    for k in TIME_KEYS.intersection(d.keys()):
+        if isinstance(d[k], (int, float)):
+            d[k] = from_epoch(d[k])
+    return d
+
+
+def dump_doc(doc: dict) -> str:
+    return json.dumps(doc, default=_json_default, separators=(',', ':'))
+
+
+def load_doc(data: str) -> dict:
+    return json.loads(data, object_hook=_decode_times)
+
+
+def sql_value(v: Any) -> Any:
+    """Convert a document / filter value into the value stored in (or compared against) an SQLite column"""
+    if isinstance(v, datetime):
+        return v.timestamp()
+    if isinstance(v, bool):
+        return int(v)
+    if isinstance(v, (dict, list)):
+        return dump_doc(v)
+    return v
+
+
+def doc_field(doc: dict, name: str) -> Any:
+    """The (``x.y`` style) field ``name`` of ``doc``, or ``None`` if it's missing"""
+    for k in name.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(k)
+    return doc
+
+
+def multi_values(doc: Optional[dict], name: str) -> Set[Any]:
+    """The distinct (SQL) values of the array field ``name`` of ``doc``, i.e. it's entries in a multi index"""
+    if doc is None:
+        return set()
+    return {v if type(v) is str else sql_value(v) for v in doc_field(doc, name) or []}
+
+
+def column_name(name: str) -> str:
+    """The SQLite column holding the (``x.y`` style) field ``name``, e.g. ``status__code``"""
+    return name.replace('.', '__')
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _json_path(name: str) -> str:
+    return '$' + ''.join('."' + k.replace('"', '\\"') + '"' for k in name.split('.'))
+
+
+@lru_cache(maxsize=256)
+def _compile(pattern: str):
+    try:
+        return re.compile(pattern)
+    except re.error:
+        return None
+
+
+def _regexp(pattern: str, value) -> bool:
+    """The ``REGEXP`` operator - like RethinkDB's ``match()``, it searches anywhere in the string"""
+    rx = _compile(pattern)
+    return isinstance(value, str) and rx is not None and rx.search(value) is not None
+
+
+def merge_message_doc(old: dict, new: dict) -> dict:
+    """
+    The same merge as the RethinkDB conflict function :func:`.merge_message` - a newly imported message ``new`` is
+    merged into the stored copy ``old`` without blanking fields, keeping the stored log lines from before ``new``
+    begins, and combining the search tokens.
+    """
+    merged = dict(old)
+    merged.update({k: v for k, v in new.items() if v != '' and v != {}})
+    for k in ('timestamp', 'first_attempt'):
+        if old.get(k) is not None and new.get(k) is not None:
+            merged[k] = min(old[k], new[k])
+    if new.get('first_attempt') is not None:
+        kept = [l for l in old.get('lines') or [] if l['timestamp'] < new['first_attempt']]
+        merged['lines'] = kept + list(new.get('lines') or [])
+    merged[TOKENS_FIELD] = sorted(set(old.get(TOKENS_FIELD) or []).union(new.get(TOKENS_FIELD) or []))
+    return merged
+
+
+def merge_counts_doc(old: dict, new: dict) -> dict:
+    """The same merge as the RethinkDB conflict function :func:`.merge_counts` - the counts are added together"""
+    counts = dict(old.get('counts') or {})
+    for k, n in (new.get('counts') or {}).items():
+        counts[k] = counts.get(k, 0) + n
+    return {**old, 'counts': counts}
+
+
+def merge_delivery_doc(old: dict, new: dict) -> dict:
+    """The same merge as the RethinkDB conflict function :func:`.merge_delivery` - the latest attempt is kept"""
+    return new if new['timestamp'] >= old['timestamp'] else old
+
+
+class TableSchema:
+    """The SQLite layout of a table from :attr:`.settings.rethink_tables` - it's columns, indexes and multi indexes"""
+
+    def __init__(self, table: str, indexes: Iterable):
+        self.table, self.indexes, self.multi = table, {}, {}
+        for spec in indexes:
+            name, fields = index_spec(spec)
+            if index_options(spec).get('multi'):
+                self.multi[fields[0]] = f'{table}__{name}'
+            else:
+                self.indexes[name] = fields
+        self.columns: Dict[str, str] = {}
+        """``{field: column}`` for each field covered by an index"""
+        for fields in self.indexes.values():
+            for f in fields:
+                self.columns.setdefault(f, column_name(f))
+
+    def create_statements(self) -> List[str]:
+        t = _quote(self.table)
+        cols = ''.join(f', {_quote(c)}' for c in self.columns.values())
+        stmts = [f'CREATE TABLE IF NOT EXISTS {t} (id TEXT PRIMARY KEY NOT NULL, doc TEXT NOT NULL{cols})']
+        for name, fields in self.indexes.items():
+            cols = ', '.join(_quote(self.columns[f]) for f in fields)
+            stmts.append(f'CREATE INDEX IF NOT EXISTS {_quote(self.table + "__" + name)} ON {t} ({cols})')
+        for mt in self.multi.values():
+            stmts.append(f'CREATE TABLE IF NOT EXISTS {_quote(mt)} (value NOT NULL, id TEXT NOT NULL, '
+                         f'PRIMARY KEY (value, id)) WITHOUT ROWID')
+        return stmts
+
+    def row(self, doc: dict) -> tuple:
+        """The values for ``INSERT INTO <table> (id, doc, <columns>...)``"""
+        return (doc[PRIMARY_KEY], dump_doc(doc)) + tuple(sql_value(doc_field(doc, f)) for f in self.columns)
+
+    def expr(self, name: str) -> Tuple[str, list]:
+        """SQL for the value of the field ``name`` (a column, or extracted from the JSON document), and it's params"""
+        if name == PRIMARY_KEY:
+            return 'id', []
+        if name in self.columns:
+            return _quote(self.columns[name]), []
+        return 'json_extract(doc, ?)', [_json_path(name)]
+
+    def covered(self, c: Condition) -> bool:
+        """Whether the condition ``c`` can be answered from an index (rather than reading each document)"""
+        return c.field == PRIMARY_KEY or c.field in self.columns or (c.op == 'contains' and c.field in self.multi)
+
+    def condition(self, c: Condition) -> Tuple[str, list]:
+        """Translate ``c`` into an SQL ``WHERE`` clause and it's params, with the same meaning as :meth:`.Condition.apply`"""
+        v = sql_value(c.value)
+        if c.op == 'contains':
+            if c.field in self.multi:
+                return f'id IN (SELECT id FROM {_quote(self.multi[c.field])} WHERE value = ?)', [v]
+            return 'EXISTS (SELECT 1 FROM json_each(doc, ?) WHERE value = ?)', [_json_path(c.field), v]
+        expr, params = self.expr(c.field)
+        if c.op == 'in':
+            return f'{expr} IN (SELECT value FROM json_each(?))', params + [dump_doc([sql_value(x) for x in c.value])]
+        if c.op == 'match':
+            return f'{expr} REGEXP ?', params + [v]
+        op = {'le': '<=', 'ge': '>='}.get(c.op, '=')
+        return f'{expr} {op} ?', params + [v]
+
+    def where(self, conditions: List[Condition], order_by: Optional[str] = None, order_dir: str = 'desc',
+              after: Tuple[Any, str] = None) -> Tuple[str, list]:
+        clauses, params = [], []
+        for c in conditions:
+            sql, p = self.condition(c)
+            clauses.append(sql)
+            params += p
+        if after is not None and order_by is not None:
+            # Keyset pagination - only rows after `after` in the requested order, ties broken by the id
+            expr, p = self.expr(order_by)
+            cmp = '<' if order_dir != 'asc' else '>'
+            clauses.append(f'({expr} {cmp} ? OR ({expr} = ? AND id {cmp} ?))')
+            key = sql_value(after[0])
+            params += p + [key] + p + [key, after[1]]
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+
+class SQLiteStorage(Storage):
+    """
+    :param str path:       The SQLite database file (default: :attr:`.settings.sqlite_path`)
+    :param float timeout:  Seconds to wait for a lock held by another process (default: :attr:`.settings.sqlite_timeout`)
+    """
+    name = 'sqlite'
+    transient_errors = (DatabaseLocked,)
+
+    MERGERS = {'sent_mail': merge_message_doc, 'mail_stats': merge_counts_doc, 'deliveries': merge_delivery_doc}
+    """The merge function used for :attr:`.OnConflict.MERGE` on each table"""
+
+    def __init__(self, path: str = None, timeout: float = None, tables: Iterable = None):
+        self.path = settings.sqlite_path if path is None else path
+        self.timeout = settings.sqlite_timeout if timeout is None else timeout
+        tables = settings.rethink_tables if tables is None else tables
+        self.schemas: Dict[str, TableSchema] = {t: TableSchema(t, indexes) for t, indexes in tables}
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-writer')
+        self._readers = ThreadPoolExecutor(max_workers=max(1, settings.sqlite_readers), thread_name_prefix='sqlite-reader')
+        self._idle: SimpleQueue = SimpleQueue()
+        self._local = threading.local()
+
+    @property
+    def location(self) -> str:
+        return 'sqlite://' + os.path.abspath(self.path)
+
+    def _connect(self) -> sqlite3.Connection:
+        # Transactions are managed explicitly (BEGIN IMMEDIATE ... COMMIT) - see _insert
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.create_function('regexp', 2, _regexp)
+        return conn
+
+    def _writer_conn(self) -> sqlite3.Connection:
+        if getattr(self._local, 'conn', None) is None:
+            self._local.conn = self._connect()
+        return self._local.conn
+
+    async def _write(self, func, *args):
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self._writer, func, *args)
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e) or 'busy' in str(e):
+                raise DatabaseLocked(str(e)) from e
+            raise
+
+    async def _read(self, func, *args):
+        """Run ``func(conn, *args)`` on a reader thread, with an idle read connection"""
+        try:
+            conn = self._idle.get_nowait()
+        except Empty:
+            conn = None
+        loop = asyncio.get_event_loop()
+        if conn is None:
+            conn = await loop.run_in_executor(self._readers, self._connect)
+        try:
+            return await loop.run_in_executor(self._readers, func, conn, *args)
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e) or 'busy' in str(e):
+                raise DatabaseLocked(str(e)) from e
+            raise
+        finally:
+            self._idle.put(conn)
+
+    def schema(self, table: str) -> TableSchema:
+        if table not in self.schemas:
+            raise KeyError(f"Unknown table '{table}' - tables are configured in settings.rethink_tables")
+        return self.schemas[table]
+
+    def _bootstrap(self):
+        conn = self._writer_conn()
+        try:
+            conn.execute("SELECT json_extract('{\"a\": 1}', '$.a')")
+        except sqlite3.OperationalError:
+            raise RuntimeError('This Python\'s SQLite library was built without the JSON1 extension, which the SQLite '
+                               'storage backend needs.')
+        for schema in self.schemas.values():
+            existing = {r[1] for r in conn.execute(f'PRAGMA table_info({_quote(schema.table)})')}
+            for stmt in schema.create_statements():
+                conn.execute(stmt)
+            missing = [f for f, c in schema.columns.items() if len(existing) > 0 and c not in existing]
+            if len(missing) > 0:
+                self._add_columns(conn, schema, missing)
+
+    def _add_columns(self, conn: sqlite3.Connection, schema: TableSchema, fields: List[str]):
+        """Add (and fill in) the columns for ``fields``, which have been indexed since the table was created"""
+        log.info('Adding columns %s to the SQLite table %s', fields, schema.table)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for f in fields:
+                conn.execute(f'ALTER TABLE {_quote(schema.table)} ADD COLUMN {_quote(schema.columns[f])}')
+            sets = ', '.join(f'{_quote(schema.columns[f])} = ?' for f in fields)
+            rows = conn.execute(f'SELECT id, doc FROM {_quote(schema.table)}').fetchall()
+            conn.executemany(f'UPDATE {_quote(schema.table)} SET {sets} WHERE id = ?', [
+                tuple(sql_value(doc_field(load_doc(doc), f)) for f in fields) + (doc_id,) for doc_id, doc in rows
+            ])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        # The indexes were created before the columns were filled in - so refresh the query planner's statistics
+        conn.execute('ANALYZE')
+
+    async def bootstrap(self):
+        await self._write(self._bootstrap)
+
+    def _close_writer(self):
+        if getattr(self._local, 'conn', None) is not None:
+            self._local.conn.close()
+            self._local.conn = None
+
+    async def close(self):
+        await asyncio.get_event_loop().run_in_executor(self._writer, self._close_writer)
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                break
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+
+    def _insert(self, table: str, docs: List[dict], conflict: OnConflict, return_changes: bool) -> Dict[str, Any]:
+        schema, conn = self.schema(table), self._writer_conn()
+        res = dict(inserted=0, replaced=0, unchanged=0, errors=0)
+        changes, rows, merge = [], {}, self.MERGERS.get(table)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            stored = {}
+            ids = list({d[PRIMARY_KEY] for d in docs})
+            for i in range(0, len(ids), MAX_VARIABLES):
+                chunk = ids[i:i + MAX_VARIABLES]
+                q = f"SELECT id, doc FROM {_quote(table)} WHERE id IN ({', '.join('?' * len(chunk))})"
+                stored.update((doc_id, load_doc(doc)) for doc_id, doc in conn.execute(q, chunk))
+            for new in docs:
+                doc_id = new[PRIMARY_KEY]
+                old = rows[doc_id] if doc_id in rows else stored.get(doc_id)
+                if old is None:
+                    doc = new
+                    res['inserted'] += 1
+                elif conflict in (OnConflict.QUIET, OnConflict.EXCEPT):
+                    res['errors'] += 1
+                    res.setdefault('first_error', f"Duplicate primary key `id`: {doc_id}")
+                    continue
+                else:
+                    if conflict == OnConflict.MERGE:
+                        doc = merge(old, new)
+                    elif conflict == OnConflict.UPDATE:
+                        doc = {**old, **new}
+                    else:
+                        doc = new
+                    if doc == old:
+                        res['unchanged'] += 1
+                        continue
+                    res['replaced'] += 1
+                rows[doc_id] = doc
+                if return_changes:
+                    changes.append({'old_val': old, 'new_val': doc})
+
+            cols = ', '.join(['id', 'doc'] + [_quote(c) for c in schema.columns.values()])
+            marks = ', '.join('?' * (2 + len(schema.columns)))
+            conn.executemany(f'INSERT OR REPLACE INTO {_quote(table)} ({cols}) VALUES ({marks})',
+                             [schema.row(d) for d in rows.values()])
+            for f, mt in schema.multi.items():
+                # Only the entries which changed are written - merged messages mostly just gain a few tokens
+                removed, added = [], []
+                for doc_id, doc in rows.items():
+                    old_values = multi_values(stored.get(doc_id), f)
+                    new_values = multi_values(doc, f)
+                    removed += [(v, doc_id) for v in old_values - new_values]
+                    added += [(v, doc_id) for v in new_values - old_values]
+                conn.executemany(f'DELETE FROM {_quote(mt)} WHERE value = ? AND id = ?', removed)
+                conn.executemany(f'INSERT OR IGNORE INTO {_quote(mt)} (value, id) VALUES (?, ?)', added)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        if return_changes:
+            res['changes'] = changes
+        return res
+
+    async def insert(self, table: str, docs: List[dict], conflict: OnConflict = OnConflict.UPDATE,
+                     return_changes: bool = False) -> Dict[str, Any]:
+        return await self._write(self._insert, table, docs, conflict, return_changes)
+
+    def _delete_all(self, table: str):
+        conn = self._writer_conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(f'DELETE FROM {_quote(table)}')
+            for mt in self.schema(table).multi.values():
+                conn.execute(f'DELETE FROM {_quote(mt)}')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    async def delete_all(self, table: str):
+        await self._write(self._delete_all, table)
+
+    async def get(self, table: str, doc_id: str) -> Optional[dict]:
+        def _get(conn):
+            row = conn.execute(f'SELECT doc FROM {_quote(table)} WHERE id = ?', [doc_id]).fetchone()
+            return None if row is None else load_doc(row[0])
+        self.schema(table)
+        return await self._read(_get)
+
+    def select(self, table: str, conditions: List[Condition], order_by: Optional[str] = None, order_dir: str = 'desc',
+               after: Tuple[Any, str] = None, offset: int = 0, limit: int = None) -> Tuple[str, list]:
+        """The SQL (and params) used by :meth:`.find` for these arguments"""
+        schema = self.schema(table)
+        where, params = schema.where(conditions, order_by, order_dir, after)
+        sql = f'SELECT doc FROM {_quote(table)}{where}'
+        if order_by is not None:
+            expr, p = schema.expr(order_by)
+            d = 'DESC' if order_dir != 'asc' else 'ASC'
+            sql += f' ORDER BY {expr} {d}, id {d}'
+            params += p
+        if limit is not None or offset > 0:
+            sql += ' LIMIT ? OFFSET ?'
+            params += [-1 if limit is None else limit, offset]
+        return sql, params
+
+    async def find(self, table: str, conditions: List[Condition], order_by: Optional[str] = None,
+                   order_dir: str = 'desc', after: Tuple[Any, str] = None, offset: int = 0, limit: int = None,
+                   fields: Sequence[str] = None, strict_order: bool = True) -> AsyncGenerator[dict, None]:
+        sql, params = self.select(table, conditions, order_by, order_dir, after, offset, limit)
+        log.debug('SQL for %s %s: %s %s', table, conditions, sql, params)
+
+        def _fetch(conn, cursor):
+            cursor = conn.execute(sql, params) if cursor is None else cursor
+            docs = []
+            for (data,) in cursor.fetchmany(FETCH_ROWS):
+                doc = load_doc(data)
+                docs.append(doc if fields is None else {k: doc[k] for k in fields if k in doc})
+            return cursor, docs
+
+        # A dedicated connection, as the cursor is read across several trips to the reader threads
+        loop = asyncio.get_event_loop()
+        conn = await loop.run_in_executor(self._readers, self._connect)
+        try:
+            cursor = None
+            while True:
+                cursor, docs = await loop.run_in_executor(self._readers, _fetch, conn, cursor)
+                for doc in docs:
+                    yield doc
+                if len(docs) < FETCH_ROWS:
+                    return
+        finally:
+            conn.close()
+
+    async def count(self, table: str, conditions: List[Condition], cap: int = 0) -> Tuple[int, bool]:
+        schema = self.schema(table)
+        where, params = schema.where(conditions)
+        # Like RethinkDB, counting is only capped when rows have to be read (rather than counted from an index)
+        if cap > 0 and not all(schema.covered(c) and c.op != 'match' for c in conditions):
+            sql = f'SELECT count(*) FROM (SELECT 1 FROM {_quote(table)}{where} LIMIT ?)'
+            count = await self._read(lambda conn: conn.execute(sql, params + [cap + 1]).fetchone()[0])
+            return (cap, False) if count > cap else (count, True)
+        sql = f'SELECT count(*) FROM {_quote(table)}{where}'
+        return await self._read(lambda conn: conn.execute(sql, params).fetchone()[0]), True
+
+    async def estimate(self, table: str, conditions: List[Condition], limit: int = MULTI_INDEX_MAX_ROWS) -> int:
+        where, params = self.schema(table).where(conditions)
+        sql = f'SELECT count(*) FROM (SELECT 1 FROM {_quote(table)}{where} LIMIT ?)'
+        return await self._read(lambda conn: conn.execute(sql, params + [limit]).fetchone()[0])
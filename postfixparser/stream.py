@@ -0,0 +1,223 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Streaming message assembly - rather than holding every message of a log file in memory until the whole file has
+been read, :class:`.MessageTracker` hands back each message as soon as it's finished, so it can be written to the DB
+and released. Peak memory then depends on how many messages are in-flight, not on the size of the log.
+
+"""
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Dict, List, Optional, Set
+
+from postfixparser import settings
+from postfixparser.dates import from_epoch
+from postfixparser.metrics import LINES_READ, LINES_UNMATCHED, STAGE_SECONDS
+from postfixparser.objects import PostfixMessage
+from postfixparser.parser import match, tokenize_line
+from postfixparser.parallel import Segment
+
+log = logging.getLogger(__name__)
+
+
+class MessageTracker:
+    """
+    Assembles log lines into :class:`.PostfixMessage`'s, and returns each message once it's finished - either because
+    Postfix logged ``removed`` for it, or because no lines have been logged for it for ``idle_timeout`` (measured
+    using the timestamps of the log lines, not the wall clock, so backfills behave the same as live imports).
+
+        >>> tracker = MessageTracker(idle_timeout=timedelta(hours=1))
+        >>> for line in open('/var/log/mail.log'):
+        ...     for msg in tracker.feed(line):
+        ...         save(msg)
+        >>> for msg in tracker.drain_touched():   # Messages which are still in the queue
+        ...     save(msg)
+
+    A message which was flushed due to being idle (e.g. a deferred message waiting for it's next retry) may receive
+    more lines later on. Those later lines form a new message with the same queue ID - a "continuation" - which
+    only holds the new lines, and must be merged into the stored message rather than replacing it
+    (see :meth:`.is_continuation`).
+    """
+
+    def __init__(self, messages: Dict[str, PostfixMessage] = None, flushed: Dict[str, datetime] = None,
+                 idle_timeout: Optional[timedelta] = None):
+        self.messages: Dict[str, PostfixMessage] = OrderedDict(messages or {})
+        """In-flight messages keyed by queue ID, ordered from least to most recently updated"""
+        self.flushed: Dict[str, datetime] = dict(flushed or {})
+        """Queue ID's of messages which were flushed due to being idle, mapped to the time of their last line"""
+        self.touched: Set[str] = set()
+        """Queue ID's of in-flight messages which received lines since the last :meth:`.drain_touched`"""
+        self.idle_timeout = idle_timeout
+        self.latest: Optional[datetime] = None
+        """The timestamp of the newest log line seen so far"""
+        self.lines_read, self.lines_unmatched = 0, 0
+        """Lines fed in / lines which didn't match :attr:`.match`, since the last :meth:`.record_metrics`"""
+        self.sample_every = max(1, settings.metrics_sample_every)
+
+    def is_continuation(self, queue_id: str) -> bool:
+        """
+        Returns ``True`` if the message ``queue_id`` only holds lines logged after it was previously flushed as idle
+        (and that flush was :meth:`.written`)
+        """
+        return queue_id in self.flushed
+
+    def _get(self, qid: str, timestamp) -> PostfixMessage:
+        msg = self.messages.get(qid)
+        if msg is None:
+            msg = self.messages[qid] = PostfixMessage(timestamp=timestamp, queue_id=qid)
+        else:
+            self.messages.move_to_end(qid)
+        self.touched.add(qid)
+        return msg
+
+    def _finish(self, qid: str) -> Optional[PostfixMessage]:
+        msg = self.messages.pop(qid, None)
+        self.touched.discard(qid)
+        return msg
+
+    def _seen(self, ts: datetime):
+        if self.latest is None or ts > self.latest:
+            self.latest = ts
+
+    def feed(self, line: str) -> List[PostfixMessage]:
+        """
+        Parse a single raw mail.log line.
+
+        :return list finished: Any messages which are now finished, and can be written to the DB
+        """
+        self.lines_read += 1
+        if self.lines_read % self.sample_every == 0:
+            return self._feed_timed(line)
+        m = match.match(line)
+        if not m:
+            self.lines_unmatched += 1
+            return []
+        return self.add(*m.groups())
+
+    def _feed_timed(self, line: str) -> List[PostfixMessage]:
+        """Same as :meth:`.feed`, but records how long the line took to match and parse"""
+        start = perf_counter()
+        m = match.match(line)
+        matched = perf_counter()
+        STAGE_SECONDS.observe(matched - start, stage='match')
+        if not m:
+            self.lines_unmatched += 1
+            return []
+        finished = self.add(*m.groups())
+        STAGE_SECONDS.observe(perf_counter() - matched, stage='parse')
+        return finished
+
+    def add(self, dtime: str, qid: str, msg: str) -> List[PostfixMessage]:
+        """
+        Add the already split up log line ``msg`` for the queue ID ``qid`` logged at ``dtime``.
+
+        :return list finished: Any messages which are now finished, and can be written to the DB
+        """
+        pm = self._get(qid, dtime)
+        pm.merge(tokenize_line(msg))
+        pm.add_line(dtime, msg)
+        self._seen(pm.last_attempt)
+
+        finished = self.expire()
+        if pm.last_message == 'removed':
+            finished.append(self._finish(qid))
+        return finished
+
+    def add_partials(self, segments: List[Segment], stats: Dict[str, int] = None) -> List[PostfixMessage]:
+        """
+        Add the partial results from parsing one byte range of a log file (see :func:`postfixparser.parallel.parse_range`
+        - which must be given this tracker's ``idle_timeout``). Ranges must be added in the order they appear in the file.
+
+        :return list finished: Any messages which are now finished, and can be written to the DB
+        """
+        if stats is not None:
+            self.lines_read += stats.get('lines', 0)
+            self.lines_unmatched += stats.get('unmatched', 0)
+        start = float('-inf') if self.latest is None else self.latest.timestamp()
+        finished, newest = [], start
+        for qid, (fields, times, lines), since in segments:
+            # A message carried over from an earlier range (or segment) which went idle before these lines were logged
+            if qid in self.messages and self._idle(self.messages[qid], max(start, since)):
+                finished.append(self._finish(qid))
+            pm = self._get(qid, from_epoch(times[0]))
+            pm.merge(fields)
+            pm.extend_lines(times, lines)
+            newest = max(newest, max(times))
+            if pm.last_message == 'removed':
+                finished.append(self._finish(qid))
+        if newest > start:
+            self._seen(from_epoch(newest))
+        return finished + self.expire()
+
+    def _idle(self, msg: PostfixMessage, now: float) -> bool:
+        """``True`` if ``msg`` would have been flushed as idle once a line logged at the epoch ``now`` was read"""
+        return self.idle_timeout is not None and now > float('-inf') and \
+            from_epoch(now) - msg.last_attempt > self.idle_timeout
+
+    def expire(self, now: datetime = None) -> List[PostfixMessage]:
+        """
+        Flush any in-flight messages which haven't had a line logged for ``idle_timeout``, relative to ``now``
+        (default: the newest line seen so far).
+        """
+        now = self.latest if now is None else now
+        if self.idle_timeout is None or now is None:
+            return []
+        expired = []
+        for qid, msg in self.messages.items():
+            if now - msg.last_attempt <= self.idle_timeout:
+                break
+            expired.append(qid)
+        return [self._finish(qid) for qid in expired]
+
+    def drain_touched(self) -> List[PostfixMessage]:
+        """
+        Return each in-flight message which received new lines since the last call, without removing it - so that
+        messages still in the Postfix queue can be written to the DB in their current state.
+        """
+        msgs = [self.messages[qid] for qid in self.touched if qid in self.messages]
+        self.touched = set()
+        return msgs
+
+    def written(self, msg: PostfixMessage, stored: bool = True):
+        """
+        Call once a finished message has been handed off to be written. A message which was flushed as idle is only
+        remembered as flushed (so that lines logged for it later form a continuation) once it's first flush was
+        ``stored`` - i.e. it wasn't dropped as incomplete / ignored. A removed message is forgotten entirely.
+        """
+        if msg.last_message == 'removed':
+            self.flushed.pop(msg.queue_id, None)
+        elif stored:
+            self.flushed[msg.queue_id] = msg.last_attempt
+
+    def record_metrics(self):
+        """Add the number of lines read / unmatched since the last call to :mod:`postfixparser.metrics`"""
+        LINES_READ.inc(self.lines_read)
+        LINES_UNMATCHED.inc(self.lines_unmatched)
+        self.lines_read, self.lines_unmatched = 0, 0
+
+    def prune(self, max_age: timedelta) -> int:
+        """Forget in-flight and idle-flushed messages whose last line is more than ``max_age`` older than the newest line"""
+        if self.latest is None:
+            return 0
+        stale = [qid for qid, m in self.messages.items() if self.latest - m.last_attempt > max_age]
+        for qid in stale:
+            self._finish(qid)
+        old = [qid for qid, ts in self.flushed.items() if self.latest - ts > max_age]
+        for qid in old:
+            del self.flushed[qid]
+        return len(stale)
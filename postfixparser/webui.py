@@ -15,19 +15,29 @@ Copyright::
     +===================================================+
 
 """
+import asyncio
+import csv
+import io
 import json
+from datetime import datetime
+from time import perf_counter
 from dataclasses import dataclass, field
-from typing import List, Union, Mapping, Tuple
+from typing import AsyncGenerator, List, Optional, Sequence, Union, Mapping, Tuple
 
-import rethinkdb.query
 import logging
 
-from rethinkdb.net import DefaultConnection
-
-from postfixparser import settings, api
-from postfixparser.exceptions import APIException
-from postfixparser.core import get_rethink
-from quart import Quart, session, redirect, render_template, request, flash, jsonify
+from postfixparser import settings, api, metrics, stats
+from postfixparser.deliveries import DELIVERIES_TABLE, recipient_conditions
+from postfixparser.exceptions import APIException, DatabaseLocked, PoolTimeout
+from postfixparser.fingerprints import FINGERPRINT_FIELD
+from postfixparser.dates import parse_log_time
+from postfixparser.cache import ResponseCache, TTLCache, current_generation
+from postfixparser.query import (
+    ADDRESS_DERIVED_FIELDS, MULTI_INDEX_MAX_ROWS, Condition, decode_cursor, encode_cursor, filters_key, parse_filters
+)
+from postfixparser.search import TOKENS_FIELD, search_conditions
+from postfixparser.storage import Storage, get_storage
+from quart import Quart, session, redirect, render_template, request, flash, jsonify, g, Response
 from privex.helpers import random_str, empty, filter_form, DictDataClass, DictObject
 
 log = logging.getLogger(__name__)
@@ -35,9 +45,49 @@ log = logging.getLogger(__name__)
 app = Quart(__name__)
 app.secret_key = settings.secret_key
 
-Table = rethinkdb.query.ast.Table
-RqlQuery = rethinkdb.query.ast.RqlQuery
-QueryOrTable = Union[Table, RqlQuery]
+COUNT_CACHE = TTLCache(maxsize=settings.count_cache_size, ttl=settings.count_cache_ttl)
+SUMMARY_FIELDS = [
+    'id', 'timestamp', 'queue_id', 'mail_to', 'mail_from', 'message_id', 'status', 'relay', 'client',
+    'first_attempt', 'last_attempt',
+]
+"""
+The fields of each email returned by ``/api/emails`` by default - everything except the (large) ``lines``,
+which can be requested with ``?fields=lines``, or fetched for a single email from ``/api/emails/<queue_id>``.
+"""
+
+RESPONSE_CACHE = ResponseCache(
+    maxsize=settings.response_cache_size, ttl=settings.response_cache_ttl, folder=settings.response_cache_dir or None
+)
+
+
+@app.before_request
+async def _start_timer():
+    g.request_start = perf_counter()
+
+
+@app.after_request
+async def _record_latency(response):
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        # Use the route pattern (e.g. /api/emails) rather than the path, so each route is a single set of series
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.API_SECONDS.observe(perf_counter() - start, route=route, method=request.method,
+                                    status=response.status_code)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    """
+    Metrics in the Prometheus text format - the latency of each Web UI / API route for this process, plus the
+    importer metrics saved by the last ``manage.py parse`` / ``follow`` run (see :mod:`postfixparser.metrics`).
+    """
+    if not settings.metrics_token:
+        if not settings.metrics_public:
+            return Response('Not Found\n', status=404, content_type='text/plain')
+    elif request.headers.get('Authorization', '') != f'Bearer {settings.metrics_token}':
+        return Response('Unauthorized\n', status=401, content_type='text/plain')
+    return Response(metrics.render_all(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 @app.route('/', methods=['GET'])
@@ -87,9 +137,14 @@ class PageResult(DictDataClass):
     error: bool = False
     error_code: str = None
     count: int = 0
+    count_exact: bool = True
+    """``False`` if ``count`` was capped at :attr:`.settings.count_cap` - i.e. there are at least ``count`` results"""
     remaining: int = 0
     page: int = 1
     total_pages: int = 1
+    limit: int = 0
+    next_cursor: str = None
+    """Pass this as ``?cursor=`` to fetch the page after this one, or ``None`` if this is the last page"""
     message: List[str] = field(default_factory=list)
     messages: List[str] = field(default_factory=list)
     
@@ -117,8 +172,9 @@ class PageResult(DictDataClass):
 async def api_emails():
     """
 
-    All GET params are used for filtering. Use ``x.y`` to access sub-dict key's (only works for 1 layer deep),
-    and append ``__lt`` / ``__gt`` to the end of a key for ``<=`` and ``>=`` respectively.
+    All GET params are used for filtering. Use ``x.y`` to access sub-dict key's, and append ``__lt`` / ``__gt``
+    to the end of a key for ``<=`` and ``>=`` respectively. Filters and ordering (``order`` / ``order_dir``) are
+    served by an index where possible - see :class:`.QueryPlanner`.
 
 
     Example queries:
@@ -138,41 +194,280 @@ async def api_emails():
         /api/emails?id=E553EBD87B
 
 
+        Get emails sent to any address at ``example.com`` or it's sub-domains (case insensitive, served by an index -
+        see :func:`.address_conditions`)
+
+        /api/emails?mail_to=*example.com
+
+
+        Recipient filters (``mail_to``) match any recipient of a message, not just the last one - see
+        :func:`._resolve_recipients`.
+
+
+    To keep pages small, each email only includes the :attr:`.SUMMARY_FIELDS` - pass a comma separated list of
+    extra fields in ``fields`` (e.g. ``?fields=lines``), or ``?fields=*`` for whole documents.
+
+
+    Search the log lines and status messages with ``q`` - only emails containing every word are returned. Joined
+    words like ``5.1.1`` or ``gmail.com`` are matched as a whole (see :mod:`postfixparser.search`).
+
+        /api/emails?q=550 5.1.1 user unknown&status.code=bounced
+
+
+    Results are paginated with ``page`` (or ``offset``) and ``limit``. Each response also includes ``next_cursor``
+    (``null`` on the last page) - pass it as ``cursor`` along with the same filters and ordering to fetch the
+    next page. Cursors resume directly from the last row of the previous page, so unlike ``page`` / ``offset``,
+    they stay just as fast however deep you page.
+
+        /api/emails?status.code=bounced&limit=100&cursor=eyJvIjoibGFzdF9hdHRlbXB0Ii...
+
+
     :return:
     """
     if 'admin' not in session:
         await flash("You must log in to access this.", 'error')
         return redirect('/')
 
-    r, conn, r_q = await get_rethink()
-    r_q: rethinkdb.query
-
     frm = dict(request.args)
     order_by = str(frm.pop('order', 'last_attempt')).lower()
     order_dir = str(frm.pop('order_dir', 'desc')).lower()
+    fields = _projection(frm.pop('fields', None), order_by)
+
+    # Identical queries (whatever order their parameters are in) share a cached response until the next import
+    cache_key = ('/api/emails', order_by, order_dir, fields, tuple(sorted((k, str(v)) for k, v in frm.items())))
+    generation = current_generation()
+    body, source = RESPONSE_CACHE.get(cache_key, generation)
+    metrics.CACHE_REQUESTS.inc(cache='response', result=source)
+    if body is not None:
+        return Response(body, content_type='application/json')
 
-    _sm = r.table('sent_mail')
+    store = get_storage()
+    conds = await _search_conditions(frm.pop('q', None), store) + parse_filters(frm)
+    count_key = ('sent_mail', filters_key(conds))
+    conds, notes = await _resolve_recipients(conds, store)
+    await _estimate_ranges(conds, store)
 
-    # Handle appending .filter() to `_sm` for each filter key in `frm`
-    _sm = await _process_filters(query=_sm, frm=frm)
+    res = await _paginate_query(store, conds, frm, order_by, order_dir, fields=fields, count_key=count_key)
+    res.messages += notes
 
-    _sm, res = await _paginate_query(_sm, frm, rt_conn=conn, rt_query=r_q, order_by=order_by, order_dir=order_dir)
-    _sm = await _sm.run(conn)
+    response = jsonify(res.to_json_dict())
+    RESPONSE_CACHE.set(cache_key, await response.get_data(), generation)
+    return response
+
+
+def _projection(fields: Optional[str], order_by: str) -> Optional[Tuple[str, ...]]:
+    """
+    Parse the ``fields`` query parameter into the fields to ``pluck()`` - the :attr:`.SUMMARY_FIELDS`, plus any
+    comma separated extra fields. Returns ``None`` (no projection) for ``fields=*``.
+    """
+    if fields is not None and fields.strip() == '*':
+        return None
+    extra = [] if empty(fields) else [f.strip() for f in fields.split(',') if f.strip() != '']
+    # The sort key is always included, since it's needed to build the `next_cursor`
+    extra.append(order_by.split('.')[0])
+    return tuple(SUMMARY_FIELDS + sorted(set(extra) - set(SUMMARY_FIELDS)))
+
+
+EXPORT_CSV_COLUMNS = [
+    'id', 'timestamp', 'mail_from', 'mail_to', 'message_id', 'status.code', 'status.message',
+    'relay.host', 'relay.ip', 'relay.port', 'client.host', 'client.ip', 'first_attempt', 'last_attempt',
+]
+"""The default columns of a CSV export. Nested fields use the same ``x.y`` syntax as filters."""
+
+EXPORT_CHUNK_ROWS = 500
+"""Rows are sent to the client in chunks of this many, rather than one write per row"""
+
+
+def _export_value(v):
+    if isinstance(v, datetime):
+        return v.isoformat()
+    if isinstance(v, (dict, list)):
+        return json.dumps(v, default=_export_value)
+    return v
+
+
+def _csv_cell(row: dict, column: str):
+    for k in column.split('.'):
+        row = row.get(k) if isinstance(row, dict) else None
+    return '' if row is None else _export_value(row)
+
+
+async def _export_rows(docs: AsyncGenerator[dict, None], fmt: str, columns: List[str]) -> AsyncGenerator[bytes, None]:
+    """Stream the documents from :meth:`.Storage.find` as NDJSON or CSV, in chunks of :attr:`.EXPORT_CHUNK_ROWS` rows"""
+    buf = io.StringIO()
+    writer = csv.writer(buf) if fmt == 'csv' else None
+    if writer is not None:
+        writer.writerow(columns)
+    rows = 0
+    try:
+        async for row in docs:
+            if writer is not None:
+                writer.writerow([_csv_cell(row, c) for c in columns])
+            else:
+                buf.write(json.dumps(row, default=_export_value) + '\n')
+            rows += 1
+            if rows % EXPORT_CHUNK_ROWS == 0:
+                yield buf.getvalue().encode()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue().encode()
+    finally:
+        # Stop the query early if the client disconnected part way through
+        await docs.aclose()
+        log.info('Exported %d rows as %s', rows, fmt)
+
+
+@app.route('/api/emails/export', methods=['GET'])
+async def api_emails_export():
+    """
+    Export every email matching the given filters (the same as :func:`.api_emails`) - streamed straight from the
+    DB cursor, so it uses the same (small) amount of memory however many emails match.
 
-    sm = []
-    if type(_sm) is list:
-        sm = list(_sm)
+        /api/emails/export?status.code=bounced&last_attempt__gt=2019-10-01&format=csv
+
+    Parameters (besides filters):
+
+     - ``format`` - ``ndjson`` (default, one JSON object per line) or ``csv``
+     - ``q`` - A full-text search, the same as :func:`.api_emails`
+     - ``fields`` - For NDJSON, extra fields on top of the :attr:`.SUMMARY_FIELDS` (or ``*`` for whole documents).
+       For CSV, the (``x.y`` style) columns to output, instead of :attr:`.EXPORT_CSV_COLUMNS`.
+     - ``order`` / ``order_dir`` - Only applied if an index can return the rows in that order, otherwise rows are
+       exported in index / table order, since sorting the whole result set would need it all in memory.
+     - ``limit`` - Optionally stop after this many rows (unlike :func:`.api_emails`, ``MAX_LIMIT`` doesn't apply)
+
+    Times are output in ISO 8601 format.
+    """
+    if 'admin' not in session:
+        await flash("You must log in to access this.", 'error')
+        return redirect('/')
+
+    frm = dict(request.args)
+    fmt = str(frm.pop('format', 'ndjson')).lower()
+    if fmt not in ('ndjson', 'csv'):
+        raise APIException('INVALID_FORMAT', f"Unsupported export format '{fmt}' - must be 'ndjson' or 'csv'")
+    order_by = str(frm.pop('order', 'last_attempt')).lower()
+    order_dir = str(frm.pop('order_dir', 'desc')).lower()
+    fields, limit = frm.pop('fields', None), filter_form(frm, 'limit', cast=int).get('limit')
+
+    store = get_storage()
+    conds = await _search_conditions(frm.pop('q', None), store)
+    conds += parse_filters(frm, skip_keys=('limit', 'offset', 'page', 'cursor'))
+    conds, notes = await _resolve_recipients(conds, store)
+    for n in notes:
+        log.info('Export: %s', n)
+    await _estimate_ranges(conds, store)
+
+    if fmt == 'csv':
+        columns = EXPORT_CSV_COLUMNS if empty(fields) else [f.strip() for f in fields.split(',') if f.strip() != '']
+        projection = tuple(sorted({c.split('.')[0] for c in columns}))
     else:
-        async for s in _sm:
-            sm.append(dict(s))
-    
-    res.result = sm
+        columns, projection = [], _projection(fields, order_by)
+
+    docs = store.find(
+        'sent_mail', conds, order_by=order_by, order_dir=order_dir, fields=projection, strict_order=False,
+        limit=limit if not empty(limit) and limit > 0 else None
+    )
+    filename = f"emails-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    return Response(
+        _export_rows(docs, fmt, columns),
+        content_type='text/csv; charset=utf-8' if fmt == 'csv' else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+
+@app.route('/api/emails/<queue_id>', methods=['GET'])
+async def api_email(queue_id: str):
+    """
+    Get a single email by it's queue ID, including all of it's log ``lines``, and the latest delivery attempt to
+    each of it's recipients (``deliveries``).
+
+        /api/emails/E553EBD87B
+
+    """
+    if 'admin' not in session:
+        await flash("You must log in to access this.", 'error')
+        return redirect('/')
+
+    store = get_storage()
+    msg = await store.get('sent_mail', queue_id)
+    if msg is None:
+        raise APIException('NOT_FOUND', f"No email was found with the queue ID '{queue_id}'")
+    for k in (TOKENS_FIELD, FINGERPRINT_FIELD) + ADDRESS_DERIVED_FIELDS:
+        msg.pop(k, None)
+    msg['deliveries'] = [
+        d async for d in store.find(
+            DELIVERIES_TABLE, [Condition('queue_id', 'eq', queue_id)], order_by='timestamp', order_dir='asc',
+            fields=('recipient', 'relay', 'status', 'delay', 'dsn', 'timestamp')
+        )
+    ]
+    return jsonify(api.result_dict(msg))
+
+
+@app.route('/api/stats', methods=['GET'])
+async def api_stats():
+    """
+    Message counts per hour or day for charts, served from the rollups kept by the importer (see
+    :mod:`postfixparser.stats`) rather than by scanning ``sent_mail``.
 
-    return jsonify(res.to_json_dict())
+    Bounces per hour to gmail.com over the last 24 hours::
 
+        /api/stats?period=hour&by=to_domain&value=gmail.com&status=bounced
 
-async def _paginate_query(query: QueryOrTable, frm: Mapping, rt_conn: DefaultConnection, rt_query: rethinkdb.query,
-                          order_by=None, order_dir='desc') -> Tuple[QueryOrTable, PageResult]:
+    The 5 relays which were sent the most mail per day in October::
+
+        /api/stats?period=day&by=relay&top=5&start=2019-10-01&end=2019-10-31
+
+    Parameters:
+
+     - ``period`` - ``hour`` (default) or ``day``
+     - ``by`` - ``all`` (default), ``from_domain``, ``to_domain`` or ``relay``
+     - ``value`` - Only return the series for this domain / relay
+     - ``status`` - Only count messages with this ``status.code``, e.g. ``bounced``
+     - ``start`` / ``end`` - The time range (default: the last 24 hours, or 30 days for ``day``)
+     - ``top`` - Without ``value``, return the series for this many values with the most messages (default: 10)
+
+    The result contains ``buckets`` (the start time of each hour / day, in UTC), and a list of ``series`` - each
+    with a ``totals`` list holding the number of messages in each bucket, and ``by_status`` holding the same
+    per status code.
+    """
+    if 'admin' not in session:
+        await flash("You must log in to access this.", 'error')
+        return redirect('/')
+
+    frm = dict(request.args)
+    cache_key = ('/api/stats', tuple(sorted((k, str(v)) for k, v in frm.items())))
+    generation = current_generation()
+    body, source = RESPONSE_CACHE.get(cache_key, generation)
+    metrics.CACHE_REQUESTS.inc(cache='response', result=source)
+    if body is not None:
+        return Response(body, content_type='application/json')
+
+    times = {}
+    for k in ('start', 'end'):
+        if not empty(frm.get(k)):
+            try:
+                times[k] = parse_log_time(str(frm[k]))
+            except (ValueError, OverflowError):
+                raise APIException('INVALID_FILTER', f"Could not parse the date/time '{frm[k]}' for '{k}'")
+    top = filter_form(frm, 'top', cast=int).get('top', 10)
+    res = await stats.query_stats(
+        period=str(frm.get('period', 'hour')).lower(), dimension=str(frm.get('by', 'all')).lower(),
+        value=frm.get('value') or None, status=frm.get('status') or None, top=top, **times
+    )
+    res['buckets'] = [b.isoformat() for b in res['buckets']]
+
+    response = jsonify(api.result_dict(res))
+    RESPONSE_CACHE.set(cache_key, await response.get_data(), generation)
+    return response
+
+
+async def _paginate_query(store: Storage, conds: List[Condition], frm: Mapping, order_by: str, order_dir: str,
+                          fields: Sequence[str] = None, count_key: tuple = None) -> PageResult:
+    cursor, after = frm.get('cursor'), None
+    if not empty(cursor):
+        # Keyset pagination - resume straight after the last row of the previous page, instead of skipping
+        # `offset` rows (which gets slower the deeper you page). `page` is then only used for `remaining`.
+        after = decode_cursor(cursor, order_by, order_dir)
     _lo = filter_form(frm, 'limit', 'offset', 'page', cast=int)
     limit, offset, page = _lo.get('limit', settings.default_limit), _lo.get('offset', 0), _lo.get('page')
     if not empty(page, True, True):
@@ -181,63 +476,140 @@ async def _paginate_query(query: QueryOrTable, frm: Mapping, rt_conn: DefaultCon
     res = PageResult(error=False, count=0, remaining=0, page=1 if not page else page, total_pages=1)
     
     # Get the total number of rows which match the requested filters
-    count = await query.count().run(rt_conn)
+    count, exact = await _count_query(store, conds, cache_key=count_key)
     
-    # rt_query: RqlTopLevelQuery
-    r_order = order_by if order_dir == 'asc' else rt_query.desc(order_by)
     limit = settings.default_limit if limit <= 0 else (settings.max_limit if limit > settings.max_limit else limit)
-    offset = (count - limit if (count - limit) > 0 else 0) if offset >= count else offset
+    if exact:
+        offset = (count - limit if (count - limit) > 0 else 0) if offset >= count else offset
     
     # if count < offset:
     #     offset = count - limit if count - limit > 0 else count - 1
     page, total_pages = int(offset / limit) + 1, int(count / limit) - 1
     total_pages = 1 if total_pages < 1 else total_pages
     page = 1 if page < 1 else page
-    res.count, res.remaining, res.page, res.total_pages = count, count - offset, page, total_pages
-    # if order_by in dict(settings.rethink_tables)['sent_mail']:
-    #     _sm = _sm.order_by(index=r_order)
-    # else:
-    query = query.order_by(r_order).skip(offset).limit(limit)
-    return query, res
+    res.count, res.remaining, res.page, res.total_pages = count, max(count - offset, 0), page, total_pages
+    res.count_exact = exact
+    res.limit = limit
+
+    # The page query fetches one extra row, just to find out whether there's a next page
+    rows = [
+        row async for row in store.find(
+            'sent_mail', conds, order_by=order_by, order_dir=order_dir, after=after,
+            offset=0 if after is not None else offset, limit=limit + 1, fields=fields
+        )
+    ]
+    if len(rows) > limit:
+        rows = rows[:limit]
+        res.next_cursor = encode_cursor(rows[-1], order_by, order_dir)
+    res.result = rows
+    return res
+
+
+async def _search_conditions(q: Optional[str], store: Storage) -> List[Condition]:
+    """
+    Parse the full-text search ``q`` into a condition per token (see :mod:`postfixparser.search`), and estimate
+    how many messages contain each one - counting at most :attr:`.MULTI_INDEX_MAX_ROWS` index entries per token,
+    and caching the estimates in :attr:`.COUNT_CACHE`. The :class:`.QueryPlanner` then looks up the rarest token.
+    """
+    if empty(q):
+        return []
+    conds, generation = search_conditions(str(q)), current_generation()
 
+    async def _estimate(c: Condition):
+        key = ('sent_mail', TOKENS_FIELD, c.value)
+        c.estimate = COUNT_CACHE.get(key, generation)
+        metrics.CACHE_REQUESTS.inc(cache='count', result='miss' if c.estimate is None else 'memory')
+        if c.estimate is None:
+            c.estimate = await store.estimate('sent_mail', [c], limit=MULTI_INDEX_MAX_ROWS)
+            COUNT_CACHE.set(key, c.estimate, generation)
+
+    await asyncio.gather(*[_estimate(c) for c in conds])
+    log.debug('Search token estimates: %s', {c.value: c.estimate for c in conds})
+    return conds
 
-async def _process_filters(query: QueryOrTable, frm: Mapping, skip_keys: List[str] = None) -> QueryOrTable:
-    if empty(frm, itr=True):
-        return query
-    
-    skip_keys = ['limit', 'offset', 'page'] if not skip_keys else skip_keys
-    
-    for fkey, fval in frm.items():
-        if fkey in skip_keys:
-            continue
-
-        query = await _filter_form_key(fkey=fkey, fval=fval, query=query)
-    return query
-
-
-async def _filter_form_key(fkey: str, fval: str, query: QueryOrTable) -> QueryOrTable:
-    if '.' in fkey:
-        k1, k2 = fkey.split('.')
-        return query.filter(lambda m: m[k1][k2] == fval)
-    if '__lt' in fkey:
-        fkey = fkey.replace('__lt', '')
-        return query.filter(lambda m: m[fkey] <= fval)
-    if '__gt' in fkey:
-        fkey = fkey.replace('__gt', '')
-        return query.filter(lambda m: m[fkey] >= fval)
-    # If the form key value starts or ends with an asterisk, then we use .match() with regex filtering
-    # to find items which start/end with the actual value (rval = without asterisks)
-    if fval.startswith('*') or fval.endswith('*'):
-        rval = fval.replace('*', '')  # fval but without asterisks
-        if fval.startswith('*') and fval.endswith('*'):  # matches: *something*
-            query = query.filter(lambda m: m[fkey].match(rval))
-        elif fval.startswith('*'):  # matches: *something
-            query = query.filter(lambda m: m[fkey].match(f"{rval}$"))
-        elif fval.endswith('*'):  # matches: something*
-            query = query.filter(lambda m: m[fkey].match(f"^{rval}"))
-        return query
-
-    return query.filter(lambda m: m[fkey] == fval)
+
+async def _resolve_recipients(conds: List[Condition], store: Storage) -> Tuple[List[Condition], List[str]]:
+    """
+    Replace the recipient filters in ``conds`` (e.g. ``mail_to=*@example.com``) with an ``id in (...)`` condition
+    holding the queue IDs of the messages with a matching recipient, looked up from the indexed ``deliveries``
+    table (see :mod:`postfixparser.deliveries`) - so messages match on any of their recipients, not just the last
+    one stored in ``sent_mail``. The queue IDs are cached in :attr:`.COUNT_CACHE`.
+
+    If more than :attr:`.settings.recipient_lookup_max` messages match, ``conds`` are returned unchanged (so only
+    the last recipient of each message is matched), along with a note to add to the response ``messages``.
+
+    :return tuple res: ``(conditions, notes)``
+    """
+    split = recipient_conditions(conds)
+    if split is None:
+        return conds, []
+    rconds, rest = split
+    key, generation = (DELIVERIES_TABLE, 'queue_ids', filters_key(rconds)), current_generation()
+    ids = COUNT_CACHE.get(key, generation)
+    metrics.CACHE_REQUESTS.inc(cache='count', result='miss' if ids is None else 'memory')
+    if ids is None:
+        limit = settings.recipient_lookup_max
+        rows = [
+            d['queue_id'] async for d in store.find(DELIVERIES_TABLE, rconds, fields=('queue_id',), limit=limit + 1)
+        ]
+        # A message may have several matching recipients, so it's the number of records which is limited
+        ids = tuple(sorted(set(rows))) if len(rows) <= limit else False
+        COUNT_CACHE.set(key, ids, generation)
+    if ids is False:
+        return conds, [
+            f"More than {settings.recipient_lookup_max} messages match the recipient filter, so it was only "
+            f"matched against the last recipient of each message"
+        ]
+    log.debug('Recipient filters %s matched %d messages', rconds, len(ids))
+    return rest + [Condition('id', 'in', ids)], []
+
+
+async def _estimate_ranges(conds: List[Condition], store: Storage):
+    """
+    Estimate how many messages fall in each address prefix / suffix range from :func:`.parse_filters` (e.g.
+    ``mail_from=bob*``) - counting at most :attr:`.MULTI_INDEX_MAX_ROWS` index entries, and caching the estimates in
+    :attr:`.COUNT_CACHE`. The :class:`.QueryPlanner` reads small ranges from the index, instead of streaming the whole
+    table in order.
+    """
+    generation, ranges = current_generation(), {}
+    for c in conds:
+        if c.field in ADDRESS_DERIVED_FIELDS and c.op in ('ge', 'le'):
+            ranges.setdefault(c.field, []).append(c)
+
+    async def _estimate(bounds: List[Condition]):
+        key = ('sent_mail', 'estimate', filters_key(bounds))
+        estimate = COUNT_CACHE.get(key, generation)
+        metrics.CACHE_REQUESTS.inc(cache='count', result='miss' if estimate is None else 'memory')
+        if estimate is None:
+            estimate = await store.estimate('sent_mail', bounds, limit=MULTI_INDEX_MAX_ROWS)
+            COUNT_CACHE.set(key, estimate, generation)
+        for c in bounds:
+            c.estimate = estimate
+
+    await asyncio.gather(*[_estimate(bounds) for bounds in ranges.values()])
+    if len(ranges) > 0:
+        log.debug('Address range estimates: %s', {f: b[0].estimate for f, b in ranges.items()})
+
+
+async def _count_query(store: Storage, conds: List[Condition], cache_key: tuple = None) -> Tuple[int, bool]:
+    """
+    Count the ``sent_mail`` rows matching ``conds``, using :attr:`.COUNT_CACHE` if ``cache_key`` is given. If
+    :attr:`.settings.count_cap` is set, and the count can't be read from an index, counting stops at the cap.
+
+    :return tuple count: ``(count, exact)`` - ``exact`` is ``False`` if the count was capped
+    """
+    generation = current_generation()
+    if cache_key is not None:
+        cached = COUNT_CACHE.get(cache_key, generation)
+        metrics.CACHE_REQUESTS.inc(cache='count', result='miss' if cached is None else 'memory')
+        if cached is not None:
+            return cached
+
+    res = await store.count('sent_mail', conds, cap=settings.count_cap)
+
+    if cache_key is not None:
+        COUNT_CACHE.set(cache_key, res, generation)
+    return res
 
 
 @app.errorhandler(404)
@@ -250,6 +622,18 @@ async def api_exception_handler(exc: APIException, *args, **kwargs):
     return await api.handle_error(err_code=exc.error_code, err_msg=exc.message, code=exc.status, exc=exc, template=exc.template)
 
 
+@app.errorhandler(PoolTimeout)
+async def pool_timeout_handler(exc: PoolTimeout, *args, **kwargs):
+    log.warning("Request gave up waiting for a DB connection: %s", str(exc))
+    return await api.handle_error('DB_UNAVAILABLE', exc=exc)
+
+
+@app.errorhandler(DatabaseLocked)
+async def db_locked_handler(exc: DatabaseLocked, *args, **kwargs):
+    log.warning("Request gave up waiting for the database to be unlocked: %s", str(exc))
+    return await api.handle_error('DB_UNAVAILABLE', exc=exc)
+
+
 @app.errorhandler(Exception)
 async def app_error_handler(exc=None, *args, **kwargs):
     log.warning("app_error_handler exception type / msg: %s / %s", type(exc), str(exc))
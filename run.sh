@@ -72,14 +72,18 @@ cd "$DIR"
 
 case "$1" in
     dev*)
-        QUART_APP=wsgi QUART_ENV=development ./wsgi.py
+        ./manage.py initdb && QUART_APP=wsgi QUART_ENV=development ./wsgi.py
         ;;
     prod*)
-        pipenv run hypercorn -b "${HOST}:${PORT}" -w "$GU_WORKERS" wsgi
+        # Create the DB / tables / indexes once, rather than in each worker
+        pipenv run ./manage.py initdb && pipenv run hypercorn -b "${HOST}:${PORT}" -w "$GU_WORKERS" wsgi
         ;;
     cron|import|parse*)
         pipenv run ./manage.py parse
         ;;
+    follow|tail)
+        exec pipenv run ./manage.py follow
+        ;;
     *)
         echo "Runner script for Privex's Postfix Log Parser"
         echo ""
@@ -90,6 +94,7 @@ case "$1" in
         msg yellow "\t dev - Start the Flask development server - UNSAFE FOR PRODUCTION"
         msg yellow "\t prod - Start the production Hypercorn server"
         msg yellow "\t parse - Parse and import Postfix logs"
+        msg yellow "\t follow - Continuously tail and import the Postfix log (instead of running 'parse' from cron)"
         msg
         ;;
 esac
@@ -0,0 +1,44 @@
+"""
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Postfix Log Parser / Web UI                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+Shared setup for the test suite - run it from the repository root with ``pipenv run pytest``.
+
+The settings are read from the environment when :mod:`postfixparser.settings` is first imported, so they're
+pointed at a temporary folder here (before any test module imports the app) - the tests use the embedded SQLite
+backend, and never touch a real RethinkDB or the importer state files in the repository.
+
+"""
+import os
+import sys
+import tempfile
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+TEST_DIR = tempfile.mkdtemp(prefix='postfixparser-tests-')
+
+os.environ.update(
+    STORAGE_BACKEND='sqlite',
+    SQLITE_PATH=join(TEST_DIR, 'maildata.sqlite3'),
+    MAIL_LOG=join(TEST_DIR, 'mail.log'),
+    CHECKPOINT_FILE=join(TEST_DIR, '.mail_log_checkpoint'),
+    FINGERPRINT_CACHE=join(TEST_DIR, '.import_fingerprints.sqlite3'),
+    METRICS_FILE=join(TEST_DIR, '.import_metrics.json'),
+    GENERATION_FILE=join(TEST_DIR, '.import_generation'),
+    RESPONSE_CACHE_DIR='',
+    LOG_TIMEZONE='UTC',
+    IGNORE_DOMAINS='localhost,127.0.0.1',
+)
@@ -0,0 +1,142 @@
+"""
+Tests for resuming a log import from a :class:`postfixparser.checkpoint.Checkpoint` - including after the log was
+rotated, truncated, or re-written in place since the checkpoint was saved.
+"""
+import asyncio
+import os
+
+from postfixparser.checkpoint import Checkpoint, find_rotated, load_checkpoint, save_checkpoint
+from postfixparser.main import track_incremental
+from postfixparser.stream import MessageTracker
+
+
+def line(second: int, qid: str, msg: str) -> str:
+    return f'2019-10-01T12:00:{second:02d}.000000+00:00 mx1 postfix/smtp[123]: {qid}: {msg}\n'
+
+
+MSG_A = [
+    line(1, 'AAAAAAAAA1', 'from=<john@example.com>, size=1234, nrcpt=1 (queue active)'),
+    line(2, 'AAAAAAAAA1', 'to=<jane@example.org>, relay=mx.example.org[1.2.3.4]:25, delay=1, dsn=2.0.0, status=sent (ok)'),
+    line(3, 'AAAAAAAAA1', 'removed'),
+]
+MSG_B = [
+    line(4, 'BBBBBBBBB2', 'from=<bob@example.com>, size=99, nrcpt=1 (queue active)'),
+    line(5, 'BBBBBBBBB2', 'to=<sue@example.net>, relay=mx.example.net[5.6.7.8]:25, delay=1, dsn=2.0.0, status=sent (ok)'),
+    line(6, 'BBBBBBBBB2', 'removed'),
+]
+
+
+def write(path, lines, mode='w'):
+    with open(path, mode) as f:
+        f.writelines(lines)
+
+
+def run(tracker: MessageTracker, logfile: str, cp: Checkpoint) -> dict:
+    """Read the new lines of ``logfile`` since ``cp``, returning the finished messages keyed by queue ID"""
+    async def _run():
+        return {m.queue_id: m async for m in track_incremental(tracker, logfile, cp)}
+    return asyncio.run(_run())
+
+
+def resume(cp_file: str, logfile: str, tracker: MessageTracker, cp: Checkpoint):
+    """Save the checkpoint as the importer does after a run, and load it back with a new tracker"""
+    cp.messages, cp.flushed = dict(tracker.messages), tracker.flushed
+    save_checkpoint(cp, cp_file)
+    cp = load_checkpoint(cp_file, logfile)
+    return MessageTracker(cp.messages, cp.flushed), cp
+
+
+def test_resume(tmp_path):
+    logfile, cp_file = str(tmp_path / 'mail.log'), str(tmp_path / 'checkpoint')
+    write(logfile, MSG_A[:2])
+    tracker, cp = MessageTracker(), load_checkpoint(cp_file, logfile)
+    assert run(tracker, logfile, cp) == {}
+    assert cp.offset == os.path.getsize(logfile)
+
+    tracker, cp = resume(cp_file, logfile, tracker, cp)
+    write(logfile, MSG_A[2:] + MSG_B, 'a')
+    done = run(tracker, logfile, cp)
+    assert sorted(done) == ['AAAAAAAAA1', 'BBBBBBBBB2']
+    assert [l.message for l in done['AAAAAAAAA1'].lines] == [l.split(': ', 2)[2].strip() for l in MSG_A]
+    assert done['AAAAAAAAA1'].mail_from == 'john@example.com'
+    assert cp.offset == os.path.getsize(logfile)
+    # Nothing new to read
+    assert run(tracker, logfile, cp) == {}
+
+
+def test_partial_line(tmp_path):
+    logfile, cp_file = str(tmp_path / 'mail.log'), str(tmp_path / 'checkpoint')
+    half = len(MSG_A[2]) // 2
+    write(logfile, MSG_A[:2] + [MSG_A[2][:half]])
+    tracker, cp = MessageTracker(), load_checkpoint(cp_file, logfile)
+    assert run(tracker, logfile, cp) == {}
+    # The incomplete line is left to be read once the rest of it is written
+    assert cp.offset == len(MSG_A[0]) + len(MSG_A[1])
+
+    tracker, cp = resume(cp_file, logfile, tracker, cp)
+    write(logfile, [MSG_A[2][half:]], 'a')
+    assert list(run(tracker, logfile, cp)) == ['AAAAAAAAA1']
+
+
+def test_resume_after_rotation(tmp_path):
+    logfile, cp_file = str(tmp_path / 'mail.log'), str(tmp_path / 'checkpoint')
+    write(logfile, MSG_A[:1])
+    tracker, cp = MessageTracker(), load_checkpoint(cp_file, logfile)
+    run(tracker, logfile, cp)
+    tracker, cp = resume(cp_file, logfile, tracker, cp)
+
+    # A line is logged before logrotate moves the file away, and the rest of the message goes into the new file
+    write(logfile, MSG_A[1:2], 'a')
+    old_inode = os.stat(logfile).st_ino
+    os.rename(logfile, logfile + '.1')
+    write(logfile, MSG_A[2:] + MSG_B)
+    assert find_rotated(logfile, old_inode) == logfile + '.1'
+
+    done = run(tracker, logfile, cp)
+    assert sorted(done) == ['AAAAAAAAA1', 'BBBBBBBBB2']
+    assert done['AAAAAAAAA1'].line_count == 3
+    assert done['AAAAAAAAA1'].mail_to == 'jane@example.org'
+    assert cp.inode == os.stat(logfile).st_ino
+    assert cp.offset == os.path.getsize(logfile)
+
+
+def test_resume_after_truncation(tmp_path):
+    logfile, cp_file = str(tmp_path / 'mail.log'), str(tmp_path / 'checkpoint')
+    write(logfile, MSG_A + MSG_B)
+    tracker, cp = MessageTracker(), load_checkpoint(cp_file, logfile)
+    assert len(run(tracker, logfile, cp)) == 2
+    tracker, cp = resume(cp_file, logfile, tracker, cp)
+
+    # e.g. logrotate's copytruncate - the same file now holds fewer bytes than the checkpoint offset
+    with open(logfile, 'w') as f:
+        f.truncate(0)
+    write(logfile, MSG_B)
+    assert list(run(tracker, logfile, cp)) == ['BBBBBBBBB2']
+    assert cp.offset == os.path.getsize(logfile)
+
+
+def test_resume_after_rewrite_in_place(tmp_path):
+    logfile, cp_file = str(tmp_path / 'mail.log'), str(tmp_path / 'checkpoint')
+    write(logfile, MSG_A)
+    tracker, cp = MessageTracker(), load_checkpoint(cp_file, logfile)
+    run(tracker, logfile, cp)
+    tracker, cp = resume(cp_file, logfile, tracker, cp)
+
+    # Same inode and at least as large, but different content - detected by the head of the file
+    with open(logfile, 'w') as f:
+        f.writelines(MSG_B + MSG_B)
+    assert list(run(tracker, logfile, cp)) == ['BBBBBBBBB2']
+
+
+def test_checkpoint_for_other_log(tmp_path):
+    logfile, cp_file = str(tmp_path / 'mail.log'), str(tmp_path / 'checkpoint')
+    save_checkpoint(Checkpoint(path=str(tmp_path / 'other.log'), offset=1234), cp_file)
+    cp = load_checkpoint(cp_file, logfile)
+    assert (cp.path, cp.offset) == (logfile, 0)
+
+
+def test_corrupt_checkpoint(tmp_path):
+    logfile, cp_file = str(tmp_path / 'mail.log'), str(tmp_path / 'checkpoint')
+    with open(cp_file, 'wb') as f:
+        f.write(b'not a pickle')
+    assert load_checkpoint(cp_file, logfile).offset == 0
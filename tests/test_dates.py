@@ -0,0 +1,61 @@
+"""
+Tests for the mail.log timestamp parsing in :mod:`postfixparser.dates` - especially inferring the year of syslog
+timestamps around new year, and on Feb 29th.
+"""
+from datetime import datetime
+
+import pytest
+import pytz
+
+from postfixparser.dates import infer_year, parse_log_epoch, parse_log_time, from_epoch
+
+
+@pytest.mark.parametrize('args,now,expected', [
+    # December's logs imported in January are from the previous year
+    ((12, 31, 23, 59, 59), datetime(2020, 1, 1, 0, 5), datetime(2019, 12, 31, 23, 59, 59)),
+    ((12, 31, 23, 59, 59), datetime(2020, 1, 15), datetime(2019, 12, 31, 23, 59, 59)),
+    # ...while the first lines of the new year are in the current year
+    ((1, 1, 0, 0, 1), datetime(2020, 1, 1, 0, 5), datetime(2020, 1, 1, 0, 0, 1)),
+    ((1, 1, 0, 0, 1), datetime(2019, 12, 31, 23, 59), datetime(2019, 1, 1, 0, 0, 1)),
+    # Up to a day in the future is tolerated (e.g. the server's clock / timezone being slightly off)
+    ((1, 1, 0, 0, 1), datetime(2019, 12, 31, 12, 0), datetime(2019, 1, 1, 0, 0, 1)),
+    ((6, 2, 10, 0, 0), datetime(2020, 6, 1, 12, 0), datetime(2020, 6, 2, 10, 0, 0)),
+    ((6, 3, 10, 0, 0), datetime(2020, 6, 1, 12, 0), datetime(2019, 6, 3, 10, 0, 0)),
+])
+def test_infer_year_boundary(args, now, expected):
+    assert infer_year(*args, now=now) == expected
+
+
+@pytest.mark.parametrize('now,expected_year', [
+    (datetime(2020, 3, 1), 2020),   # Leap year
+    (datetime(2020, 2, 29, 12), 2020),
+    (datetime(2021, 3, 1), 2020),   # The most recent Feb 29th
+    (datetime(2023, 6, 1), 2020),
+    (datetime(2024, 2, 28), 2020),  # Feb 29th 2024 is more than a day away
+    (datetime(2024, 2, 29, 1), 2024),
+])
+def test_infer_year_leap_day(now, expected_year):
+    assert infer_year(2, 29, 8, 0, 0, now=now) == datetime(expected_year, 2, 29, 8, 0, 0)
+
+
+def test_infer_year_invalid_date():
+    with pytest.raises(ValueError):
+        infer_year(2, 30, 0, 0, 0, now=datetime(2020, 3, 1))
+
+
+def test_parse_rfc3339():
+    dt = parse_log_time('2019-10-01T12:34:56.123456+02:00')
+    assert dt == datetime(2019, 10, 1, 10, 34, 56, 123456, tzinfo=pytz.UTC)
+    assert parse_log_time('2019-10-01T12:34:56Z') == datetime(2019, 10, 1, 12, 34, 56, tzinfo=pytz.UTC)
+
+
+def test_parse_syslog_is_aware():
+    dt = parse_log_time('Jan  2 03:04:05')
+    assert dt.tzinfo is not None
+    assert (dt.month, dt.day, dt.hour, dt.minute, dt.second) == (1, 2, 3, 4, 5)
+
+
+def test_epoch_round_trip():
+    raw = '2019-10-01T12:34:56.123456+00:00'
+    assert parse_log_epoch(raw) == parse_log_time(raw).timestamp()
+    assert from_epoch(parse_log_epoch(raw)) == parse_log_time(raw)
@@ -0,0 +1,140 @@
+"""
+Tests for the per-recipient delivery records (:mod:`postfixparser.deliveries`) - so that ``mail_to`` filters match
+any recipient of a message, not just the last one stored in ``sent_mail``.
+"""
+import asyncio
+
+import pytest
+
+from postfixparser import settings
+from postfixparser.deliveries import line_delivery, message_deliveries, recipient_conditions
+from postfixparser.main import _insert_batch, _tracked_docs
+from postfixparser.query import Condition, parse_filters
+from postfixparser.storage import OnConflict, get_storage
+from postfixparser.stream import MessageTracker
+from postfixparser.webui import _resolve_recipients
+
+
+def line(second: int, qid: str, msg: str) -> str:
+    return f'2019-10-01T12:00:{second:02d}.000000+00:00 mx1 postfix/smtp[123]: {qid}: {msg}'
+
+
+def delivery(second: int, qid: str, to: str, status: str = 'sent', relay='mx.example.com[1.2.3.4]:25') -> str:
+    return line(second, qid, f'to=<{to}>, relay={relay}, delay=0.5, delays=0/0/0.2/0.3, dsn=2.0.0, status={status} (ok)')
+
+
+# A message to three recipients - the first is deferred and then delivered. Only the last recipient logged
+# (carol@other.org) ends up in the sent_mail document.
+MULTI = [
+    line(0, 'DDDDDDDDD1', 'from=<bob@example.org>, size=100, nrcpt=3 (queue active)'),
+    delivery(1, 'DDDDDDDDD1', 'Alice@Example.com', 'deferred', relay='none'),
+    delivery(2, 'DDDDDDDDD1', 'dave@example.com'),
+    delivery(3, 'DDDDDDDDD1', 'alice@example.com'),
+    delivery(4, 'DDDDDDDDD1', 'carol@other.org'),
+    line(5, 'DDDDDDDDD1', 'removed'),
+]
+SINGLE = [
+    line(6, 'DDDDDDDDD2', 'from=<eve@example.net>, size=100, nrcpt=1 (queue active)'),
+    delivery(7, 'DDDDDDDDD2', 'dave@example.com', 'bounced'),
+    line(8, 'DDDDDDDDD2', 'removed'),
+]
+
+
+async def feed(tracker: MessageTracker, lines):
+    for l in lines:
+        for m in tracker.feed(l):
+            yield m
+
+
+def docs(lines) -> list:
+    """The ``sent_mail`` documents which streaming ``lines`` through a :class:`.MessageTracker` would write"""
+    async def _docs():
+        tracker = MessageTracker()
+        return [d async for d in _tracked_docs(feed(tracker, lines), tracker, convert_time=lambda dt: dt)]
+    return asyncio.run(_docs())
+
+
+def test_line_delivery():
+    d = line_delivery('to=<john@example.com>, relay=none, delay=3.2, delays=0/0/3.2/0, dsn=4.4.1, '
+                      'status=deferred (connect to mx.example.com[1.2.3.4]:25: Connection timed out)')
+    assert (d['recipient'], d['relay']['host'], d['delay'], d['dsn'], d['status']['code']) == \
+        ('john@example.com', 'none', 3.2, '4.4.1', 'deferred')
+    assert (d['recipient_local'], d['recipient_domain'], d['recipient_rdomain']) == ('john', 'example.com', 'moc.elpmaxe')
+    assert line_delivery('from=<bob@example.org>, size=100, nrcpt=1 (queue active)') is None
+    assert line_delivery('removed') is None
+
+
+def test_message_deliveries():
+    doc, = docs(MULTI)
+    assert doc['mail_to'] == 'carol@other.org'
+    records = {d['recipient']: d for d in message_deliveries(doc)}
+    # Addresses are stored as logged - the lowercase parts are what's indexed
+    assert sorted(records) == ['Alice@Example.com', 'alice@example.com', 'carol@other.org', 'dave@example.com']
+    assert records['dave@example.com']['id'] == 'DDDDDDDDD1/dave@example.com'
+    assert records['dave@example.com']['queue_id'] == 'DDDDDDDDD1'
+    assert records['Alice@Example.com']['status']['code'] == 'deferred'
+    assert records['alice@example.com']['status']['code'] == 'sent'
+
+
+def test_latest_attempt_per_recipient():
+    doc = {'id': 'X', 'lines': [
+        {'timestamp': 1, 'message': 'to=<a@example.com>, relay=none, delay=1, dsn=4.4.1, status=deferred (timeout)'},
+        {'timestamp': 2, 'message': 'to=<a@example.com>, relay=mx[1.2.3.4]:25, delay=1, dsn=2.0.0, status=sent (ok)'},
+    ]}
+    record, = message_deliveries(doc)
+    assert (record['status']['code'], record['timestamp']) == ('sent', 2)
+
+
+def test_recipient_conditions():
+    conds = parse_filters({'mail_to': '*@example.com', 'status.code': 'sent'})
+    rconds, rest = recipient_conditions(conds)
+    assert rconds == [Condition('recipient_domain', 'eq', 'example.com')]
+    assert rest == [Condition('status.code', 'eq', 'sent')]
+    # Only filters which an index can answer are moved onto deliveries
+    assert recipient_conditions(parse_filters({'mail_to': '*smith*'})) is None
+    assert recipient_conditions(parse_filters({'status.code': 'sent'})) is None
+
+
+@pytest.fixture(scope='module')
+def store():
+    batch = docs(MULTI + SINGLE)
+
+    async def _load():
+        s = get_storage()
+        await s.bootstrap()
+        await _insert_batch('sent_mail', batch, OnConflict.MERGE, retries=0, deliveries=True)
+        return s
+    return asyncio.run(_load())
+
+
+def search(store, filters: dict):
+    """The queue IDs of the messages matching ``filters`` - like ``/api/emails``, and any notes it would add"""
+    async def _run():
+        conds, notes = await _resolve_recipients(parse_filters(filters), store)
+        found = [d['id'] async for d in store.find('sent_mail', conds, order_by='id', order_dir='asc')]
+        return found, notes
+    return asyncio.run(_run())
+
+
+@pytest.mark.parametrize('filters,expected', [
+    # Not the last recipient of DDDDDDDDD1
+    ({'mail_to': 'dave@example.com'}, ['DDDDDDDDD1', 'DDDDDDDDD2']),
+    ({'mail_to': 'alice@example.com'}, ['DDDDDDDDD1']),
+    ({'mail_to': 'carol@other.org'}, ['DDDDDDDDD1']),
+    ({'mail_to': '*@example.com'}, ['DDDDDDDDD1', 'DDDDDDDDD2']),
+    ({'mail_to': 'ALICE@*'}, ['DDDDDDDDD1']),
+    ({'mail_to': '*other.org'}, ['DDDDDDDDD1']),
+    # Other filters still apply to the message
+    ({'mail_to': 'dave@example.com', 'status.code': 'bounced'}, ['DDDDDDDDD2']),
+    ({'mail_to': 'nobody@example.com'}, []),
+])
+def test_mail_to_matches_any_recipient(store, filters, expected):
+    assert search(store, filters) == (expected, [])
+
+
+def test_recipient_lookup_limit(store, monkeypatch):
+    monkeypatch.setattr(settings, 'recipient_lookup_max', 1)
+    # Too many matches - falls back to the last recipient stored in sent_mail, with a note
+    found, notes = search(store, {'mail_to': 'dave@*'})
+    assert found == ['DDDDDDDDD2']
+    assert len(notes) == 1
@@ -0,0 +1,112 @@
+"""
+Tests for :mod:`postfixparser.fingerprints` - unchanged messages are skipped on re-import, and any change to a
+message (or writing to a different DB) invalidates it's cached fingerprint.
+"""
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from postfixparser.fingerprints import FINGERPRINT_FIELD, FingerprintCache
+from postfixparser.main import _insert_batch, _tracked_docs
+from postfixparser.objects import PostfixMessage
+from postfixparser.storage import OnConflict, get_storage
+from postfixparser.stream import MessageTracker
+
+
+def message(*lines) -> PostfixMessage:
+    msg = PostfixMessage(timestamp='2019-10-01T12:00:00+00:00', queue_id='AAAAAAAAA1')
+    for ts, text in lines:
+        msg.add_line(f'2019-10-01T12:00:{ts:02d}+00:00', text)
+    msg.mail_from, msg.mail_to = 'bob@example.org', 'jane@example.com'
+    return msg
+
+
+LINES = [(0, 'from=<bob@example.org>, size=100, nrcpt=1 (queue active)'), (1, 'to=<jane@example.com>, status=sent (ok)')]
+
+
+@pytest.fixture
+def cache(tmp_path) -> FingerprintCache:
+    c = FingerprintCache(str(tmp_path / 'fingerprints.sqlite3'), 'sqlite:/data/maildata.sqlite3')
+    yield c
+    c.close()
+
+
+async def _docs(msg: PostfixMessage, cache: FingerprintCache) -> list:
+    async def _msgs():
+        yield msg
+    tracker = MessageTracker()
+    return [d async for d in _tracked_docs(_msgs(), tracker, convert_time=lambda dt: dt, fingerprints=cache)]
+
+
+def docs(msg: PostfixMessage, cache: FingerprintCache) -> list:
+    return asyncio.run(_docs(msg, cache))
+
+
+def test_fingerprint_is_stable():
+    assert message(*LINES).fingerprint == message(*LINES).fingerprint
+
+
+@pytest.mark.parametrize('change', [
+    lambda m: m.add_line('2019-10-01T12:00:02+00:00', 'removed'),
+    lambda m: setattr(m, 'status', {'code': 'bounced', 'message': '(550 unknown user)'}),
+])
+def test_fingerprint_changes(change):
+    msg = message(*LINES)
+    before = msg.fingerprint
+    change(msg)
+    assert msg.fingerprint != before
+
+
+def test_unchanged_skipped(cache):
+    msg = message(*LINES)
+    assert not cache.unchanged(msg)
+    written = docs(msg, cache)
+    assert [d['id'] for d in written] == ['AAAAAAAAA1']
+    assert written[0][FINGERPRINT_FIELD] == msg.fingerprint
+    cache.record(written)
+
+    # Re-reading the same lines (e.g. parse --full) doesn't write the message again
+    assert cache.unchanged(message(*LINES))
+    assert docs(message(*LINES), cache) == []
+    # ...but a new line does
+    more = message(*LINES, (2, 'removed'))
+    assert not cache.unchanged(more)
+    assert len(docs(more, cache)) == 1
+
+
+def test_not_recorded_until_written(cache):
+    msg = message(*LINES)
+    docs(msg, cache)
+    assert cache.get(msg.queue_id) is None
+
+
+def test_other_db_empties_cache(cache):
+    cache.record([{'id': 'AAAAAAAAA1', FINGERPRINT_FIELD: 'abc'}])
+    # Re-opening for the same DB keeps the fingerprints
+    same = FingerprintCache(cache.path, cache.location)
+    assert same.get('AAAAAAAAA1') == 'abc'
+    same.close()
+    other = FingerprintCache(cache.path, 'rethinkdb:otherhost:28015/maildata')
+    assert other.get('AAAAAAAAA1') is None
+    other.close()
+
+
+def test_prune_and_clear(cache):
+    cache.record([{'id': 'AAAAAAAAA1', FINGERPRINT_FIELD: 'abc'}, {'id': 'BBBBBBBBB2', FINGERPRINT_FIELD: 'def'}])
+    assert cache.prune(timedelta(days=1)) == 0
+    assert cache.prune(timedelta(seconds=-1)) == 2
+    cache.record([{'id': 'AAAAAAAAA1', FINGERPRINT_FIELD: 'abc'}])
+    cache.clear()
+    assert cache.get('AAAAAAAAA1') is None
+
+
+def test_recorded_after_insert(cache):
+    msg = message(*LINES)
+
+    async def _run():
+        await get_storage().bootstrap()
+        return await _insert_batch('sent_mail', await _docs(msg, cache), OnConflict.MERGE, retries=0, fingerprints=cache)
+    res = asyncio.run(_run())
+    assert res['errors'] == 0
+    assert cache.unchanged(msg)
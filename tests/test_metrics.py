@@ -0,0 +1,41 @@
+"""
+Tests for the Prometheus text output of :mod:`postfixparser.metrics`, and access to ``/metrics``.
+"""
+import asyncio
+
+import pytest
+
+from postfixparser import settings
+from postfixparser.metrics import Registry
+from postfixparser.webui import app
+
+
+def test_label_values_escaped():
+    reg = Registry()
+    reg.counter('test_requests_total', 'Requests', ['route']).inc(route='/a\\b "c"\nd')
+    assert 'test_requests_total{route="/a\\\\b \\"c\\"\\nd"} 1' in reg.render().splitlines()
+
+
+def test_histogram_labels():
+    reg = Registry()
+    reg.histogram('test_seconds', 'Latency', ['stage'], buckets=[0.1, 1]).observe(0.5, stage='x"y')
+    lines = reg.render().splitlines()
+    assert 'test_seconds_bucket{stage="x\\"y",le="1"} 1' in lines
+    assert 'test_seconds_count{stage="x\\"y"} 1' in lines
+
+
+@pytest.mark.parametrize('token,public,header,status', [
+    ('', False, None, 404),       # Disabled by default
+    ('', True, None, 200),
+    ('secret', False, None, 401),
+    ('secret', False, 'Bearer wrong', 401),
+    ('secret', False, 'Bearer secret', 200),
+])
+def test_metrics_access(monkeypatch, token, public, header, status):
+    monkeypatch.setattr(settings, 'metrics_token', token)
+    monkeypatch.setattr(settings, 'metrics_public', public)
+
+    async def _get():
+        res = await app.test_client().get('/metrics', headers={'Authorization': header} if header else {})
+        return res.status_code
+    assert asyncio.run(_get()) == status
@@ -0,0 +1,92 @@
+"""
+Tests for :mod:`postfixparser.parallel` - parsing a log file with several worker processes must give exactly the
+same messages (and continuations) as the serial :class:`.MessageTracker`, including when a queue ID is re-used
+after ``removed``, or a message is flushed as idle part way through a byte range.
+"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+from postfixparser.main import _tracked_docs, track_file
+from postfixparser.parallel import parse_range
+from postfixparser.stream import MessageTracker
+
+T0 = datetime(2019, 12, 1, tzinfo=pytz.UTC)
+IDLE = timedelta(minutes=30)
+
+
+def line(secs: int, qid: str, msg: str) -> str:
+    return f'{(T0 + timedelta(seconds=secs)).isoformat()} mx1 postfix/smtp[123]: {qid}: {msg}\n'
+
+
+def message(secs: int, qid: str, status: str = 'sent', removed: bool = True) -> list:
+    lines = [
+        line(secs, qid, 'from=<bob@example.org>, size=100, nrcpt=1 (queue active)'),
+        line(secs + 1, qid, f'to=<jane@example.com>, relay=mx.example.com[1.2.3.4]:25, delay=1, dsn=2.0.0, '
+                            f'status={status} (ok)'),
+    ]
+    return lines + ([line(secs + 2, qid, 'removed')] if removed else [])
+
+
+def mail_log(count: int = 20) -> list:
+    """
+    ``count`` rounds of: a queue ID used for two messages in a row, and a deferred message which goes idle
+    (while another message is delivered) before it's retried
+    """
+    lines = []
+    for i in range(count):
+        t, reused, deferred, other = i * 4000, f'A{i:09X}', f'B{i:09X}', f'C{i:09X}'
+        lines += message(t, reused)
+        lines += message(t + 3, deferred, status='deferred', removed=False)
+        lines += message(t + 10, reused)
+        lines += message(t + 3600, other)
+        lines.append(line(t + 3700, deferred, 'to=<jane@example.com>, relay=mx.example.com[1.2.3.4]:25, delay=1, '
+                                              'dsn=2.0.0, status=sent (ok)'))
+        lines.append(line(t + 3701, deferred, 'removed'))
+    return lines
+
+
+def tracked(path: str, workers: int) -> list:
+    """The ``sent_mail`` documents which importing ``path`` would write, in a stable order"""
+    async def _run():
+        tracker = MessageTracker(idle_timeout=IDLE)
+        msgs = track_file(tracker, path, workers=workers)
+        return [d async for d in _tracked_docs(msgs, tracker, convert_time=lambda dt: dt)]
+    return sorted(asyncio.run(_run()), key=lambda d: (d['id'], d['first_attempt']))
+
+
+@pytest.fixture(scope='module')
+def log_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp('parallel') / 'mail.log'
+    path.write_text(''.join(mail_log()))
+    return str(path)
+
+
+def test_reused_queue_id_split(tmp_path):
+    path = tmp_path / 'mail.log'
+    path.write_text(''.join(message(0, 'AAAAAAAAA1') + message(10, 'AAAAAAAAA1')))
+    segments, stats = parse_range(str(path), 0, path.stat().st_size)
+    assert [qid for qid, _, _ in segments] == ['AAAAAAAAA1', 'AAAAAAAAA1']
+    assert [p[2][-1] for _, p, _ in segments] == ['removed', 'removed']
+    assert stats['lines'] == 6
+
+
+def test_idle_split(tmp_path):
+    path = tmp_path / 'mail.log'
+    path.write_text(''.join(
+        message(0, 'BBBBBBBBB1', removed=False) + message(3600, 'CCCCCCCCC1') + [line(3700, 'BBBBBBBBB1', 'removed')]
+    ))
+    segments, _ = parse_range(str(path), 0, path.stat().st_size, idle_timeout=IDLE.total_seconds())
+    assert [qid for qid, _, _ in segments] == ['BBBBBBBBB1', 'CCCCCCCCC1', 'BBBBBBBBB1']
+    # The newest line read before the continuation, which the idle time is measured from
+    assert segments[2][2] == (T0 + timedelta(seconds=3602)).timestamp()
+
+
+@pytest.mark.parametrize('workers', [2, 3])
+def test_parallel_matches_serial(log_path, workers):
+    serial = tracked(log_path, workers=1)
+    # Each reused queue ID is two messages, and each deferred message is written again as a continuation
+    assert len(serial) == 20 * 5
+    assert tracked(log_path, workers=workers) == serial
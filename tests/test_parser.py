@@ -0,0 +1,92 @@
+"""
+Tests for :func:`postfixparser.parser.tokenize_line` - it must return the same fields as the original per-key
+regexes (:func:`postfixparser.benchmark.regex_parse_line`), except where those picked up ``orig_to=<...>``.
+"""
+import pytest
+
+from postfixparser.benchmark import divergence, parser_divergences, regex_parse_line, synthetic_messages
+from postfixparser.loggen import MailLogGenerator
+from postfixparser.parser import match, parse_line, tokenize_line
+
+LINES = [
+    'client=mail1.example.com[1.2.3.4]',
+    'client=unknown[2001:db8::1]',
+    'message-id=<5da1b2c3.1c69fb81.4f3e.1234@mx.google.com>',
+    'message-id=<>',
+    'from=<john@example.com>, size=1234, nrcpt=1 (queue active)',
+    'from=<>, size=3012, nrcpt=1 (queue active)',
+    'to=<jane.doe@gmail.com>, relay=gmail-smtp-in.l.google.com[173.194.76.27]:25, delay=1.2, '
+    'delays=0.01/0/0.5/0.7, dsn=2.0.0, status=sent (250 2.0.0 OK  1569921234 a1si123456qkb.12 - gsmtp)',
+    'to=<bob@example.org>, relay=none, delay=30, delays=0/0/30/0, dsn=4.4.1, '
+    'status=deferred (connect to mx.example.org[5.6.7.8]:25: Connection timed out)',
+    'to=<x@example.com>, relay=mx.example.com[1.2.3.4]:25, delay=0.4, delays=0/0/0.2/0.2, dsn=5.1.1, '
+    'status=bounced (host mx.example.com[1.2.3.4] said: 550 5.1.1 <x@example.com>: Recipient address rejected)',
+    'removed',
+    'warning: header Subject: hello from localhost[127.0.0.1]',
+]
+
+
+@pytest.mark.parametrize('line', LINES)
+def test_matches_regex_parser(line):
+    assert tokenize_line(line) == regex_parse_line(line)
+
+
+def test_matches_regex_parser_synthetic():
+    counts = parser_divergences(synthetic_messages(3000, seed=42))
+    # The corpus includes the lines the old regexes mis-parse - and nothing else may differ
+    assert counts['orig_to'] > 0 and counts['relay_in_status'] > 0
+    assert counts['unexpected'] == 0
+
+
+def test_unexpected_divergence():
+    line = 'to=<a@example.com>, relay=local, status=sent (ok)'
+    assert divergence(line, {'mail_to': 'b@example.com'}, tokenize_line(line)) == 'unexpected'
+
+
+def test_matches_regex_parser_generated_log():
+    for line in MailLogGenerator(seed=7).lines(300):
+        m = match.match(line)
+        if m is None:
+            continue
+        msg = m.group(3)
+        if '[' in msg.partition('status=')[2]:
+            continue   # See test_relay_not_taken_from_status
+        assert tokenize_line(msg) == regex_parse_line(msg), line
+
+
+def test_orig_to_skipped():
+    line = 'to=<john@example.com>, orig_to=<postmaster@example.com>, relay=local, delay=0.1, dsn=2.0.0, ' \
+           'status=sent (delivered to mailbox)'
+    assert tokenize_line(line)['mail_to'] == 'john@example.com'
+    # The greedy regex matched the last "to=<...>" on the line - i.e. the orig_to address
+    assert regex_parse_line(line)['mail_to'] == 'postmaster@example.com'
+
+
+def test_orig_to_only():
+    assert 'mail_to' not in tokenize_line('orig_to=<postmaster@example.com>, relay=local, status=sent (ok)')
+
+
+def test_relay_not_taken_from_status():
+    line = 'to=<a@example.com>, relay=mx.example.com[1.2.3.4]:25, delay=2, dsn=4.4.1, ' \
+           'status=deferred (connect to mx.example.com[1.2.3.4]:25: Connection timed out)'
+    assert tokenize_line(line)['relay'] == {'host': 'mx.example.com', 'ip': '1.2.3.4', 'port': '25'}
+    # The greedy regex ran the IP on until the last "]:25" on the line, inside the status message
+    assert regex_parse_line(line)['relay']['ip'].startswith('1.2.3.4]:25, delay=2')
+
+
+def test_only_present_keys():
+    assert tokenize_line('removed') == {}
+    assert tokenize_line('to=<a@example.com>, status=sent (ok)') == {
+        'mail_to': 'a@example.com', 'status': {'code': 'sent', 'message': '(ok)'},
+    }
+
+
+def test_status_message_ends_line():
+    # Keys inside the free text status message aren't parsed
+    res = tokenize_line('to=<a@example.com>, status=bounced (550 unknown to=<b@example.com> relay=x[1.2.3.4]:25)')
+    assert res['mail_to'] == 'a@example.com'
+    assert 'relay' not in res
+
+
+def test_parse_line_alias():
+    assert parse_line(LINES[6]) == tokenize_line(LINES[6])
@@ -0,0 +1,154 @@
+"""
+Tests for :class:`postfixparser.query.QueryPlanner` - which ``sent_mail`` index a query is served from, and which
+conditions are left over to be filtered - and for the keyset pagination cursors.
+"""
+import base64
+import json
+from datetime import datetime
+
+import pytest
+import pytz
+
+from postfixparser.exceptions import APIException
+from postfixparser.query import (
+    MAX_CHAR, MULTI_INDEX_MAX_ROWS, Condition, QueryPlanner, decode_cursor, encode_cursor, parse_filters
+)
+
+
+@pytest.fixture(scope='module')
+def planner() -> QueryPlanner:
+    return QueryPlanner.for_table('sent_mail')
+
+
+def test_no_filters_streams_ordered_index(planner):
+    plan = planner.plan([])
+    assert (plan.index, plan.index_ordered, plan.between, plan.filters) == ('last_attempt', True, None, [])
+    assert plan.order_dir == 'desc'
+
+
+def test_primary_key(planner):
+    conds = parse_filters({'id': 'ABCDEF1234', 'status.code': 'sent'})
+    plan = planner.plan(conds)
+    assert (plan.index, plan.get_all) == ('id', 'ABCDEF1234')
+    assert plan.filters == [Condition('status.code', 'eq', 'sent')]
+
+
+def test_primary_key_in(planner):
+    plan = planner.plan([Condition('id', 'in', ('A', 'B')), Condition('status.code', 'eq', 'sent')])
+    assert (plan.index, plan.get_all_keys, plan.index_ordered) == ('id', ('A', 'B'), False)
+    assert [c.field for c in plan.filters] == ['status.code']
+
+
+def test_compound_index_covers_filter_and_order(planner):
+    plan = planner.plan(parse_filters({'status.code': 'bounced', 'mail_from': 'x@example.com'}))
+    # Both compound indexes cover one equality filter and the order (the first one listed wins a tie) - the other
+    # filter is applied afterwards
+    assert (plan.index, plan.index_ordered) == ('status_last_attempt', True)
+    assert plan.between == (['bounced', None], ['bounced', None])
+    assert plan.filters == [Condition('mail_from', 'eq', 'x@example.com')]
+
+
+def test_range_on_ordered_field(planner):
+    since = datetime(2019, 10, 1, tzinfo=pytz.UTC)
+    plan = planner.plan(parse_filters({'last_attempt__gt': '2019-10-01', 'status.code': 'sent'}))
+    assert (plan.index, plan.index_ordered) == ('status_last_attempt', True)
+    assert plan.between == (['sent', since], ['sent', None])
+    assert plan.filters == []
+
+
+def test_unordered_prefers_filter_index(planner):
+    plan = planner.plan(parse_filters({'mail_to': 'jane@example.com'}), order_by=None)
+    assert (plan.index, plan.get_all, plan.index_ordered) == ('mail_to', 'jane@example.com', False)
+    assert plan.filters == []
+
+
+def test_order_by_other_field(planner):
+    plan = planner.plan(parse_filters({'status.code': 'sent'}), order_by='mail_to', order_dir='asc')
+    assert (plan.index, plan.index_ordered, plan.order_dir) == ('mail_to', True, 'asc')
+    assert [c.field for c in plan.filters] == ['status.code']
+
+
+def test_address_prefix(planner):
+    conds = parse_filters({'mail_from': 'bob*'})
+    assert conds == [Condition('mail_from_local', 'ge', 'bob'), Condition('mail_from_local', 'le', 'bob' + MAX_CHAR)]
+    # Without an estimate, streaming the table in order beats sorting an unknown number of rows in memory
+    assert planner.plan(conds).index == 'last_attempt'
+    # A range known to be small is read from it's index, and sorted in memory
+    for c in conds:
+        c.estimate = 50
+    plan = planner.plan(conds)
+    assert (plan.index, plan.index_ordered) == ('mail_from_local_last_attempt', False)
+    assert plan.between == (['bob', None], ['bob' + MAX_CHAR, None])
+    assert plan.filters == []
+
+
+def test_address_suffix(planner):
+    plan = planner.plan(parse_filters({'mail_to': '*@example.com'}))
+    assert (plan.index, plan.index_ordered) == ('mail_to_domain_last_attempt', True)
+    assert plan.between == (['example.com', None], ['example.com', None])
+
+
+def test_unindexed_wildcard_is_filtered(planner):
+    plan = planner.plan(parse_filters({'mail_to': '*smith*'}))
+    assert plan.index == 'last_attempt'
+    assert plan.filters == [Condition('mail_to', 'match', 'smith')]
+
+
+def test_search_token(planner):
+    common = Condition('tokens', 'contains', 'gmail.com', estimate=MULTI_INDEX_MAX_ROWS * 2)
+    rare = Condition('tokens', 'contains', '5.1.1', estimate=20)
+    plan = planner.plan([common, rare])
+    assert (plan.index, plan.get_all, plan.index_ordered) == ('tokens', '5.1.1', False)
+    assert plan.filters == [common]
+    # Too common to look up - filtered while streaming the ordered index instead
+    plan = planner.plan([common])
+    assert (plan.index, plan.filters) == ('last_attempt', [common])
+
+
+def test_unknown_field_scans(planner):
+    plan = planner.plan(parse_filters({'message_id': 'abc@example.com'}), order_by=None)
+    assert plan.index is None
+    assert len(plan.filters) == 1
+
+
+@pytest.mark.parametrize('row,order_by,key', [
+    ({'id': 'AAAAAAAAA1', 'last_attempt': datetime(2019, 10, 1, 12, 34, 56, 123456, tzinfo=pytz.UTC)},
+     'last_attempt', datetime(2019, 10, 1, 12, 34, 56, 123456, tzinfo=pytz.UTC)),
+    ({'id': 'AAAAAAAAA1', 'mail_to': 'jane@example.com'}, 'mail_to', 'jane@example.com'),
+    ({'id': 'AAAAAAAAA1', 'status': {'code': 'sent'}}, 'status.code', 'sent'),
+    ({'id': 'AAAAAAAAA1', 'mail_to': ''}, 'mail_to', ''),
+])
+@pytest.mark.parametrize('order_dir', ['asc', 'desc'])
+def test_cursor_round_trip(row, order_by, key, order_dir):
+    cursor = encode_cursor(row, order_by, order_dir)
+    # Safe to pass in a query string as-is
+    assert all(c.isalnum() or c in '-_' for c in cursor)
+    assert decode_cursor(cursor, order_by, order_dir) == (key, 'AAAAAAAAA1')
+
+
+def test_cursor_missing_key():
+    assert encode_cursor({'id': 'AAAAAAAAA1'}, 'last_attempt', 'desc') is None
+    assert encode_cursor({'last_attempt': 1}, 'last_attempt', 'desc') is None
+
+
+def _raw_cursor(data) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+
+@pytest.mark.parametrize('cursor', [
+    '', 'not a cursor', '!!!!', _raw_cursor([1, 2]), _raw_cursor({'o': 'mail_to', 'd': 'desc', 'k': 'x'}),
+    _raw_cursor({'o': 'last_attempt', 'd': 'desc', 'k': {'$time': 'soon'}, 'i': 'A'}),
+    base64.urlsafe_b64encode(b'\xff\xfe').decode(),
+])
+def test_invalid_cursor(cursor):
+    with pytest.raises(APIException) as e:
+        decode_cursor(cursor, 'mail_to', 'desc')
+    assert e.value.error_code == 'INVALID_CURSOR'
+
+
+def test_cursor_for_other_order():
+    cursor = encode_cursor({'id': 'A', 'mail_to': 'x@example.com', 'mail_from': 'y@example.com'}, 'mail_to', 'desc')
+    for order_by, order_dir in [('mail_from', 'desc'), ('mail_to', 'asc')]:
+        with pytest.raises(APIException) as e:
+            decode_cursor(cursor, order_by, order_dir)
+        assert e.value.error_code == 'INVALID_CURSOR'
@@ -0,0 +1,110 @@
+"""
+Tests for keeping the stats rollups (:mod:`postfixparser.stats`) correct when a write to the DB is retried.
+"""
+import asyncio
+
+import pytest
+
+from postfixparser import main, settings
+from postfixparser.metrics import ROLLUP_ERRORS
+from postfixparser.checkpoint import Checkpoint
+from postfixparser.exceptions import DatabaseLocked
+from postfixparser.follow import LogFollower
+from postfixparser.stats import STATS_TABLE
+from postfixparser.storage import OnConflict, SQLiteStorage
+
+from tests.test_deliveries import MULTI, SINGLE, docs
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    s = SQLiteStorage(str(tmp_path / 'db.sqlite3'))
+    asyncio.run(s.bootstrap())
+    monkeypatch.setattr(main, 'get_storage', lambda: s)
+    monkeypatch.setattr(settings, 'write_retry_delay', 0)
+    monkeypatch.setattr(settings, 'stats_rollups', True)
+    yield s
+    asyncio.run(s.close())
+
+
+def fail_once_after_write(store, monkeypatch, table: str) -> list:
+    """Make the first insert into ``table`` raise a transient error *after* it was applied, like a dropped connection"""
+    insert, calls = store.insert, []
+
+    async def flaky(t, batch, conflict, return_changes=False):
+        res = await insert(t, batch, conflict, return_changes=return_changes)
+        calls.append(t)
+        if t == table and calls.count(t) == 1:
+            raise DatabaseLocked('connection lost')
+        return res
+    monkeypatch.setattr(store, 'insert', flaky)
+    return calls
+
+
+def total_messages(store) -> int:
+    async def _sum():
+        return sum([sum(d['counts'].values()) async for d in store.scan(STATS_TABLE)])
+    return asyncio.run(_sum())
+
+
+def write(batch):
+    return asyncio.run(main._insert_batch('sent_mail', batch, OnConflict.MERGE, retries=2, rollup=True))
+
+
+def errors() -> float:
+    return ROLLUP_ERRORS.values.get((), 0)
+
+
+def test_rollups_counted(store):
+    before = errors()
+    write(docs(MULTI + SINGLE))
+    counted = total_messages(store)
+    assert counted > 0
+    assert errors() == before
+    # Re-writing the same messages doesn't count them again
+    write(docs(MULTI + SINGLE))
+    assert total_messages(store) == counted
+
+
+def test_retried_message_write_is_reported(store, monkeypatch):
+    calls = fail_once_after_write(store, monkeypatch, 'sent_mail')
+    before = errors()
+    res = write(docs(MULTI + SINGLE))
+    assert calls[:2] == ['sent_mail', 'sent_mail']
+    assert res['unchanged'] == 2
+    # The retry can't tell what the first attempt changed - so it's flagged, for rebuild_stats to fix
+    assert errors() == before + 1
+
+
+def test_rollup_write_not_retried(store, monkeypatch):
+    write(docs(MULTI + SINGLE))
+    expected = total_messages(store)
+    for table in (STATS_TABLE, 'sent_mail'):
+        asyncio.run(store.delete_all(table))
+
+    calls = fail_once_after_write(store, monkeypatch, STATS_TABLE)
+    before = errors()
+    write(docs(SINGLE))
+    write(docs(MULTI))
+    assert calls.count(STATS_TABLE) == 2
+    assert errors() == before + 1
+    # The rollup insert was applied before the error - retrying it would have counted the messages twice
+    assert total_messages(store) == expected
+
+
+def test_follower_retry_is_reported(store, monkeypatch, tmp_path):
+    # With no retries left inside _insert_batch, the follower's own loop retries the batch
+    monkeypatch.setattr(settings, 'write_retries', 0)
+    calls = fail_once_after_write(store, monkeypatch, 'sent_mail')
+    batch = docs(MULTI + SINGLE)
+    before = errors()
+
+    async def _run():
+        follower = LogFollower(str(tmp_path / 'mail.log'), Checkpoint(path=str(tmp_path / 'mail.log')),
+                               checkpoint_file=str(tmp_path / 'checkpoint'))
+        await follower.write_batch(batch)
+        return follower
+    follower = asyncio.run(_run())
+    assert calls[:2] == ['sent_mail', 'sent_mail']
+    assert (follower.written, follower.failed) == (2, False)
+    assert errors() == before + 1
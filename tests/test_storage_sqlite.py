@@ -0,0 +1,144 @@
+"""
+Tests for the embedded SQLite storage backend - mainly that it's merges (:func:`.merge_message_doc` etc.) give the
+same results as the RethinkDB conflict functions they mirror (:func:`.merge_message` etc.).
+
+The ReQL functions themselves are only evaluated if a RethinkDB server is reachable at ``RETHINK_TEST_HOST``
+(e.g. ``RETHINK_TEST_HOST=localhost pytest``) - the expressions are run without touching any table.
+"""
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+from postfixparser.query import Condition, parse_filters
+from postfixparser.storage import OnConflict, SQLiteStorage
+from postfixparser.storage.rethink import merge_counts, merge_delivery, merge_message
+from postfixparser.storage.sqlite import merge_counts_doc, merge_delivery_doc, merge_message_doc
+
+T0 = datetime(2019, 10, 1, 12, 0, 0, tzinfo=pytz.UTC)
+
+
+def t(minutes: float) -> datetime:
+    return T0 + timedelta(minutes=minutes)
+
+
+def lines(*minutes) -> list:
+    return [{'timestamp': t(m), 'message': f'line at {m}'} for m in minutes]
+
+
+STORED = {
+    'id': 'AAAAAAAAA1', 'mail_from': 'bob@example.org', 'mail_to': 'jane@example.com', 'timestamp': t(0),
+    'first_attempt': t(0), 'last_attempt': t(1), 'status': {'code': 'deferred', 'message': '(try again)'},
+    'relay': {'host': 'mx.example.com', 'ip': '1.2.3.4', 'port': '25'}, 'client': {'host': 'a', 'ip': 'b'},
+    'lines': lines(0, 1), 'tokens': ['deferred', 'again'],
+}
+
+MESSAGE_MERGES = {
+    # ``parse --full`` re-reading the same lines (plus one more) - the stored lines are replaced
+    'reimport': (STORED, {
+        **STORED, 'last_attempt': t(2), 'status': {'code': 'sent', 'message': '(ok)'}, 'lines': lines(0, 1, 2),
+        'tokens': ['sent', 'ok'],
+    }),
+    # The later lines of a message which was flushed as idle - appended, without blanking the addresses
+    'continuation': (STORED, {
+        'id': 'AAAAAAAAA1', 'mail_from': '', 'mail_to': 'jane@example.com', 'timestamp': t(90),
+        'first_attempt': t(90), 'last_attempt': t(91), 'status': {'code': 'sent', 'message': '(ok)'},
+        'relay': {'host': 'mx2.example.com', 'ip': '5.6.7.8', 'port': '25'}, 'client': {},
+        'lines': lines(90, 91), 'tokens': ['sent', 'ok'],
+    }),
+    # Lines from before the stored ones (e.g. an older log imported later) - the earliest timestamp is kept
+    'older': (STORED, {**STORED, 'timestamp': t(-5), 'first_attempt': t(-5), 'lines': lines(-5), 'tokens': []}),
+    'no_tokens': ({k: v for k, v in STORED.items() if k != 'tokens'}, {**STORED, 'lines': lines(0, 1, 2)}),
+}
+
+
+def normalise(doc: dict) -> dict:
+    """Sets are unordered - ReQL's ``set_union`` doesn't sort the tokens like the SQLite merge does"""
+    return {**doc, 'tokens': sorted(doc.get('tokens', []))}
+
+
+def test_merge_reimport():
+    old, new = MESSAGE_MERGES['reimport']
+    merged = merge_message_doc(old, new)
+    assert merged['lines'] == lines(0, 1, 2)
+    assert merged['status']['code'] == 'sent'
+    assert merged['tokens'] == ['again', 'deferred', 'ok', 'sent']
+
+
+def test_merge_continuation():
+    old, new = MESSAGE_MERGES['continuation']
+    merged = merge_message_doc(old, new)
+    assert merged['lines'] == lines(0, 1, 90, 91)
+    assert (merged['mail_from'], merged['client']) == ('bob@example.org', STORED['client'])
+    assert (merged['timestamp'], merged['first_attempt'], merged['last_attempt']) == (t(0), t(0), t(91))
+    assert (merged['status']['code'], merged['relay']['host']) == ('sent', 'mx2.example.com')
+
+
+def test_merge_older_lines():
+    old, new = MESSAGE_MERGES['older']
+    merged = merge_message_doc(old, new)
+    assert (merged['timestamp'], merged['first_attempt']) == (t(-5), t(-5))
+    assert merged['lines'] == lines(-5)
+
+
+def test_merge_counts_and_deliveries():
+    old = {'id': 'x', 'counts': {'sent': 3, 'bounced': 1}}
+    assert merge_counts_doc(old, {'id': 'x', 'counts': {'sent': 2, 'deferred': 1}})['counts'] == {
+        'sent': 5, 'bounced': 1, 'deferred': 1,
+    }
+    early, late = {'id': 'd', 'timestamp': t(0), 'status': 'deferred'}, {'id': 'd', 'timestamp': t(5), 'status': 'sent'}
+    assert merge_delivery_doc(early, late) == late
+    assert merge_delivery_doc(late, early) == late
+
+
+@pytest.fixture(scope='module')
+def rethink():
+    host = os.environ.get('RETHINK_TEST_HOST')
+    if not host:
+        pytest.skip('Set RETHINK_TEST_HOST to compare the merges against a RethinkDB server')
+    from rethinkdb import r
+    conn = r.connect(host=host, port=int(os.environ.get('RETHINK_TEST_PORT', 28015)), timeout=5)
+    yield r, conn
+    conn.close()
+
+
+@pytest.mark.parametrize('case', sorted(MESSAGE_MERGES))
+def test_merge_message_matches_reql(rethink, case):
+    r, conn = rethink
+    old, new = MESSAGE_MERGES[case]
+    reql = merge_message(r.expr(old['id']), r.expr(old), r.expr(new)).run(conn)
+    assert normalise(reql) == normalise(merge_message_doc(old, new))
+
+
+def test_merge_counts_and_deliveries_match_reql(rethink):
+    r, conn = rethink
+    old, new = {'id': 'x', 'counts': {'sent': 3, 'bounced': 1}}, {'id': 'x', 'counts': {'sent': 2, 'deferred': 1}}
+    assert merge_counts('x', r.expr(old), r.expr(new)).run(conn) == merge_counts_doc(old, new)
+    early, late = {'id': 'd', 'timestamp': t(0)}, {'id': 'd', 'timestamp': t(5)}
+    for a, b in [(early, late), (late, early)]:
+        assert merge_delivery('d', r.expr(a), r.expr(b)).run(conn) == merge_delivery_doc(a, b)
+
+
+def test_insert_merge(tmp_path):
+    async def _run():
+        store = SQLiteStorage(str(tmp_path / 'db.sqlite3'))
+        try:
+            await store.bootstrap()
+            old, new = MESSAGE_MERGES['continuation']
+            res = await store.insert('sent_mail', [dict(old)], OnConflict.MERGE)
+            assert res['inserted'] == 1
+            res = await store.insert('sent_mail', [dict(new)], OnConflict.MERGE, return_changes=True)
+            assert (res['replaced'], len(res['changes'])) == (1, 1)
+            stored = await store.get('sent_mail', 'AAAAAAAAA1')
+            assert normalise(stored) == normalise(merge_message_doc(old, new))
+            # Merging the same document again changes nothing
+            res = await store.insert('sent_mail', [dict(new)], OnConflict.MERGE)
+            assert res['unchanged'] == 1
+            # The merged tokens are searchable through the multi index
+            assert await store.count('sent_mail', [Condition('tokens', 'contains', 'again')]) == (1, True)
+            assert await store.count('sent_mail', parse_filters({'mail_from': 'bob@example.org'})) == (1, True)
+        finally:
+            await store.close()
+    asyncio.run(_run())
@@ -0,0 +1,126 @@
+"""
+Tests for :class:`postfixparser.stream.MessageTracker` - finishing messages when they're removed or idle, and
+writing the later lines of an idle-flushed message as a continuation (see :func:`postfixparser.main._tracked_docs`).
+"""
+import asyncio
+from datetime import timedelta
+
+from postfixparser.main import _tracked_docs
+from postfixparser.stream import MessageTracker
+
+
+def line(ts: str, qid: str, msg: str) -> str:
+    return f'2019-12-01T{ts}.000000+00:00 mx1 postfix/smtp[123]: {qid}: {msg}'
+
+
+def from_line(ts, qid, addr='bob@example.org'):
+    return line(ts, qid, f'from=<{addr}>, size=100, nrcpt=1 (queue active)')
+
+
+def to_line(ts, qid, status='sent'):
+    return line(ts, qid, f'to=<jane@example.com>, relay=mx.example.com[1.2.3.4]:25, delay=1, dsn=2.0.0, '
+                         f'status={status} (ok)')
+
+
+def docs(tracker: MessageTracker, lines) -> list:
+    """Feed ``lines`` into ``tracker``, returning the ``sent_mail`` documents which would be written"""
+    async def msgs():
+        for l in lines:
+            for m in tracker.feed(l):
+                yield m
+
+    async def _run():
+        return [d async for d in _tracked_docs(msgs(), tracker, convert_time=lambda dt: dt)]
+    return asyncio.run(_run())
+
+
+def test_removed_finishes():
+    tracker = MessageTracker()
+    assert tracker.feed(from_line('10:00:00', 'AAAAAAAAA1')) == []
+    assert tracker.feed(to_line('10:00:01', 'AAAAAAAAA1')) == []
+    done = tracker.feed(line('10:00:02', 'AAAAAAAAA1', 'removed'))
+    assert [m.queue_id for m in done] == ['AAAAAAAAA1']
+    assert done[0].line_count == 3
+    assert tracker.messages == {}
+
+
+def test_idle_expiry():
+    tracker = MessageTracker(idle_timeout=timedelta(hours=1))
+    tracker.feed(from_line('10:00:00', 'AAAAAAAAA1'))
+    tracker.feed(from_line('10:30:00', 'BBBBBBBBB2'))
+    # Idle time is measured from the timestamps of the log lines
+    assert tracker.feed(from_line('11:00:00', 'CCCCCCCCC3')) == []
+    done = tracker.feed(from_line('11:00:01', 'DDDDDDDDD4'))
+    assert [m.queue_id for m in done] == ['AAAAAAAAA1']
+    assert list(tracker.messages) == ['BBBBBBBBB2', 'CCCCCCCCC3', 'DDDDDDDDD4']
+    # Not a continuation until the flushed message has been written
+    assert not tracker.is_continuation('AAAAAAAAA1')
+    tracker.written(done[0])
+    assert tracker.is_continuation('AAAAAAAAA1')
+
+
+def test_continuation():
+    tracker = MessageTracker(idle_timeout=timedelta(hours=1))
+    res = docs(tracker, [
+        from_line('10:00:00', 'AAAAAAAAA1'),
+        to_line('10:00:01', 'AAAAAAAAA1', 'deferred'),
+        from_line('11:30:00', 'CCCCCCCCC3'),          # Flushes AAAAAAAAA1 as idle
+        to_line('12:00:00', 'AAAAAAAAA1'),
+        line('12:00:01', 'AAAAAAAAA1', 'removed'),
+    ])
+    first, cont = [d for d in res if d['id'] == 'AAAAAAAAA1']
+    assert (first['mail_from'], first['status']['code'], len(first['lines'])) == ('bob@example.org', 'deferred', 2)
+    # The continuation only holds the new lines - it's merged into the stored message
+    assert (cont['status']['code'], len(cont['lines'])) == ('sent', 2)
+    assert cont['mail_from'] == ''
+    # Once removed, the queue ID may be re-used by a new message
+    assert not tracker.is_continuation('AAAAAAAAA1')
+
+
+def test_ignored_first_flush_is_not_continued():
+    tracker = MessageTracker(idle_timeout=timedelta(hours=1))
+    res = docs(tracker, [
+        from_line('10:00:00', 'AAAAAAAAA1', addr='bob@localhost'),
+        to_line('10:00:01', 'AAAAAAAAA1', 'deferred'),
+        from_line('11:30:00', 'CCCCCCCCC3'),
+        to_line('12:00:00', 'AAAAAAAAA1'),
+        line('12:00:01', 'AAAAAAAAA1', 'removed'),
+    ])
+    # The first flush is from an ignored domain, so the rest of the message isn't written either
+    assert [d['id'] for d in res] == []
+    assert tracker.flushed == {}
+
+
+def test_incomplete_first_flush_is_not_continued():
+    tracker = MessageTracker(idle_timeout=timedelta(hours=1))
+    res = docs(tracker, [
+        line('10:00:00', 'AAAAAAAAA1', 'client=mail.example.org[1.2.3.4]'),
+        from_line('11:30:00', 'CCCCCCCCC3'),
+    ])
+    assert res == []
+    assert not tracker.is_continuation('AAAAAAAAA1')
+
+
+def test_drained_continuation():
+    tracker = MessageTracker(idle_timeout=timedelta(hours=1))
+    res = docs(tracker, [
+        from_line('10:00:00', 'AAAAAAAAA1'),
+        to_line('10:00:01', 'AAAAAAAAA1', 'deferred'),
+        from_line('11:30:00', 'CCCCCCCCC3'),
+        to_line('12:00:00', 'AAAAAAAAA1', 'deferred'),   # Still in the queue when the import ends
+    ])
+    first, cont = [d for d in res if d['id'] == 'AAAAAAAAA1']
+    assert len(first['lines']) == 2
+    # Written as a continuation, rather than being dropped for not having a sender
+    assert (cont['mail_from'], len(cont['lines'])) == ('', 1)
+    assert 'AAAAAAAAA1' in tracker.messages
+
+
+def test_prune():
+    tracker = MessageTracker()
+    tracker.feed(from_line('10:00:00', 'AAAAAAAAA1'))
+    tracker.flushed['BBBBBBBBB2'] = tracker.messages['AAAAAAAAA1'].last_attempt
+    tracker.feed(from_line('20:00:00', 'CCCCCCCCC3'))
+    assert tracker.prune(timedelta(hours=2)) == 1
+    assert list(tracker.messages) == ['CCCCCCCCC3']
+    assert tracker.flushed == {}